@@ -15,23 +15,140 @@ class Config:
 
         # Check if there was target person detected in the last m analyses - if yes the recording continues
         self.RECORD_IF_IN_M_ANAL = 15
+        # The recording starts when there are at least START_COUNT positive analyses in the last m analyses
+        # and stops when there are at most STOP_COUNT of them and the clip is at least MIN_CLIP_LENGTH seconds long
+        self.RECORD_START_COUNT = 1
+        self.RECORD_STOP_COUNT = 0
+        self.MIN_CLIP_LENGTH = 0
+        # The clips begin PRE_ROLL_SECONDS before the analysis which started the recording (the first positive
+        # analysis can be up to NTH_FRAME frames late), in the live mode the encoded segments of the last
+        # PRE_ROLL_SECONDS are buffered for this purpose, 0 - the clips begin with the analysis as before
+        # (e.g. 2.0 covers the sampling delay of the default NTH_FRAME)
+        self.PRE_ROLL_SECONDS = 0
 
+        # A number of sampled frames whose faces are fed to the model in a single forward pass
+        self.ANALYSIS_BATCH_SIZE = 8
+
+        # The faces are detected on a copy of the frame resized by DETECTION_SCALE, the faces smaller
+        # than MIN_FACE_SIZE pixels (in the full resolution) are ignored, DETECTION_ROIS is a list of regions
+        # (x1, y1, x2, y2) relative to the frame size the faces are searched in (None means the whole frame),
+        # the defaults detect the same faces as before (e.g. 0.5 and 40 for a faster detection of larger faces)
+        self.DETECTION_SCALE = 1.0
+        self.MIN_FACE_SIZE = 20
+        self.DETECTION_ROIS = None
+        # The face detector: 'mtcnn' - MTCNN, 'yunet' - YuNet run by OpenCV DNN (faster on CPU, opencv-python >= 4.5.4)
+        self.DETECTOR = 'mtcnn'
+        # A path to the YuNet model (downloaded by setup.py)
+        self.YUNET_MODEL_PATH = f'{self.APP_DATA_DIR}/face_detection_yunet_2023mar.onnx'
+
+        # Follow the faces across the sampled frames and embed them only when they are new, moved, changed
+        # their appearance or when their identity is older than TRACK_REFRESH_INTERVAL seconds
+        # (opt-in, the cached identities may differ from embedding every face)
+        self.TRACK_FACES = False
+        self.TRACK_REFRESH_INTERVAL = 10.0
+
+        # Reuse the labels of the last analysed frame when the sampled frame differs from it by less than
+        # SCENE_CHANGE_THRESHOLD (mean absolute difference of downscaled intensities in <0, 1>, None disables it),
+        # the frame is analysed anyway when the last analysis is older than SCENE_MAX_STALENESS seconds
+        # (disabled until the threshold is tuned against the accuracy, e.g. 0.03)
+        self.SCENE_CHANGE_THRESHOLD = None
+        self.SCENE_MAX_STALENESS = 5.0
+
+        # Pipelined processing - a number of inference workers and a maximum number of batches waiting in a queue
+        self.PIPELINE_INFERENCE_WORKERS = 2
+        self.PIPELINE_QUEUE_SIZE = 4
+
+        # A number of worker processes of track_channels.py and a number of torch threads of each worker
+        # (None splits the CPUs evenly among the workers)
+        self.WORKER_PROCESSES = 4
+        self.WORKER_THREADS = None
+
+        # A number of processes cutting the video segments in the timeline mode
+        self.CLIP_WRITER_WORKERS = 2
+
+        # The way the video segments are cut out:
+        # 'reencode' - re-encoded with libx265, 'copy' - widened to the nearest keyframes and stream copied,
+        # 'exact' - frame exact, only the partial GOPs at the boundaries are re-encoded
+        # (both 'copy' and 'exact' use only the ffmpeg executable of imageio-ffmpeg)
+        self.CLIP_BACKEND = 'reencode'
+
+        # The version of the model, recorded with the reference features computed by it
+        self.MODEL_VERSION = 'resnet18_110'
         # A path to model weights
-        self.MODEL_WEIGHTS_PATH = f'{self.APP_DATA_DIR}/resnet18_110.pth'
+        self.MODEL_WEIGHTS_PATH = f'{self.APP_DATA_DIR}/{self.MODEL_VERSION}.pth'
+        # A path to the model with folded batch normalizations frozen by export_model.py - used if it exists
+        # and it was exported from the current MODEL_WEIGHTS_PATH
+        self.EXPORTED_MODEL_PATH = f'{self.APP_DATA_DIR}/{self.MODEL_VERSION}_frozen.pt'
+        # Use the int8 model saved by quantize_model.py (CPU only) if it exists: None - disabled,
+        # 'static' - convolutions and linear layers calibrated on the dataset, 'dynamic' - linear layers only
+        self.QUANTIZATION = None
+        # Each quantization mode has its own model, {mode} is replaced by the mode (used only if it was quantized
+        # from the current MODEL_WEIGHTS_PATH)
+        self.QUANTIZED_MODEL_PATH = f'{self.APP_DATA_DIR}/{self.MODEL_VERSION}_int8_{{mode}}.pt'
 
         # A path to the reference dataset - used to compute features of the target identities
         self.DATASET = f'{self.PROJECT_ROOT}/dataset'
 
-        # A path to pickle file where the reference features and corresponding labels will be stored
-        self.REPRESENTATIONS = f'{self.APP_DATA_DIR}/representations.pickle'
+        # The way the faces are embedded: 'flip' - the face and its flipped copy (1024-d features),
+        # 'single' - only the face (512-d features, half of the computation)
+        self.EMBEDDING_MODE = 'flip'
+
+        # A path to the directory where the reference features (memory-mapped .npy matrix) and the corresponding
+        # labels will be stored (the features computed in the single embedding mode are stored separately)
+        representations_suffix = '' if self.EMBEDDING_MODE == 'flip' else f'_{self.EMBEDDING_MODE}'
+        self.REPRESENTATIONS = f'{self.APP_DATA_DIR}/representations{representations_suffix}'
+        # A path to the pickle file the older versions stored the reference features in, imported once
+        self.LEGACY_REPRESENTATIONS = f'{self.APP_DATA_DIR}/representations{representations_suffix}.pickle'
+        # The features of the dataset images cached by setup.py under the hash of the image content,
+        # only the new or changed images are processed by the next run
+        self.REFERENCE_CACHE = f'{self.APP_DATA_DIR}/reference_cache{representations_suffix}.pickle'
+        # A number of dataset faces embedded in a single forward pass by setup.py
+        self.REFERENCE_BATCH_SIZE = 32
+
+        # Matching of the detected faces with the reference features:
+        # 'exact' - brute force, 'ivf' - approximate NumPy index, 'faiss' - approximate faiss index (faiss-cpu)
+        self.MATCHER = 'exact'
+        # A fraction of the exact matches the approximate index has to find
+        self.MATCHER_RECALL = 0.95
+        # A maximum number of identities matched to one face, None means unlimited
+        self.MATCHER_TOP_K = None
+        # A path to the file where the approximate index is stored
+        self.MATCHER_INDEX = f'{self.REPRESENTATIONS}.index'
 
         # A path to the directory where the processed videos will be stored
         self.VIDEO_DIR = f'{self.PROJECT_ROOT}/video_out'
+        # The embeddings of the faces of every processed video are saved to this directory, so the archive
+        # can be matched with new reference features by rematch_archive.py without the model (None disables it)
+        self.LEDGER_DIR = None
 
         # YouTube related
+        # A SQLite database with the state of every video (queued, processing, done, failed) shared by all the processes
+        self.JOB_STORE = f'{self.APP_DATA_DIR}/jobs.sqlite3'
+        # The videos whose heartbeat is older than this number of seconds are considered abandoned and queued again
+        self.JOB_STALE_AFTER = 10 * 60
+        # The time between the heartbeats of a video being processed [in seconds], must be less than JOB_STALE_AFTER
+        self.JOB_HEARTBEAT_INTERVAL = 60
+        # The set of processed video IDs saved by the older versions, imported to the JOB_STORE on the first run
         self.PROCESSED_YOUTUBE_IDS = f'{self.APP_DATA_DIR}/processed_ids.pickle'
         # The time between new video checks [in seconds]
         self.SLEEP_INTERVAL = 600
+        # The search endpoint of the YouTube Data API (can point to a local stub server for testing)
+        self.YOUTUBE_API_URL = 'https://www.googleapis.com/youtube/v3/search'
+        # The maximum number of concurrent API requests and stream resolutions
+        # and the maximum number of resolved videos waiting for the analysis
+        self.POLLER_CONCURRENCY = 4
+        self.POLLER_PREFETCH = 2
+        # The new videos are downloaded to this directory before the analysis, None means they are streamed
+        self.DOWNLOAD_DIR = None
+
+        # Live streams (HLS)
+        # The directory the stream segments are downloaded to, they are deleted once they can't be a part of a clip
+        self.LIVE_SEGMENT_DIR = f'{self.APP_DATA_DIR}/live_segments'
+        # The number of the segments before the live edge the ingest starts with
+        self.LIVE_EDGE_SEGMENTS = 3
+        # The segments which are more than LIVE_MAX_LATENCY seconds behind the newest downloaded segment
+        # are not analysed (but they are still saved in the clips), None analyses every segment
+        self.LIVE_MAX_LATENCY = 30
 
         # IPFS uploader constants
         # Maximum acceptable transaction size in bytes
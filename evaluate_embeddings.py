@@ -0,0 +1,126 @@
+"""
+A script which compares the identification accuracy of the embedding modes on the reference dataset.
+Every image with a single face is identified against the representative features of all the identities,
+where the representative feature of its own identity is computed without the image (leave-one-out).
+The images of the identities with a single image are used as unknown faces, which should not be identified.
+Example usage:
+$ python evaluate_embeddings.py
+"""
+from os import listdir
+from os.path import join
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from config import Config
+from video_presence_tracker import *
+
+
+def get_dataset_landmarks(classifier_wrapper, dataset_dir):
+    """
+    A function which detects the faces in the dataset, the images without exactly one face are skipped.
+    Only the landmarks are kept, the images are read again when the faces are embedded
+    :param classifier_wrapper: ClassifierWrapper used for the face detection
+    :param dataset_dir: a path to the dataset root folder
+    :return: a list of labels, a list of image paths and a list of landmarks of the faces, dimensions: (1, 10)
+    """
+    labels, image_paths, landmarks = [], [], []
+    for name in listdir(dataset_dir):
+        for image_name in listdir(join(dataset_dir, name)):
+            image_path = join(dataset_dir, name, image_name)
+            image = cv2.imread(image_path)
+            if image is None:
+                continue
+            _, image_landmarks = classifier_wrapper.detect(image)
+            if len(image_landmarks) == 1:
+                labels.append(name)
+                image_paths.append(image_path)
+                landmarks.append(np.asarray(image_landmarks))
+    return labels, image_paths, landmarks
+
+
+def get_features(classifier_wrapper, image_paths, landmarks, batch_size):
+    """
+    A function which embeds the detected faces in batches, only the images of one batch are in memory at a time
+    :param classifier_wrapper: ClassifierWrapper used for the embedding
+    :param image_paths: a list of paths of the images
+    :param landmarks: a list of landmarks of the faces, one array for each image
+    :param batch_size: int, the number of faces embedded in a single forward pass
+    :return: numpy.ndarray of features of the faces, dimensions: (num_faces, feature_dim)
+    """
+    features = []
+    for batch_i in range(0, len(image_paths), batch_size):
+        images = [cv2.imread(image_path) for image_path in image_paths[batch_i:batch_i + batch_size]]
+        features.append(classifier_wrapper.get_features_for_landmarks(images, landmarks[batch_i:batch_i + batch_size]))
+    return np.vstack(features)
+
+
+def evaluate(labels, features, threshold):
+    """
+    A function which identifies every face against the leave-one-out representative features
+    :param labels: a list of labels of the faces
+    :param features: numpy.ndarray of features of the faces, dimensions: (num_faces, feature_dim)
+    :param threshold: float, the maximum cosine distance of the face and the representative feature
+    :return: a dictionary of the accuracy measures
+    """
+    names = sorted(set(labels))
+    label_ids = np.array([names.index(label) for label in labels])
+    features = normalize_features(features)
+
+    # Sums of the features of each identity, the representative feature is their normalized mean
+    sums = np.zeros((len(names), features.shape[1]), dtype=np.float64)
+    np.add.at(sums, label_ids, features)
+    counts = np.bincount(label_ids, minlength=len(names))
+
+    known = correct = unknown = false_accepts = 0
+    for label_i, feature in zip(label_ids, features):
+        # Leave the face out of its own representative feature
+        face_sums, face_counts = sums.copy(), counts.copy()
+        face_sums[label_i] -= feature
+        face_counts[label_i] -= 1
+        valid = face_counts > 0
+        references = normalize_features(face_sums[valid])
+        reference_ids = np.flatnonzero(valid)
+
+        similarities = references @ feature
+        accepted = set(reference_ids[similarities > 1 - threshold])
+        if face_counts[label_i] > 0:
+            known += 1
+            best = reference_ids[np.argmax(similarities)]
+            correct += int(best == label_i and label_i in accepted)
+        else:
+            unknown += 1
+        false_accepts += int(len(accepted - {label_i}) != 0)
+
+    return {
+        'known faces': known,
+        'identification accuracy': correct / max(known, 1),
+        'unknown faces': unknown,
+        'false accept rate': false_accepts / max(len(labels), 1)
+    }
+
+
+if __name__ == '__main__':
+    # 1) Load configuration and detect the faces once for both modes
+    conf = Config()
+    threshold = 0.5
+    classifier_wrapper = ClassifierWrapper([], np.zeros((0, 1024), dtype=np.float32), conf.MODEL_WEIGHTS_PATH,
+                                           threshold)
+    labels, image_paths, landmarks = get_dataset_landmarks(classifier_wrapper, conf.DATASET)
+    print(f'{len(labels)} faces of {len(set(labels))} identities found in the dataset {conf.DATASET}')
+    if len(labels) == 0:
+        raise ValueError(f'No faces found in the dataset {conf.DATASET}')
+
+    # 2) Embed the faces in both modes and compare the results
+    for embedding_mode in ('flip', 'single'):
+        classifier_wrapper.embedding_mode = embedding_mode
+        start = perf_counter()
+        features = get_features(classifier_wrapper, image_paths, landmarks, conf.REFERENCE_BATCH_SIZE)
+        elapsed = perf_counter() - start
+
+        results = evaluate(labels, features, threshold)
+        print(f'Embedding mode {embedding_mode} ({features.shape[1]}-d features, '
+              f'{len(labels) / max(elapsed, 1e-9):.1f} faces/s):')
+        for measure, value in results.items():
+            print(f'    {measure}: {value:.4f}' if isinstance(value, float) else f'    {measure}: {value}')
@@ -0,0 +1,62 @@
+"""
+A script which folds the batch normalizations of the model into the neighbouring layers,
+freezes it with TorchScript and saves it, so that it can be loaded by the ClassifierWrapper directly.
+The embeddings of the exported model are checked against the original model on the faces from the dataset.
+Example usage:
+$ python export_model.py
+"""
+from os import listdir
+from os.path import join, exists
+
+import cv2
+import numpy as np
+import torch
+
+from config import Config
+from video_presence_tracker import *
+from video_presence_tracker.models.export import export_model
+
+
+def get_dataset_faces(classifier_wrapper, dataset_dir, max_faces=64):
+    """
+    A function which returns the processed faces from the dataset
+    :param classifier_wrapper: ClassifierWrapper used for the face detection
+    :param dataset_dir: a path to the dataset root folder
+    :param max_faces: int, the maximum number of faces to return
+    :return: torch.Tensor, dimensions: (num_faces * 2, 1, 128, 128) or (num_faces, 1, 128, 128)
+             in the single embedding mode of the classifier wrapper, None if there is no face
+    """
+    faces = []
+    for name in listdir(dataset_dir):
+        for image_name in listdir(join(dataset_dir, name)):
+            image = cv2.imread(join(dataset_dir, name, image_name))
+            if image is None:
+                continue
+            _, landmarks = classifier_wrapper.detect(image)
+            if len(landmarks) != 0:
+                faces.append(classifier_wrapper._get_faces(image, landmarks))
+            if len(faces) >= max_faces:
+                break
+        if len(faces) >= max_faces:
+            break
+    if len(faces) == 0:
+        return None
+    return torch.from_numpy(np.vstack(faces))
+
+
+if __name__ == '__main__':
+    # 1) Load configuration
+    conf = Config()
+
+    # 2) Collect the faces the embeddings are compared on
+    inputs = None
+    if exists(conf.DATASET):
+        classifier_wrapper = ClassifierWrapper([], np.zeros((0, 1024), dtype=np.float32), conf.MODEL_WEIGHTS_PATH)
+        inputs = get_dataset_faces(classifier_wrapper, conf.DATASET)
+    if inputs is None:
+        print('No faces found in the dataset, the model is checked on random images.')
+
+    # 3) Export the model
+    cosine = export_model(conf.MODEL_WEIGHTS_PATH, conf.EXPORTED_MODEL_PATH, inputs)
+    print(f'The exported model was saved to {conf.EXPORTED_MODEL_PATH}, '
+          f'the lowest cosine similarity to the original embeddings: {cosine:.6f}')
@@ -12,6 +12,7 @@ import ipfshttpclient
 from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from config import Config
+from video_presence_tracker.ffmpeg_utils import split_stream_copy
 
 
 def get_next_interval(duration, num_splits):
@@ -26,6 +27,39 @@ def get_next_interval(duration, num_splits):
         yield i * segment_duration, (i + 1) * segment_duration
 
 
+def split_video(video_path, max_size, backend):
+    """
+    A function which splits the video into parts which do not exceed the size limit
+    :param video_path: str, a path of the video
+    :param max_size: int, the maximum size of a part in bytes
+    :param backend: str, 'reencode' - the parts are re-encoded with libx265, otherwise the video is split
+           on the keyframes without re-encoding and the parts which are still too large are re-encoded
+    :return: a list of paths of the parts
+    """
+    num_splits = ceil(getsize(video_path) / max_size)
+    part_paths = [f'{video_path[0:-4]}_part{i}.mp4' for i in range(num_splits)]
+    video = VideoFileClip(video_path)
+    intervals = list(get_next_interval(video.duration, num_splits))
+    if backend == 'reencode':
+        for part_path, (t_start, t_end) in zip(part_paths, intervals):
+            video.subclip(t_start, t_end).write_videofile(part_path, codec='libx265')
+    else:
+        # Split on the keyframes without re-encoding --> the parts are only approximately of the same size
+        split_stream_copy(video_path, f'{video_path[0:-4]}_part%d.mp4', [t_start for t_start, _ in intervals[1:]])
+        part_paths = [part_path for part_path in part_paths if exists(part_path)]
+    video.close()
+
+    # The parts may still exceed the limit (sparse keyframes or an uneven bitrate) --> re-encode and split them
+    checked_paths = []
+    for part_path in part_paths:
+        if getsize(part_path) <= max_size:
+            checked_paths.append(part_path)
+        else:
+            checked_paths += split_video(part_path, max_size, 'reencode')
+            remove(part_path)
+    return checked_paths
+
+
 if __name__ == '__main__':
     # Load configuration
     conf = Config()
@@ -48,13 +82,7 @@ if __name__ == '__main__':
                     size_in_bytes = getsize(video_path)
                     if size_in_bytes > conf.MAX_TRANSACTION_SIZE:
                         # 4) If the size exceeds the transaction limit split it into chunks
-                        num_splits = ceil(size_in_bytes / conf.MAX_TRANSACTION_SIZE)
-                        video = VideoFileClip(video_path)
-                        for i, (t_start, t_end) in enumerate(get_next_interval(video.duration, num_splits)):
-                            video_clip_path = join(conf.VIDEO_DIR, f'{file_[0:-4]}_part{i}.mp4')
-                            video_clip = video.subclip(t_start, t_end)
-                            video_clip.write_videofile(video_clip_path, codec='libx265')
-                            files_to_upload.append(video_clip_path)
+                        files_to_upload = split_video(video_path, conf.MAX_TRANSACTION_SIZE, conf.CLIP_BACKEND)
                     else:
                         files_to_upload.append(video_path)
 
@@ -73,14 +101,10 @@ if __name__ == '__main__':
                         with open(path.join(conf.VIDEO_DIR, "uploaded_hashes.txt"), "a") as myfile:
                             myfile.write(path.basename(file_to_upload) + ', ' + ipfs_hash + '\n')
 
-                        if 'part' in file_to_upload:
+                        if file_to_upload != video_path:
                             print(f'Deleting video part {file_to_upload}.')
                             remove(file_to_upload)
-                            to_move = f'{file_to_upload[0:-10]}.mp4'
-                            if exists(to_move):
-                                move(to_move, uploaded_dir)
-                        else:
-                            move(file_to_upload, uploaded_dir)
+                    move(video_path, uploaded_dir)
 
             print(f'Going to sleep for {conf.SLEEP_INTERVAL} seconds')
             sleep(conf.SLEEP_INTERVAL)
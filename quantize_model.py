@@ -0,0 +1,102 @@
+"""
+A script which quantizes the model to int8, calibrates it on the faces from the dataset and saves it,
+so that it can be loaded by the ClassifierWrapper directly. The report compares the quantized and the original
+model on the faces not used for the calibration - the embedding throughput and the drift of the decisions
+made against the reference features at the cosine distance threshold.
+Example usage:
+$ python quantize_model.py --mode static
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from config import Config
+from export_model import get_dataset_faces
+from video_presence_tracker import *
+from video_presence_tracker.models.quantization import QUANTIZATION_MODES, export_quantized_model
+
+
+def get_embeddings(model, inputs, embedding_mode='flip', batch_size=32):
+    """
+    A function which computes the embeddings the same way ClassifierWrapper does
+    :param model: the model
+    :param inputs: torch.Tensor, dimensions: (num_faces * 2, 1, 128, 128) - each face followed by its flipped copy,
+           or (num_faces, 1, 128, 128) in the single embedding mode
+    :param embedding_mode: str, one of EMBEDDING_MODES
+    :param batch_size: int, the number of images fed to the model at once
+    :return: numpy.ndarray of normalized features, dimensions: (num_faces, 1024 or 512) and the elapsed time in seconds
+    """
+    start = perf_counter()
+    with torch.no_grad():
+        output = torch.cat([model(batch) for batch in torch.split(inputs, batch_size)]).numpy()
+    elapsed = perf_counter() - start
+    if embedding_mode == 'flip':
+        output = np.hstack((output[::2], output[1::2]))
+    return normalize_features(output), elapsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Quantizes the model to int8 and reports the speedup and the accuracy drift.')
+    parser.add_argument('--mode', default=None, choices=QUANTIZATION_MODES,
+                        help='static - convolutions and linear layers calibrated on the dataset, '
+                             'dynamic - only the linear layers (default: Config.QUANTIZATION).')
+    parser.add_argument('--max-faces', default=256, type=int,
+                        help='The maximum number of faces from the dataset used for the calibration and the report.')
+    args = parser.parse_args()
+
+    # 1) Load configuration
+    conf = Config()
+    mode = args.mode if args.mode is not None else conf.QUANTIZATION
+    if mode is None:
+        mode = 'static'
+
+    # 2) Collect the faces from the dataset in the configured embedding mode (in the flip mode every face
+    # is followed by its flipped copy), the first half of the faces is used for the calibration
+    # and the second half for the report
+    embedding_mode = conf.EMBEDDING_MODE
+    classifier_wrapper = ClassifierWrapper([], np.zeros((0, EMBEDDING_DIMS[embedding_mode]), dtype=np.float32),
+                                           conf.MODEL_WEIGHTS_PATH, embedding_mode=embedding_mode)
+    inputs = get_dataset_faces(classifier_wrapper, conf.DATASET, args.max_faces)
+    if inputs is None:
+        raise ValueError(f'No faces found in the dataset {conf.DATASET}, the model cannot be calibrated')
+    copies = 2 if embedding_mode == 'flip' else 1
+    num_faces = inputs.shape[0] // copies
+    calibration_inputs = inputs[:num_faces // 2 * copies] if num_faces >= 2 else inputs
+    report_inputs = inputs[num_faces // 2 * copies:]
+
+    # 3) Quantize the model
+    quantized_model_path = conf.QUANTIZED_MODEL_PATH.format(mode=mode)
+    eager_model, quantized_model = export_quantized_model(conf.MODEL_WEIGHTS_PATH, quantized_model_path, mode,
+                                                          calibration_inputs)
+    print(f'The {mode} quantized model was saved to {quantized_model_path}')
+
+    # 4) Compare the throughput and the embeddings (after a warm-up run of both models)
+    get_embeddings(eager_model, report_inputs[:copies], embedding_mode)
+    get_embeddings(quantized_model, report_inputs[:copies], embedding_mode)
+    features, float_time = get_embeddings(eager_model, report_inputs, embedding_mode)
+    quantized_features, quantized_time = get_embeddings(quantized_model, report_inputs, embedding_mode)
+    cosine = np.sum(features * quantized_features, axis=1)
+    print(f'Embedding throughput: {len(features) / float_time:.1f} faces/s (float32), '
+          f'{len(features) / quantized_time:.1f} faces/s ({mode} int8), speedup {float_time / quantized_time:.2f}x')
+    print(f'Cosine similarity of the float32 and int8 embeddings: mean {cosine.mean():.6f}, min {cosine.min():.6f}')
+
+    # 5) Compare the decisions against the reference features at the threshold used by the ClassifierWrapper
+    migrate_representations(conf.LEGACY_REPRESENTATIONS, conf.REPRESENTATIONS, conf.EMBEDDING_MODE)
+    try:
+        _, ref_features, _ = load_references(conf.REPRESENTATIONS, features.shape[1])
+    except (FileNotFoundError, ValueError) as err:
+        print(f'\033[93mException: {err} --> the decision drift is not reported\033[0m')
+        ref_features = None
+
+    if ref_features is not None:
+        threshold = 0.5
+        distances = 1 - features @ ref_features.T
+        quantized_distances = 1 - quantized_features @ ref_features.T
+        drift = np.abs(distances - quantized_distances)
+        flipped = (distances < threshold) != (quantized_distances < threshold)
+        print(f'Cosine distance drift: mean {drift.mean():.6f}, max {drift.max():.6f}')
+        print(f'Decisions at threshold {threshold} changed for {int(flipped.sum())} of {flipped.size} '
+              f'face-identity pairs ({100 * flipped.mean():.3f} %), '
+              f'{int(flipped.any(axis=1).sum())} of {len(features)} faces affected')
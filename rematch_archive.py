@@ -0,0 +1,80 @@
+"""
+A script which matches the face embeddings saved during the analysis of the archived videos (see LEDGER_DIR
+in config.py) with the current reference features, e.g. after a new identity was added to the dataset.
+The model is not loaded, the video segments are computed from the saved embeddings only.
+Example usage:
+$ python rematch_archive.py --identities new_person
+$ python rematch_archive.py --identities new_person --save-clips
+"""
+from argparse import ArgumentParser
+from os.path import exists
+
+from config import Config
+from video_presence_tracker import *
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Finds the video segments containing people whose faces are in the dataset '
+                                        'in the archived videos from the saved face embeddings.')
+    parser.add_argument('--ledger-dir', help='The directory of the saved embeddings (LEDGER_DIR by default).',
+                        default=None, type=str)
+    parser.add_argument('--identities', help='Report only the segments containing these identities.', nargs='+',
+                        default=None, type=str)
+    parser.add_argument('--save-clips', default=False, action='store_true',
+                        help='Pass this flag as argument to cut out the segments of the videos which are still '
+                             'available to the VIDEO_DIR.')
+    args = parser.parse_args()
+
+    # 1) Load configuration and the reference features
+    conf = Config()
+    ledger_dir = args.ledger_dir if args.ledger_dir is not None else conf.LEDGER_DIR
+    if ledger_dir is None:
+        parser.error('Set LEDGER_DIR in config.py or pass --ledger-dir')
+    migrate_representations(conf.LEGACY_REPRESENTATIONS, conf.REPRESENTATIONS, conf.EMBEDDING_MODE)
+    ref_labels, ref_features, _ = load_references(conf.REPRESENTATIONS, EMBEDDING_DIMS[conf.EMBEDDING_MODE])
+    matcher = get_matcher(conf.MATCHER, ref_features, index_path=conf.MATCHER_INDEX, recall=conf.MATCHER_RECALL,
+                          top_k=conf.MATCHER_TOP_K)
+    clip_writer = None
+    if args.save_clips:
+        clip_writer = ClipWriter(conf.VIDEO_DIR, max_pending=None, num_workers=conf.CLIP_WRITER_WORKERS,
+                                 use_processes=True, backend=conf.CLIP_BACKEND)
+
+    # 2) Match the embeddings of every video and compute the segments which would be recorded
+    num_segments = 0
+    for ledger_path in list_ledgers(ledger_dir):
+        columns, meta = load_ledger(ledger_path)
+        # The ledgers saved by the older versions have only the source (a path or URL)
+        video_name = meta.get('source_id', meta['source'])
+        if meta.get('title') is not None:
+            video_name = f'{meta["title"]} ({video_name})'
+        if meta['dim'] not in (0, ref_features.shape[1]):
+            print(f'\033[93mException: the embeddings of {video_name} have {meta["dim"]} dimensions, '
+                  f'the reference features {ref_features.shape[1]} --> skipping the video\033[0m')
+            continue
+
+        times, labels = match_ledger(columns, matcher, ref_labels)
+        detections = [len(frame_labels) != 0 for frame_labels in labels]
+        timeline = PresenceTracker.replay(times, detections, conf.RECORD_IF_IN_M_ANAL, conf.RECORD_START_COUNT,
+                                          conf.RECORD_STOP_COUNT, conf.MIN_CLIP_LENGTH, labels,
+                                          conf.PRE_ROLL_SECONDS)
+        if args.identities is not None:
+            timeline = [interval for interval in timeline if len(interval[2] & set(args.identities)) != 0]
+        if len(timeline) == 0:
+            continue
+
+        num_segments += len(timeline)
+        print(f'Found {len(timeline)} video segments in {video_name}:')
+        for t_start, t_end, identities in timeline:
+            t_end = f'{t_end:.2f}' if t_end is not None else 'end'
+            print(f'  {t_start:.2f} - {t_end}: {", ".join(sorted(identities))}')
+
+        # 3) Cut out the segments if the video is still available (the local files, e.g. the videos downloaded
+        # to the DOWNLOAD_DIR, the URLs of the streams expire)
+        if clip_writer is not None:
+            if exists(meta['source']):
+                clip_writer.save_timeline(meta['source'], timeline)
+            else:
+                print(f'\033[93mException: {video_name} is not available --> the segments are not saved\033[0m')
+
+    print(f'Found {num_segments} video segments in total')
+    if clip_writer is not None:
+        clip_writer.close()
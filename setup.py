@@ -1,11 +1,10 @@
 """
 A script which computes the reference feature vectors from the images
-within the dataset and saves them along with labels to a pickle file.
+within the dataset and saves them along with labels to the reference store.
 """
-from os import listdir, makedirs
-from os.path import join, exists
+from os import makedirs
+from os.path import exists
 
-import cv2
 import gdown
 import numpy as np
 
@@ -13,9 +12,8 @@ from config import Config
 from video_presence_tracker import *
 
 if __name__ == '__main__':
-    # 1) Load configuration and model
+    # 1) Load configuration
     conf = Config()
-    labels, features = [], []
 
     # 2) Make sure the app data dir exists
     if not exists(conf.APP_DATA_DIR):
@@ -31,37 +29,26 @@ if __name__ == '__main__':
         weights_url = 'https://drive.google.com/uc?id=1wJTbgNT11GSLNZT-nsCzXNeu6Pqh5r3y'
         gdown.download(weights_url, conf.MODEL_WEIGHTS_PATH, quiet=False)
 
-    classifier_wrapper = ClassifierWrapper(labels, features, conf.MODEL_WEIGHTS_PATH)
-
-    # 5) Iterate through the dataset folders (the names of those folders are labels)
-    for name in listdir(conf.DATASET):
-        name_features = []
-        # 6) Iterate through the images within the folder
-        for image_name in listdir(join(conf.DATASET, name)):
-            # 7) Load the image and compute the features
-            image_path = join(conf.DATASET, name, image_name)
-            image = cv2.imread(image_path)
-            image_features = classifier_wrapper.get_features(image)
-
-            if len(image_features) == 0:
-                print(f'No faces detected in the image on path {image_path}')
-            elif image_features.shape[0] > 1:
-                print(f'Multiple faces detected in the image on path {image_path}.'
-                      f'Cannot distinguish which face belongs to {name}')
-            else:
-                name_features.append(image_features)
-
-        # 8) Compute representative feature by averaging all the corresponding ones
-        name_features = np.vstack(name_features)
-        representative_feature = np.sum(name_features, axis=0) / name_features.shape[0]
-
-        # 9) Append label and feature to the corresponding lists
-        labels.append(name)
-        features.append(representative_feature)
-
-    # 10) Convert list of arrays to an array where each row is one feature vector
-    features = np.vstack(features)
-
-    # 11) Save the data as a pickle file
-    print('Saving the representation of identities.')
-    save_pickle(conf.REPRESENTATIONS, [labels, features])
\ No newline at end of file
+    # The YuNet face detector is downloaded from the OpenCV model zoo only when it is selected
+    if conf.DETECTOR == 'yunet' and not exists(conf.YUNET_MODEL_PATH):
+        print("Downloading the YuNet face detector.")
+        yunet_url = 'https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/' \
+                    'face_detection_yunet_2023mar.onnx'
+        gdown.download(yunet_url, conf.YUNET_MODEL_PATH, quiet=False)
+
+    # The reference faces are detected by the same detector as the faces in the videos, on the full resolution
+    face_detector = get_face_detector(conf.DETECTOR, model_path=conf.YUNET_MODEL_PATH)
+    classifier_wrapper = ClassifierWrapper([], np.zeros((0, EMBEDDING_DIMS[conf.EMBEDDING_MODE]), dtype=np.float32),
+                                           conf.MODEL_WEIGHTS_PATH, embedding_mode=conf.EMBEDDING_MODE,
+                                           face_detector=face_detector)
+
+    # 5) Compute the representative features of the identities (the names of the dataset folders are labels),
+    # only the images which changed since the last run are processed
+    reference_builder = ReferenceBuilder(classifier_wrapper, conf.REFERENCE_CACHE, conf.MODEL_WEIGHTS_PATH,
+                                         conf.DETECTOR, conf.WORKER_PROCESSES, conf.REFERENCE_BATCH_SIZE)
+    labels, features = reference_builder.build(conf.DATASET)
+
+    # 6) Save the data as a new version of the reference store, the running processes keep the version they opened
+    print(f'Saving the representation of {len(labels)} identities.')
+    makedirs(conf.REPRESENTATIONS, exist_ok=True)
+    save_references(conf.REPRESENTATIONS, labels, features, conf.MODEL_VERSION, conf.EMBEDDING_MODE)
@@ -0,0 +1,100 @@
+"""
+A script which processes videos from multiple YouTube channels (or a list of video files) in a pool
+of worker processes. The model is loaded once and shared by the workers, all of them save the video
+segments to the VIDEO_DIR.
+Example usage:
+$ python track_channels.py --yt-api-key KEY --channel-ids UCeY0bbntWzzVIaj2z3QigXg UC16niRr50-MSBwiO3YDb3RA
+$ python track_channels.py --video-paths first.mp4 second.mp4 --workers 2
+$ python track_channels.py --video-paths long_session.mp4 --sharded
+"""
+from argparse import ArgumentParser
+
+from config import Config
+from track_yt_channel import get_channel_poller, get_job_store, get_video_processor
+from video_presence_tracker import *
+
+
+def report(results):
+    """
+    A function which prints the results of the processed videos
+    :param results: an iterable of tuples (source, the error message or None)
+    :return: None
+    """
+    for source, error in results:
+        if error is None:
+            print(f'Processed video {source}')
+        else:
+            print(f'\033[93mException: {error} --> skipping the video {source}\033[0m')
+
+
+def iter_sources(poller):
+    """
+    A generator function which returns the new videos found by the poller, they are claimed by the workers
+    :param poller: ChannelPoller
+    :return: a tuple (video_id, title, source), where source is the stream URL or the path of the downloaded video
+    """
+    for video_id, video_title, source in poller:
+        print(f'Queueing video with title: {video_title}')
+        yield video_id, video_title, source
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='A bot saving video clips containing people whose faces are in the dataset '
+                                        'from multiple YouTube channels or video files in parallel processes.')
+    parser.add_argument('--channel-ids', help='IDs of the video channels.', nargs='+', default=[], type=str)
+    parser.add_argument('--yt-api-key', help='YouTube API key (required by --channel-ids).', type=str)
+    parser.add_argument('--video-paths', help='Paths of the video files.', nargs='+', default=[], type=str)
+    parser.add_argument('--workers', help='The number of worker processes.', default=None, type=int)
+    parser.add_argument('--sharded', default=False, action='store_true',
+                        help='Pass this flag as argument to split each video file into time shards analysed '
+                             'by all the workers, the segments are cut afterwards.')
+    args = parser.parse_args()
+    if len(args.channel_ids) != 0 and args.yt_api_key is None:
+        parser.error('--channel-ids requires --yt-api-key')
+
+    # 1) Load configuration and the model, the model is shared by the workers forked afterwards
+    conf = Config()
+    if args.sharded and (conf.TRACK_FACES or conf.SCENE_CHANGE_THRESHOLD is not None):
+        parser.error('--sharded gives the same segments as the sequential processing only with TRACK_FACES '
+                     'disabled and SCENE_CHANGE_THRESHOLD set to None')
+    video_processor = get_video_processor(conf)
+    num_workers = args.workers if args.workers is not None else conf.WORKER_PROCESSES
+    pool = VideoWorkerPool(video_processor, num_workers, conf.WORKER_THREADS)
+    print(f'Started {pool.num_workers} workers with {pool.threads_per_worker} threads each')
+
+    job_store = None
+    try:
+        # 2) Process the video files - one video per worker or one video at a time split among the workers
+        if args.sharded:
+            clip_writer = ClipWriter(conf.VIDEO_DIR, max_pending=None, num_workers=conf.CLIP_WRITER_WORKERS,
+                                     use_processes=True, backend=conf.CLIP_BACKEND)
+            for video_path in args.video_paths:
+                timeline = pool.get_timeline(video_path, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL,
+                                             conf.ANALYSIS_BATCH_SIZE)
+                print(f'Detected {len(timeline)} video segments to save in the video {video_path}')
+                clip_writer.save_timeline(video_path, timeline)
+            clip_writer.close()
+        else:
+            report(pool.process(args.video_paths, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL,
+                                conf.ANALYSIS_BATCH_SIZE))
+
+        # 3) Continually process the new videos of all the channels,
+        # the poller resolves the next videos while the workers process the current ones
+        if len(args.channel_ids) != 0:
+            job_store = get_job_store(conf)
+            poller = get_channel_poller(conf, args.channel_ids, args.yt_api_key, job_store)
+            try:
+                # The workers claim the videos and mark them as processed
+                report(pool.process(iter_sources(poller), conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL,
+                                    conf.ANALYSIS_BATCH_SIZE, job_store=job_store,
+                                    heartbeat_interval=conf.JOB_HEARTBEAT_INTERVAL))
+            finally:
+                poller.stop()
+    except KeyboardInterrupt:
+        print('Exiting')
+        pool.terminate()
+        # The videos claimed by the stopped workers are processed again next time
+        if job_store is not None:
+            job_store.release_owned()
+    else:
+        pool.close()
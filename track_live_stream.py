@@ -0,0 +1,54 @@
+"""
+A script which follows a live stream (HLS) and saves the clips containing people whose faces are in the dataset
+as the stream goes on. The segments of the stream are downloaded once and the clips are made of them
+without re-encoding.
+Example usage:
+$ python track_live_stream.py --url https://example.com/live/playlist.m3u8
+$ python track_live_stream.py --url https://www.youtube.com/watch?v=VIDEO_ID
+"""
+from argparse import ArgumentParser
+
+from config import Config
+from track_yt_channel import get_video_processor
+from video_presence_tracker import *
+
+
+def get_playlist_url(url):
+    """
+    A function which resolves the URL of the HLS playlist of the live stream
+    :param url: str, URL of the HLS playlist (.m3u8) or of a page with the live stream (resolved by streamlink)
+    :return: str, URL of the HLS playlist
+    """
+    if url.split('?', 1)[0].endswith('.m3u8'):
+        return url
+    import streamlink
+    streams = streamlink.streams(url)
+    if 'best' not in streams or not hasattr(streams['best'], 'url'):
+        raise IOError(f'Cannot find a live stream at {url}')
+    return streams['best'].url
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='A bot saving video clips from a live stream '
+                                        'containing people whose faces are in the dataset.')
+    parser.add_argument('--url', help='URL of the HLS playlist or of the page with the live stream.', required=True,
+                        type=str)
+    args = parser.parse_args()
+
+    # 1) Load configuration and the model
+    conf = Config()
+    video_processor = get_video_processor(conf)
+
+    # 2) Start downloading the segments of the stream and analyse them as they arrive
+    hls_reader = HLSReader(get_playlist_url(args.url), conf.LIVE_SEGMENT_DIR, conf.LIVE_EDGE_SEGMENTS,
+                           conf.LIVE_MAX_LATENCY)
+    try:
+        video_processor.process_live(hls_reader, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL, conf.ANALYSIS_BATCH_SIZE,
+                                     source_id=args.url)
+    except KeyboardInterrupt:
+        print('Exiting')
+    finally:
+        hls_reader.stop()
+
+    # Wait for the video segments which are still being saved
+    video_processor.close()
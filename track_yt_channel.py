@@ -7,44 +7,104 @@ $ python track_yt_channel.py --display-video --channel-id UCeY0bbntWzzVIaj2z3Qig
 """
 from argparse import ArgumentParser
 from os.path import exists
-from time import sleep
 
-import requests
 from moviepy.editor import *
 from pafy import pafy
 
 from config import Config
 from video_presence_tracker import *
+from video_presence_tracker.models.export import is_export_current
 
 
-def get_next_new_channel_vid(channel_id, api_key, processed_ids_path):
+def get_stream_url(video_id):
     """
-    A generator function, which returns id and title of not yet processed videos
-    :param channel_id: str, YouTube channel ID
+    A function which resolves the URL of the best mp4 stream of the YouTube video
+    :param video_id: str, YouTube video ID
+    :return: str, URL of the video file
+    """
+    video = pafy.new(f'https://www.youtube.com/watch?v={video_id}')
+    return video.getbest(preftype='mp4').url
+
+
+def open_youtube_video(video_id):
+    """
+    A function which opens the best mp4 stream of the YouTube video
+    :param video_id: str, YouTube video ID
+    :return: moviepy.editor.VideoFileClip - used to cut out the snippets containing the target identities
+    """
+    return VideoFileClip(get_stream_url(video_id))
+
+
+def get_job_store(conf):
+    """
+    A function which opens the store of the video states, imports the processed IDs saved by the older versions
+    and returns the videos left in processing by a crashed process back to the queue
+    :param conf: Config
+    :return: JobStore
+    """
+    job_store = JobStore(conf.JOB_STORE)
+    num_imported = job_store.migrate_pickle(conf.PROCESSED_YOUTUBE_IDS)
+    if num_imported != 0:
+        print(f'Imported {num_imported} processed video IDs from {conf.PROCESSED_YOUTUBE_IDS}')
+    job_store.requeue_stale(conf.JOB_STALE_AFTER)
+    return job_store
+
+
+def get_channel_poller(conf, channel_ids, api_key, job_store):
+    """
+    A function which instantiates the poller of the channels as defined by the configuration
+    :param conf: Config
+    :param channel_ids: a list of YouTube channel IDs
     :param api_key: str, YouTube API key
-    :param processed_ids_path: path to the pickle file,
-           where the processed video ids are stored in a set
-    :return: video id and video title
+    :param job_store: JobStore, the store of the video states
+    :return: ChannelPoller
+    """
+    return ChannelPoller(channel_ids, api_key, get_stream_url, job_store, conf.YOUTUBE_API_URL,
+                         conf.SLEEP_INTERVAL, conf.POLLER_CONCURRENCY, conf.POLLER_PREFETCH, conf.DOWNLOAD_DIR)
+
+
+def get_video_processor(conf, display_vid=False, clip_writer=None):
     """
-    processed_ids = set()
-    if exists(processed_ids_path):
-        processed_ids = load_pickle(processed_ids_path)
-
-    params = {
-        'channelId': channel_id,
-        'key': api_key,
-        'part': 'snippet',
-        'type': 'video',
-        'maxResults': 20
-    }
-    videos = requests.get(url='https://www.googleapis.com/youtube/v3/search', params=params).json()
-    for video_dict in videos['items']:
-        video_id, title = video_dict['id']['videoId'], video_dict['snippet']['title']
-        if video_id not in processed_ids:
-            processed_ids.add(video_id)
-            yield video_id, title
-
-    save_pickle(processed_ids_path, processed_ids)
+    A function which loads the reference features and the model and instantiates the video processor
+    as defined by the configuration
+    :param conf: Config
+    :param display_vid: a parameter determining whether the video should be displayed in a separate window
+    :param clip_writer: ClipWriter, the writer stage of the pipelined and the timeline processing
+    :return: VideoProcessor
+    """
+    # 1) Open the reference features and labels (memory-mapped, shared by all the processes)
+    migrate_representations(conf.LEGACY_REPRESENTATIONS, conf.REPRESENTATIONS, conf.EMBEDDING_MODE)
+    ref_labels, ref_features, _ = load_references(conf.REPRESENTATIONS, EMBEDDING_DIMS[conf.EMBEDDING_MODE],
+                                                  conf.MODEL_VERSION)
+
+    # 2) Load (or build) the index of the reference features
+    matcher = get_matcher(conf.MATCHER, ref_features, index_path=conf.MATCHER_INDEX, recall=conf.MATCHER_RECALL,
+                          top_k=conf.MATCHER_TOP_K)
+
+    # 3) Select the face detector and the fastest available model
+    face_detector = get_face_detector(conf.DETECTOR, conf.DETECTION_SCALE, conf.MIN_FACE_SIZE, conf.DETECTION_ROIS,
+                                      conf.YUNET_MODEL_PATH)
+    model_path = conf.MODEL_WEIGHTS_PATH
+    if is_export_current(conf.EXPORTED_MODEL_PATH, conf.MODEL_WEIGHTS_PATH):
+        model_path = conf.EXPORTED_MODEL_PATH
+    elif exists(conf.EXPORTED_MODEL_PATH):
+        print(f'\033[93mException: {conf.EXPORTED_MODEL_PATH} was not exported from {conf.MODEL_WEIGHTS_PATH} '
+              f'--> using the weights, run export_model.py again\033[0m')
+    if conf.QUANTIZATION is not None:
+        quantized_model_path = conf.QUANTIZED_MODEL_PATH.format(mode=conf.QUANTIZATION)
+        if is_export_current(quantized_model_path, conf.MODEL_WEIGHTS_PATH):
+            model_path = quantized_model_path
+        elif exists(quantized_model_path):
+            print(f'\033[93mException: {quantized_model_path} was not quantized from {conf.MODEL_WEIGHTS_PATH} '
+                  f'--> not using it, run quantize_model.py again\033[0m')
+
+    return VideoProcessor(ref_labels, ref_features, model_path, conf.VIDEO_DIR, display_vid, clip_writer,
+                          conf.CLIP_BACKEND, start_count=conf.RECORD_START_COUNT, stop_count=conf.RECORD_STOP_COUNT,
+                          min_clip_length=conf.MIN_CLIP_LENGTH, matcher=matcher, track_faces=conf.TRACK_FACES,
+                          track_refresh_interval=conf.TRACK_REFRESH_INTERVAL,
+                          scene_change_threshold=conf.SCENE_CHANGE_THRESHOLD,
+                          scene_max_staleness=conf.SCENE_MAX_STALENESS, embedding_mode=conf.EMBEDDING_MODE,
+                          face_detector=face_detector, pre_roll=conf.PRE_ROLL_SECONDS, ledger_dir=conf.LEDGER_DIR)
 
 
 if __name__ == '__main__':
@@ -54,35 +114,70 @@ if __name__ == '__main__':
     parser.add_argument('--yt-api-key', help='YouTube API key.', required=True, type=str)
     parser.add_argument("--display-video", default=False, action="store_true",
                         help="Pass this flag as argument to display the video while processing.")
+    parser.add_argument("--pipelined", default=False, action="store_true",
+                        help="Pass this flag as argument to decode, analyse and save the video concurrently "
+                             "(the video is not displayed in this mode).")
+    parser.add_argument("--timeline", default=False, action="store_true",
+                        help="Pass this flag as argument to analyse the whole video first and cut the segments "
+                             "in parallel processes afterwards (the video is not displayed in this mode).")
     args = parser.parse_args()
 
     # Load configuration
     conf = Config()
 
-    # Load reference features and labels.
-    ref_labels, ref_features = load_pickle(conf.REPRESENTATIONS)
-
-    # Instantiate the video processor
-    video_processor = VideoProcessor(ref_labels, ref_features, conf.MODEL_WEIGHTS_PATH,
-                                     conf.VIDEO_DIR, args.display_video)
-
-    while True:
-        try:
-            # Iterate over new videos
-            for video_id, video_title in get_next_new_channel_vid(args.channel_id, args.yt_api_key,
-                                                                  conf.PROCESSED_YOUTUBE_IDS):
-                # Get the exact URL of the video file
-                video = pafy.new(f'https://www.youtube.com/watch?v={video_id}')
-                stream = video.getbest(preftype='mp4')
-
-                # Create an instance of moviepy video - used to cut out the snippets containing the target identites
-                video = VideoFileClip(stream.url)
-
-                print(f'Processing video with title: {video_title}')
-                video_processor.process(video, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL)
-
-            print(f'Going to sleep for {conf.SLEEP_INTERVAL} seconds')
-            sleep(conf.SLEEP_INTERVAL)
-        except KeyboardInterrupt:
-            print('Exiting')
-            break
\ No newline at end of file
+    # Instantiate the video processor, in the timeline mode the video segments are cut in a process pool
+    clip_writer = None
+    if args.timeline:
+        clip_writer = ClipWriter(conf.VIDEO_DIR, max_pending=None, num_workers=conf.CLIP_WRITER_WORKERS,
+                                 use_processes=True, backend=conf.CLIP_BACKEND)
+    video_processor = get_video_processor(conf, args.display_video, clip_writer)
+
+    # Open the store of the video states and start polling the channel
+    job_store = get_job_store(conf)
+    poller = get_channel_poller(conf, [args.channel_id], args.yt_api_key, job_store)
+
+    try:
+        # Iterate over new videos, the next videos are resolved while the current one is being processed
+        for video_id, video_title, source in poller:
+            # Skip the video if another process claimed it in the meantime
+            if not job_store.claim(video_id):
+                continue
+
+            try:
+                # The heartbeat tells the other processes the video is still being processed
+                with job_store.heartbeat(video_id, conf.JOB_HEARTBEAT_INTERVAL):
+                    # Create an instance of moviepy video - used to cut out the snippets containing the target identites
+                    video = VideoFileClip(source)
+
+                    print(f'Processing video with title: {video_title}')
+                    if args.timeline:
+                        video_processor.process_timeline(video, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL,
+                                                         conf.ANALYSIS_BATCH_SIZE, video_id, video_title)
+                    elif args.pipelined:
+                        video_processor.process_pipelined(video, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL,
+                                                          conf.ANALYSIS_BATCH_SIZE, conf.PIPELINE_INFERENCE_WORKERS,
+                                                          conf.PIPELINE_QUEUE_SIZE)
+                    else:
+                        video_processor.process(video, conf.NTH_FRAME, conf.RECORD_IF_IN_M_ANAL,
+                                                conf.ANALYSIS_BATCH_SIZE, video_id, video_title)
+
+                    # The video is done only once its segments are saved by the writer stage
+                    video_processor.join()
+            except KeyboardInterrupt:
+                # The interrupted video is processed again next time
+                job_store.release(video_id)
+                raise
+            except Exception as err:
+                print(f'\033[93mException: {err} --> skipping the video {video_id}\033[0m')
+                job_store.mark_failed(video_id, str(err))
+                continue
+
+            # The video is marked as processed only after it was processed
+            job_store.mark_done(video_id)
+    except KeyboardInterrupt:
+        print('Exiting')
+    finally:
+        poller.stop()
+
+    # Wait for the video segments which are still being saved
+    video_processor.close()
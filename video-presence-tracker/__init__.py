@@ -1,3 +1,16 @@
-from .classifierwrapper import ClassifierWrapper
+from .channelpoller import ChannelPoller, RateLimitError
+from .classifierwrapper import EMBEDDING_DIMS, ClassifierWrapper
+from .clipwriter import ClipWriter
+from .embeddingledger import EmbeddingLedger, list_ledgers, load_ledger, match_ledger
+from .facedetector import FaceDetector, MTCNNBackend, YuNetBackend, get_face_detector
+from .facetracker import FaceTracker
+from .hlsreader import HLSReader
+from .jobstore import JobStore
+from .matchers import BruteForceMatcher, FaissMatcher, IVFMatcher, get_matcher, normalize_features
 from .pickle_utils import *
-from .videoprocessor import VideoProcessor
\ No newline at end of file
+from .presencetracker import PresenceTracker
+from .referencebuilder import ReferenceBuilder
+from .referencestore import load_references, migrate_representations, save_references
+from .scenegate import SceneChangeGate
+from .videoprocessor import VideoProcessor
+from .workerpool import VideoWorkerPool
@@ -0,0 +1,263 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, replace
+from os.path import exists, join
+from queue import Empty, Queue
+from threading import Event, Thread
+
+import requests
+from requests.adapters import HTTPAdapter
+
+YOUTUBE_SEARCH_URL = 'https://www.googleapis.com/youtube/v3/search'
+
+# The status codes of the responses which are retried after a backoff (exceeded quota and rate limiting),
+# all the server errors (5xx) are retried as well
+_RETRY_STATUSES = (403, 429)
+
+
+class RateLimitError(IOError):
+    """
+    Raised when the API keeps refusing the requests after all the retries
+    """
+
+
+class ChannelPoller:
+    """
+    A class which watches multiple YouTube channels for new videos. The polling runs in an asyncio event loop
+    in a background thread - the channels are queried concurrently over a pooled HTTP session and the streams
+    of the new videos are resolved (and optionally downloaded) concurrently under a concurrency limit.
+    A video is resolved only when one of the prefetch slots is free (the consumer frees a slot by taking
+    a video), so the next videos are prepared while the current one is being analysed, but the stream URLs
+    (which expire) are not resolved long before they are used.
+    """
+
+    def __init__(self, channel_ids, api_key, resolve, job_store=None, api_url=YOUTUBE_SEARCH_URL,
+                 sleep_interval=600, concurrency=4, prefetch=2, download_dir=None, max_retries=5, backoff=1.0):
+        """
+        :param channel_ids: a list of YouTube channel IDs
+        :param api_key: str, YouTube API key
+        :param resolve: a function video_id -> URL of the video stream, called in a worker thread
+        :param job_store: JobStore, the new videos are queued in it and only the queued videos are prepared,
+               all the videos found after the start are prepared if not set
+        :param api_url: str, URL of the search endpoint of the YouTube Data API (can point to a stub server)
+        :param sleep_interval: float, the time between the checks of the channels in seconds
+        :param concurrency: int, the maximum number of concurrent HTTP requests and stream resolutions
+        :param prefetch: int, the maximum number of resolved videos waiting for the analysis
+        :param download_dir: str, the videos are downloaded to this directory before they are queued,
+               the stream URLs are queued if not set
+        :param max_retries: int, the maximum number of retries of a rate limited request
+        :param backoff: float, the delay before the first retry in seconds, doubled with every retry
+        """
+        self.channel_ids = channel_ids
+        self.api_key = api_key
+        self.resolve = resolve
+        self.job_store = job_store
+        # IDs of the videos prepared since the start
+        self._prepared = set()
+        self.api_url = api_url
+        self.sleep_interval = sleep_interval
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.download_dir = download_dir
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        # The connections are reused by all the requests, the pool is as large as the concurrency limit
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(concurrency)
+        # The thread waiting for the next check
+        self._wait_executor = ThreadPoolExecutor(1)
+
+        # The queue holds at most prefetch videos, one slot is taken for every video being prepared or queued
+        self._queue = Queue()
+        self._slots = None
+        self._loop = None
+        # The videos being prepared in the background (the event loop keeps only weak references to the tasks)
+        self._tasks = set()
+        self._stop_event = Event()
+        self._thread = None
+
+    async def _call(self, func, *args, executor=None):
+        """
+        :param executor: the executor the blocking function is called in, the HTTP executor if not set
+        :return: the result of the blocking function
+        """
+        executor = executor if executor is not None else self._executor
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def _get_json(self, params):
+        """
+        A function which queries the API and retries the rate limited and the failed requests with an exponential
+        backoff
+        :param params: dict, the query parameters
+        :return: the decoded JSON response
+        """
+        for attempt in range(self.max_retries + 1):
+            response = await self._call(lambda: self.session.get(self.api_url, params=params, timeout=30))
+            if response.status_code not in _RETRY_STATUSES and response.status_code < 500:
+                response.raise_for_status()
+                return response.json()
+
+            # Respect the delay requested by the server if there is one
+            retry_after = response.headers.get('Retry-After')
+            delay = float(retry_after) if retry_after is not None and retry_after.isdigit() \
+                else self.backoff * 2 ** attempt
+            print(f'\033[93mException: the API responded {response.status_code} --> '
+                  f'retrying in {delay} seconds\033[0m')
+            await asyncio.sleep(delay)
+        raise RateLimitError(f'The API refused the request {self.max_retries + 1} times')
+
+    async def _get_new_videos(self, channel_id, semaphore):
+        """
+        :param channel_id: str, YouTube channel ID
+        :param semaphore: asyncio.Semaphore limiting the number of concurrent requests
+        :return: a list of (video_id, title) tuples of the new videos of the channel
+        """
+        params = {
+            'channelId': channel_id,
+            'key': self.api_key,
+            'part': 'snippet',
+            'type': 'video',
+            'maxResults': 20
+        }
+        async with semaphore:
+            videos = await self._get_json(params)
+
+        new_videos = []
+        for video_dict in videos['items']:
+            video_id, title = video_dict['id']['videoId'], video_dict['snippet']['title']
+            if video_id in self._prepared:
+                continue
+            if self.job_store is None or self.job_store.enqueue(video_id, title, channel_id):
+                new_videos.append((video_id, title))
+        return new_videos
+
+    def _download(self, url, video_id):
+        """
+        A function which downloads the video stream to the download directory
+        :param url: str, URL of the video stream
+        :param video_id: str, YouTube video ID
+        :return: str, path of the downloaded video
+        """
+        video_path = join(self.download_dir, f'{video_id}.mp4')
+        if exists(video_path):
+            return video_path
+        # The video is downloaded under a temporary name, so an interrupted download is never used
+        with self.session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(f'{video_path}.part', 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        replace(f'{video_path}.part', video_path)
+        return video_path
+
+    async def _prepare(self, video_id, title, semaphore):
+        """
+        A function which waits for a free prefetch slot, resolves (and downloads) the video and puts it to the queue
+        :param video_id: str, YouTube video ID
+        :param title: str, the title of the video
+        :param semaphore: asyncio.Semaphore limiting the number of concurrent resolutions
+        :return: None
+        """
+        # The slot is freed by the consumer when it takes the video from the queue
+        await self._slots.acquire()
+        try:
+            async with semaphore:
+                source = await self._call(self.resolve, video_id)
+                if self.download_dir is not None:
+                    source = await self._call(self._download, source, video_id)
+        except Exception as err:
+            self._slots.release()
+            print(f'\033[93mException: {err} --> skipping the video {video_id}\033[0m')
+            return
+        self._queue.put((video_id, title, source))
+
+    async def poll_once(self):
+        """
+        A function which checks all the channels concurrently and prepares their new videos
+        :return: int, the number of new (and previously queued) videos
+        """
+        if self._slots is None:
+            self._loop, self._slots = asyncio.get_running_loop(), asyncio.Semaphore(self.prefetch)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        channel_videos = await asyncio.gather(*[self._get_new_videos(channel_id, semaphore)
+                                                for channel_id in self.channel_ids], return_exceptions=True)
+        new_videos = {}
+        for channel_id, videos in zip(self.channel_ids, channel_videos):
+            if isinstance(videos, Exception):
+                print(f'\033[93mException: {videos} --> skipping the channel {channel_id}\033[0m')
+                continue
+            new_videos.update(videos)
+
+        # The videos queued before (e.g. by a process which crashed or was interrupted before processing them)
+        # are prepared again, even if they are no longer among the latest videos of the channel
+        if self.job_store is not None:
+            channel_ids = set(self.channel_ids)
+            for video_id, title, channel_id in self.job_store.get_queued():
+                if channel_id in channel_ids and video_id not in self._prepared:
+                    new_videos.setdefault(video_id, title)
+
+        # The videos are never prepared twice, even if they are still being analysed in the next check
+        self._prepared.update(new_videos)
+        # The videos are prepared in the background as the consumer frees the slots,
+        # so the channels are checked again on time even if the consumer is behind
+        for video_id, title in new_videos.items():
+            task = asyncio.create_task(self._prepare(video_id, title, semaphore))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return len(new_videos)
+
+    async def _run(self):
+        """
+        The polling loop of the background thread
+        """
+        if self.download_dir is not None and not exists(self.download_dir):
+            makedirs(self.download_dir)
+        while not self._stop_event.is_set():
+            num_videos = await self.poll_once()
+            print(f'Found {num_videos} new videos, checking the channels again in {self.sleep_interval} seconds')
+            await self._call(self._stop_event.wait, self.sleep_interval, executor=self._wait_executor)
+
+    def start(self):
+        """
+        A function which starts polling in the background thread
+        :return: self
+        """
+        if self._thread is None:
+            self._thread = Thread(target=lambda: asyncio.run(self._run()), daemon=True)
+            self._thread.start()
+        return self
+
+    def __iter__(self):
+        """
+        :return: the generator returns tuples (video_id, title, source) of the new videos, where source is
+                 the path of the downloaded video or the stream URL, the polling is started on the first use
+        """
+        self.start()
+        while not self._stop_event.is_set():
+            try:
+                item = self._queue.get(timeout=0.5)
+            except Empty:
+                if not self._thread.is_alive():
+                    return
+                continue
+            # The consumer took the video --> the next one can be prepared
+            if self._thread.is_alive():
+                self._loop.call_soon_threadsafe(self._slots.release)
+            yield item
+
+    def stop(self):
+        """
+        A function which stops the polling
+        :return: None
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=False)
+        self._wait_executor.shutdown(wait=False)
+        self.session.close()
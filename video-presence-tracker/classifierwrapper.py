@@ -1,20 +1,64 @@
 import cv2
 import numpy as np
 import torch
-from mtcnn import detect_faces
-from scipy.spatial.distance import cdist
-from skimage import transform as trans
 from torch.nn import DataParallel
 
+from .facedetector import FaceDetector
+from .matchers import BruteForceMatcher
 from .models.resnet import resnet_face18
 
+# The face is embedded either along with its horizontally flipped copy (the 512-d outputs of both are concatenated)
+# or alone, which halves the computation of the model
+EMBEDDING_MODES = ('flip', 'single')
+# The dimension of the features produced in each embedding mode
+EMBEDDING_DIMS = {'flip': 1024, 'single': 512}
+
+# The resolution of the frontalized face
+TARGET_RES = (128, 128)
+# The desired position of the 5 facial landmarks in the frontalized face (defined for 96x112 faces originally)
+REFERENCE_LANDMARKS = np.array([
+    [30.2946, 51.6963],
+    [65.5318, 51.5014],
+    [48.0252, 71.7366],
+    [33.5493, 92.3655],
+    [62.7299, 92.2041]]) * [TARGET_RES[0] / 96, TARGET_RES[1] / 112]
+
+
+def estimate_similarity_transforms(points, reference=REFERENCE_LANDMARKS):
+    """
+    A function which estimates the similarity transformations (rotation, uniform scale and translation) mapping
+    the points of every face onto the reference points in the least squares sense. The transformations of all
+    the faces are solved at once in the closed form (the same solution as skimage SimilarityTransform.estimate).
+    :param points: numpy.ndarray, dimensions: (num_faces, num_points, 2)
+    :param reference: numpy.ndarray, dimensions: (num_points, 2)
+    :return: numpy.ndarray of affine matrices, dimensions: (num_faces, 2, 3)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    src_mean = points.mean(axis=1)
+    dst_mean = reference.mean(axis=0)
+    src = points - src_mean[:, np.newaxis]
+    dst = reference - dst_mean
+
+    # The linear part of the similarity is [[a, -b], [b, a]], minimizing the squared error gives
+    # a = sum(src . dst) / |src|^2 and b = sum(src x dst) / |src|^2
+    norm = np.maximum(np.sum(src ** 2, axis=(1, 2)), 1e-12)
+    a = np.sum(src[:, :, 0] * dst[:, 0] + src[:, :, 1] * dst[:, 1], axis=1) / norm
+    b = np.sum(src[:, :, 0] * dst[:, 1] - src[:, :, 1] * dst[:, 0], axis=1) / norm
+
+    matrices = np.empty((len(points), 2, 3))
+    matrices[:, 0, 0], matrices[:, 0, 1] = a, -b
+    matrices[:, 1, 0], matrices[:, 1, 1] = b, a
+    matrices[:, :, 2] = dst_mean - np.einsum('nij,nj->ni', matrices[:, :, :2], src_mean)
+    return matrices
+
 
 class ClassifierWrapper:
     """
     A class implementing the classification pipeline
     """
 
-    def __init__(self, ref_labels, ref_features, model_weights_path, threshold=0.5):
+    def __init__(self, ref_labels, ref_features, model_weights_path, threshold=0.5, matcher=None,
+                 embedding_mode='flip', face_detector=None):
         """
         :param ref_labels: a list containing the labels,
                the index corresponds to the row withing ref_features
@@ -23,9 +67,20 @@ class ClassifierWrapper:
         :param threshold: a float representing the maximum cosine distance
                between reference feature vector and a feature vector
                belonging to the same class
+        :param matcher: an object comparing the features with ref_features (see matchers.py),
+               BruteForceMatcher is used if not set
+        :param embedding_mode: str, one of EMBEDDING_MODES - 'flip' produces 1024-d features, 'single' 512-d ones,
+               ref_features have to be computed in the same mode
+        :param face_detector: FaceDetector (see facedetector.py),
+               MTCNN detection on the full resolution frame is used if not set
         """
+        if embedding_mode not in EMBEDDING_MODES:
+            raise ValueError(f'Unknown embedding mode {embedding_mode}, expected one of {EMBEDDING_MODES}')
+        self.embedding_mode = embedding_mode
+        self.face_detector = face_detector if face_detector is not None else FaceDetector()
         self.ref_labels = ref_labels
         self.ref_features = ref_features
+        self.matcher = matcher if matcher is not None else BruteForceMatcher(ref_features, threshold)
         self.torch_device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.threshold = threshold
         self._set_model(model_weights_path)
@@ -33,82 +88,36 @@ class ClassifierWrapper:
     def _set_model(self, model_weights_path):
         """
         A function which instantiates the model and loads the weights
-        :param model_weights_path: str, path to the model weights
+        :param model_weights_path: str, path to the model weights (.pth)
+               or to the TorchScript model exported by export_model.py (.pt)
         :return: None
         """
-        model = resnet_face18(False)
-        model = DataParallel(model)
-        model.load_state_dict(torch.load(model_weights_path, map_location=self.torch_device))
+        if model_weights_path.endswith('.pt'):
+            # The exported model already contains the architecture with the batch normalizations folded
+            model = torch.jit.load(model_weights_path, map_location=self.torch_device)
+        else:
+            model = resnet_face18(False)
+            model = DataParallel(model)
+            model.load_state_dict(torch.load(model_weights_path, map_location=self.torch_device))
         model.to(self.torch_device)
         model.eval()
         self.model = model
 
-    @staticmethod
-    def _frontalize_face(img, landmarks):
-        """
-        A function which returns 128x128 image with frontalized face
-        :param img: image with face
-        :param landmarks: numpy.ndarray
-        :return: numpy.ndarray, image with frontalized face
-        """
-        target_res = (128, 128)
-
-        # Convert landmarks of shape (1, 10) to array of coordinates of 5 facial points (shape (5, 2))
-        dst = landmarks.astype(np.float32)
-        facial5points = np.array([[dst[j], dst[j + 5]] for j in range(5)])
-
-        # The desired position of landmarks
-        src = np.array([
-            [30.2946, 51.6963],
-            [65.5318, 51.5014],
-            [48.0252, 71.7366],
-            [33.5493, 92.3655],
-            [62.7299, 92.2041]], dtype=np.float32)
-
-        src[:, 0] *= (target_res[0] / 96)
-        src[:, 1] *= (target_res[1] / 112)
-
-        # Compute the parameters of the affine transformation
-        tform = trans.SimilarityTransform()
-        tform.estimate(facial5points, src)
-        M = tform.params[0:2, :]
-
-        # Applying the transformation matrix M to the original image
-        img_warped = cv2.warpAffine(img, M, target_res, borderValue=0.0)
-
-        return img_warped
-
-    @staticmethod
-    def _process_image(img):
-        """
-        A function, which transforms the image into a form which can be fed to the model
-        (originally from arcface-pytorch project)
-        :param img: numpy.ndarray, the image to process
-        :return: numpy.ndarray, the processed image
-        """
-        # Stack image and it's flipped version. Output dimensions: (128, 128, 2)
-        img = np.dstack((img, np.fliplr(img)))
-        # Transpose. Output dimensions: (2, 128, 128)
-        img = img.transpose((2, 0, 1))
-        # Add dimension. Output dimensions: (2, 1, 128, 128)
-        img = img[:, np.newaxis, :, :]
-        img = img.astype(np.float32, copy=False)
-        # Normalize to <-1, 1>
-        img -= 127.5
-        img /= 127.5
-        return img
-
     def _get_features_for_batch(self, imgs):
         """
         Function which returns features for one batch of images stacked on top of each other
         (originally from arcface-pytorch project)
         :param imgs: numpy.ndarray, an array of images, dimensions: (num_img * 2, 1, 128, 128)
-        :return: numpy.ndarray, an array of features, dimensions: (num_img, 1024)
+               or (num_img, 1, 128, 128) in the single embedding mode
+        :return: numpy.ndarray, an array of features, dimensions: (num_img, 1024) or (num_img, 512)
         """
         data = torch.from_numpy(imgs)
         data = data.to(self.torch_device)
-        output = self.model(data)
+        with torch.no_grad():
+            output = self.model(data)
         output = output.data.cpu().numpy()
+        if self.embedding_mode == 'single':
+            return output
 
         fe_1 = output[::2]
         fe_2 = output[1::2]
@@ -116,48 +125,194 @@ class ClassifierWrapper:
 
         return features
 
+    def detect(self, img):
+        """
+        A function which detects faces in the image
+        :param img: numpy.ndarray, dimensions: (height, weight, 3)
+        :return: numpy.ndarray of bounding boxes, dimensions: (num_faces, 5) - x1, y1, x2, y2, score
+                 and numpy.ndarray of landmarks, dimensions: (num_faces, 10) - x coordinates followed by y coordinates
+        """
+        return self.face_detector.detect(img)
+
+    def detect_batch(self, imgs):
+        """
+        A function which detects faces in multiple images
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :return: a list of pairs (bounding boxes, landmarks) as returned by detect, one pair for each image
+        """
+        return self.face_detector.detect_batch(imgs)
+
+    def _get_faces(self, img, landmarks, out=None):
+        """
+        A function which returns the faces with the given landmarks frontalized and processed
+        (normalized to <-1, 1> and followed by their flipped version in the flip embedding mode)
+        :param img: numpy.ndarray, dimensions: (height, weight, 3)
+        :param landmarks: numpy.ndarray, dimensions: (num_faces, 10) - x coordinates followed by y coordinates
+        :param out: numpy.ndarray of float32 the faces are written to, allocated if not set
+        :return: numpy.ndarray, dimensions: (num_faces * 2, 1, 128, 128) or (num_faces, 1, 128, 128)
+                 in the single embedding mode
+        """
+        copies = 2 if self.embedding_mode == 'flip' else 1
+        landmarks = np.asarray(landmarks, dtype=np.float64).reshape(-1, 2, 5)
+        if out is None:
+            out = np.empty((len(landmarks) * copies, 1, TARGET_RES[1], TARGET_RES[0]), dtype=np.float32)
+        if len(landmarks) == 0:
+            return out
+
+        # 1) The classifier expects 2D image, the image sometimes contains all the colors and sometimes not
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+        # 2) Frontalize the faces, the landmarks are reshaped to (num_faces, 5, 2) coordinates of the facial points
+        matrices = estimate_similarity_transforms(landmarks.transpose((0, 2, 1)))
+        warped = np.empty((len(landmarks), TARGET_RES[1], TARGET_RES[0]), dtype=np.uint8)
+        for face_i, matrix in enumerate(matrices):
+            cv2.warpAffine(img, matrix, TARGET_RES, dst=warped[face_i], borderValue=0.0)
+
+        # 3) Fill the output (each face is followed by its flipped version) and normalize it to <-1, 1>
+        out[::copies, 0] = warped
+        if copies == 2:
+            out[1::2, 0] = warped[:, :, ::-1]
+        out -= 127.5
+        out /= 127.5
+        return out
+
+    def _get_faces_batch(self, imgs, landmarks):
+        """
+        A function which frontalizes and processes the faces from multiple images into a single array
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :param landmarks: a list of numpy.ndarray landmarks, dimensions: (num_faces_in_image, 10),
+               one array for each image
+        :return: numpy.ndarray, dimensions: (num_faces * 2, 1, 128, 128) or (num_faces, 1, 128, 128)
+                 in the single embedding mode
+        """
+        copies = 2 if self.embedding_mode == 'flip' else 1
+        num_faces = sum(len(img_landmarks) for img_landmarks in landmarks)
+        faces = np.empty((num_faces * copies, 1, TARGET_RES[1], TARGET_RES[0]), dtype=np.float32)
+        start = 0
+        for img, img_landmarks in zip(imgs, landmarks):
+            end = start + len(img_landmarks) * copies
+            self._get_faces(img, img_landmarks, faces[start:end])
+            start = end
+        return faces
+
+    def get_features_for_landmarks(self, imgs, landmarks):
+        """
+        A function which computes the feature vectors of already detected faces in a single forward pass
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :param landmarks: a list of numpy.ndarray landmarks, dimensions: (num_faces_in_image, 10),
+               one array for each image
+        :return: numpy.ndarray, an array of features in the order of the landmarks,
+                 dimensions: (num_faces, 1024 or 512)
+        """
+        if sum(len(img_landmarks) for img_landmarks in landmarks) == 0:
+            return []
+        return self._get_features_for_batch(self._get_faces_batch(imgs, landmarks))
+
+    def get_features_batch(self, imgs):
+        """
+        A function which detects faces in multiple images and computes the feature vectors
+        of all the detections in a single forward pass
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :return: numpy.ndarray, an array of features, dimensions: (num_faces, 1024 or 512)
+                 and numpy.ndarray of indices of the images the features belong to, dimensions: (num_faces,)
+        """
+        features, img_indices, _ = self.get_detections_and_features_batch(imgs)
+        return features, img_indices
+
+    def get_detections_and_features_batch(self, imgs):
+        """
+        A function which detects faces in multiple images and computes the feature vectors
+        of all the detections in a single forward pass
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :return: numpy.ndarray, an array of features, dimensions: (num_faces, 1024 or 512),
+                 numpy.ndarray of indices of the images the features belong to, dimensions: (num_faces,)
+                 and a list of numpy.ndarrays of bounding boxes, dimensions: (num_faces, 5), one for each image
+        """
+        face_imgs, face_landmarks, img_indices = [], [], []
+        detections = self.detect_batch(imgs)
+        for img_i, (img, (_, landmarks)) in enumerate(zip(imgs, detections)):
+            if len(landmarks) != 0:
+                face_imgs.append(img)
+                face_landmarks.append(landmarks)
+                img_indices.extend([img_i] * len(landmarks))
+
+        features = []
+        if len(face_imgs) != 0:
+            try:
+                features = self.get_features_for_landmarks(face_imgs, face_landmarks)
+            except Exception as err:
+                print(f'\033[93mException: {err} --> skipping the batch classification\033[0m')
+                img_indices = []
+        return features, np.array(img_indices, dtype=np.int64), [bboxes for bboxes, _ in detections]
+
     def get_features(self, img):
         """
         A function which detects faces in the image, and computes the feature vector for each detection
         :param img: numpy.ndarray, dimensions: (height, weight, 3)
-        :return: numpy.ndarray, an array of features, dimensions: (num_img, 1024)
+        :return: numpy.ndarray, an array of features, dimensions: (num_img, 1024 or 512)
         """
-        features = []
-        try:
-            bboxes, landmarks = detect_faces(img)
-            if len(bboxes) != 0:
-                faces = []
-                for box_landmarks in landmarks:
-                    if img.ndim == 3:
-                        # For some reason, the image sometimes contains all the colors and sometimes not -->
-                        # doesn't matter as the classifier expects 2D image anyway
-                        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-                    face_img = self._frontalize_face(img, box_landmarks)
-                    face_img = self._process_image(face_img)
-                    faces.append(face_img)
-                faces = np.vstack(faces)
-                features = self._get_features_for_batch(faces)
-        except Exception as err:
-            print(f'\033[93mException: {err} --> skipping the frame classification\033[0m')
+        features, _ = self.get_features_batch([img])
         return features
 
+    def match_features(self, features):
+        """
+        A function which compares the features with the reference features
+        :param features: numpy.ndarray, an array of features, dimensions: (num_faces, 1024 or 512)
+        :return: a list of dictionaries {label: the best cosine similarity}, one dictionary for each face
+        """
+        face_scores = [{} for _ in range(len(features))]
+        if len(features) == 0:
+            return face_scores
+
+        for face_i, label_i, similarity in zip(*self.matcher.match(features)):
+            scores = face_scores[face_i]
+            label = self.ref_labels[label_i]
+            scores[label] = max(scores.get(label, -1.0), float(similarity))
+        return face_scores
+
+    def get_label_scores_batch(self, imgs):
+        """
+        A function which returns labels for multiple images along with the best cosine similarity
+        of each label, all the detected faces are fed to the model as one batch.
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :return: a list of dictionaries {label: the best cosine similarity}, one dictionary for each image
+        """
+        features, img_indices = self.get_features_batch(imgs)
+        return self.get_label_scores_for_features(features, img_indices, len(imgs))
+
+    def get_label_scores_for_features(self, features, img_indices, num_imgs):
+        """
+        A function which returns labels for multiple images along with the best cosine similarity
+        of each label from the features of the faces detected in them
+        :param features: numpy.ndarray, an array of features, dimensions: (num_faces, 1024 or 512)
+        :param img_indices: numpy.ndarray of indices of the images the features belong to, dimensions: (num_faces,)
+        :param num_imgs: int, the number of images
+        :return: a list of dictionaries {label: the best cosine similarity}, one dictionary for each image
+        """
+        label_scores = [{} for _ in range(num_imgs)]
+
+        # Classification
+        for img_i, face_scores in zip(img_indices, self.match_features(features)):
+            scores = label_scores[img_i]
+            for label, similarity in face_scores.items():
+                scores[label] = max(scores.get(label, -1.0), similarity)
+
+        return label_scores
+
+    def get_labels_batch(self, imgs):
+        """
+        A function which returns labels for multiple images,
+        all the detected faces are fed to the model as one batch.
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :return: a list of sets of labels, one set for each image
+        """
+        return [set(scores) for scores in self.get_label_scores_batch(imgs)]
+
     def get_labels(self, img):
         """
         A function which returns labels for the image.
         :param img: numpy.ndarray, dimensions: (height, weight, 3)
         :return: a set of labels
         """
-        detected_labels = set()
-        features = self.get_features(img)
-        if len(features) == 0:
-            return detected_labels
-
-        # Classification
-        dists = cdist(features, self.ref_features, metric='cosine')
-        decisions = dists < self.threshold
-        presence = np.sum(decisions, axis=0) >= 1
-        label_indices = np.where(presence)[0]
-        for label_i in label_indices:
-            detected_labels.add(self.ref_labels[label_i])
-
-        return detected_labels
\ No newline at end of file
+        return self.get_labels_batch([img])[0]
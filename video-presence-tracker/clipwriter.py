@@ -0,0 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from os import link, remove
+from os.path import join
+from shutil import copyfile
+from threading import BoundedSemaphore
+from time import time
+
+from moviepy.video.io.VideoFileClip import VideoFileClip
+
+from .ffmpeg_utils import concat_stream_copy, cut_frame_exact, cut_stream_copy
+
+# reencode - moviepy re-encodes the segment with libx265
+# copy - the segment is widened to the nearest keyframes and stream copied (lossless)
+# exact - only the partial GOPs at the boundaries are re-encoded, the rest is stream copied
+CLIP_BACKENDS = ('reencode', 'copy', 'exact')
+
+
+def _save_identities(video_path, identities):
+    """
+    A function which saves the identities detected in the video segment next to it
+    :param video_path: str, a path of the video segment
+    :param identities: a set of identities detected in the video segment
+    :return: None
+    """
+    with open(f'{video_path}_identities', 'a') as f:
+        f.write(",".join(identities))
+
+
+def save_clip(video, video_path, identities, t_start, t_end=None, backend='reencode'):
+    """
+    A function which cuts out the video segment and saves it along with the detected identities
+    :param video: moviepy.editor.VideoFileClip - the source video
+    :param video_path: str, a path under which the video segment is going to be saved
+    :param identities: a set of identities detected in the video segment
+    :param t_start: numpy.float64, the beginning of the video segment
+    :param t_end: numpy.float64, the end of the video segment (None means the end of the video)
+    :param backend: str, one of CLIP_BACKENDS
+    :return: None
+    """
+    if backend == 'reencode':
+        video_clip = video.subclip(t_start, t_end)
+        video_clip.write_videofile(video_path, codec='libx265')
+        _save_identities(video_path, identities)
+    else:
+        write_clip(video.filename, video_path, identities, t_start, t_end, backend)
+
+
+def write_clip(source_path, video_path, identities, t_start, t_end=None, backend='reencode'):
+    """
+    A function which opens its own reader of the source video and saves the video segment,
+    so that it can run concurrently with the decoding of the source video
+    :param source_path: str, a path (or URL) of the source video
+    :param video_path: str, a path under which the video segment is going to be saved
+    :param identities: a set of identities detected in the video segment
+    :param t_start: numpy.float64, the beginning of the video segment
+    :param t_end: numpy.float64, the end of the video segment (None means the end of the video)
+    :param backend: str, one of CLIP_BACKENDS
+    :return: None
+    """
+    t_start = float(t_start)
+    t_end = float(t_end) if t_end is not None else None
+    if backend == 'copy':
+        cut_stream_copy(source_path, video_path, t_start, t_end)
+    elif backend == 'exact':
+        cut_frame_exact(source_path, video_path, t_start, t_end)
+    elif backend == 'reencode':
+        video = VideoFileClip(source_path)
+        try:
+            save_clip(video, video_path, identities, t_start, t_end)
+        finally:
+            video.close()
+        return
+    else:
+        raise ValueError(f'Unknown clip backend {backend}, expected one of {CLIP_BACKENDS}')
+    _save_identities(video_path, identities)
+
+
+def save_segments_clip(segment_paths, video_path, identities):
+    """
+    A function which saves the video segment made of whole stream segments (e.g. HLS) without decoding them,
+    the clip starts and ends on the boundaries of the stream segments
+    :param segment_paths: a list of paths of the consecutive MPEG-TS segments
+    :param video_path: str, a path under which the video segment is going to be saved
+    :param identities: a set of identities detected in the video segment
+    :return: None
+    """
+    concat_stream_copy(segment_paths, video_path)
+    _save_identities(video_path, identities)
+
+
+def _write_segments_clip(segment_paths, video_path, identities):
+    """
+    A function which saves the video segment made of the private links of the stream segments
+    and removes the links afterwards
+    :param segment_paths: a list of paths of the links of the consecutive MPEG-TS segments
+    :param video_path: str, a path under which the video segment is going to be saved
+    :param identities: a set of identities detected in the video segment
+    :return: None
+    """
+    try:
+        save_segments_clip(segment_paths, video_path, identities)
+    finally:
+        for segment_path in segment_paths:
+            remove(segment_path)
+
+
+def _link_segment(segment_path, link_path):
+    """
+    A function which creates a hard link of the stream segment, so the segment stays on the disk
+    when the reader deletes it, the segment is copied if the file system doesn't support the hard links
+    :param segment_path: str, a path of the stream segment
+    :param link_path: str, a path of the link
+    :return: str, the path of the link
+    """
+    try:
+        link(segment_path, link_path)
+    except OSError:
+        copyfile(segment_path, link_path)
+    return link_path
+
+
+class ClipWriter:
+    """
+    A class implementing the writer stage - the video segments are saved in the background
+    while the analysis continues. When there are too many segments waiting to be saved,
+    the submission blocks.
+    """
+
+    def __init__(self, video_dir, max_pending=4, num_workers=1, use_processes=False, backend='reencode'):
+        """
+        :param video_dir: a path to the directory where the video segments will be stored
+        :param max_pending: int, a maximum number of segments waiting to be saved, None means unlimited
+        :param num_workers: int, a number of segments saved in parallel
+        :param use_processes: bool, whether the segments are saved in a process pool instead of a thread pool
+        :param backend: str, one of CLIP_BACKENDS
+        """
+        if backend not in CLIP_BACKENDS:
+            raise ValueError(f'Unknown clip backend {backend}, expected one of {CLIP_BACKENDS}')
+        self.video_dir = video_dir
+        self.backend = backend
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._executor = executor_class(max_workers=num_workers)
+        self._slots = BoundedSemaphore(max_pending) if max_pending is not None else None
+        self._futures = []
+
+    def submit(self, source_path, identities, t_start, t_end=None, video_name=None):
+        """
+        A function which schedules the video segment to be saved
+        :param source_path: str, a path (or URL) of the source video
+        :param identities: a set of identities detected in the video segment
+        :param t_start: numpy.float64, the beginning of the video segment
+        :param t_end: numpy.float64, the end of the video segment (None means the end of the video)
+        :param video_name: str, a name under which the video segment is going to be saved,
+               derived from the current time if not set
+        :return: str, a path under which the video segment is going to be saved
+        """
+        if video_name is None:
+            video_name = f'{time()}.mp4'
+        video_path = join(self.video_dir, video_name)
+        self._submit(write_clip, source_path, video_path, set(identities), t_start, t_end, self.backend)
+        return video_path
+
+    def submit_segments(self, segment_paths, identities, video_name=None):
+        """
+        A function which schedules the video segment made of whole stream segments to be saved
+        (see save_segments_clip). The stream segments are hard-linked before the function returns,
+        so the caller can delete them right away
+        :param segment_paths: a list of paths of the consecutive MPEG-TS segments
+        :param identities: a set of identities detected in the video segment
+        :param video_name: str, a name under which the video segment is going to be saved,
+               derived from the current time if not set
+        :return: str, a path under which the video segment is going to be saved
+        """
+        if video_name is None:
+            video_name = f'{time()}.mp4'
+        video_path = join(self.video_dir, video_name)
+        # The links are created next to the segments (on the same file system)
+        link_paths = [_link_segment(segment_path, f'{segment_path}.{video_name}')
+                      for segment_path in segment_paths]
+        self._submit(_write_segments_clip, link_paths, video_path, set(identities))
+        return video_path
+
+    def _submit(self, func, *args):
+        """
+        A function which schedules the job, it blocks when there are too many jobs waiting
+        :param func: a module level function saving the video segment
+        :param args: the arguments of the function
+        :return: None
+        """
+        # Blocks when the writer can't keep up
+        if self._slots is not None:
+            self._slots.acquire()
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._on_done)
+        self._futures = [f for f in self._futures if not f.done()] + [future]
+
+    def save_timeline(self, source_path, timeline):
+        """
+        A function which schedules all the video segments of the detection timeline to be saved
+        :param source_path: str, a path (or URL) of the source video
+        :param timeline: a list of (t_start, t_end, identities) tuples
+        :return: a list of paths under which the video segments are going to be saved
+        """
+        timeline_t = time()
+        return [self.submit(source_path, identities, t_start, t_end, f'{timeline_t}_{i}.mp4')
+                for i, (t_start, t_end, identities) in enumerate(timeline)]
+
+    def _on_done(self, future):
+        """
+        A callback which frees the slot and reports the failure of the finished job
+        :param future: concurrent.futures.Future
+        :return: None
+        """
+        if self._slots is not None:
+            self._slots.release()
+        err = future.exception()
+        if err is not None:
+            print(f'\033[93mException: {err} --> the video segment was not saved\033[0m')
+
+    def join(self):
+        """
+        A function which waits until all the submitted segments are saved
+        :return: a list of the exceptions of the segments which were not saved
+        """
+        wait(self._futures)
+        errors = [future.exception() for future in self._futures if future.exception() is not None]
+        self._futures = []
+        return errors
+
+    def close(self):
+        """
+        A function which waits for the submitted segments and stops the writer
+        :return: None
+        """
+        self.join()
+        self._executor.shutdown(wait=True)
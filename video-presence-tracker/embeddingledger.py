@@ -0,0 +1,180 @@
+import json
+from hashlib import sha1
+from os import listdir, makedirs, rename
+from os.path import basename, exists, isdir, join, splitext
+from shutil import rmtree
+from time import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+from .matchers import normalize_features
+
+# The columns of the ledger, each of them is stored in its own .npy file
+LEDGER_COLUMNS = ('sampled_times', 'analysed_times', 'face_frames', 'boxes', 'face_embeddings', 'embeddings')
+
+
+def get_ledger_name(source):
+    """
+    :param source: str, a stable ID, a path or URL of the video
+    :return: str, the name of the ledger of the video - the name of the file followed by a hash of the whole source
+    """
+    name = splitext(basename(urlparse(source).path))[0] or 'video'
+    return f'{name}_{sha1(source.encode()).hexdigest()[:10]}'
+
+
+class EmbeddingLedger:
+    """
+    A class which records the face embeddings computed during the analysis of one video, so that the video
+    can be matched with another set of reference features later without running the model again.
+    The ledger consists of the times of all the sampled frames, the times of the analysed frames
+    (the rest reuses the labels of the last analysed frame), the bounding box of every detected face,
+    the index of the embedding of every face (the tracked faces share the embedding) and the embeddings
+    normalized and stored as float16. The columns are saved as .npy files which are memory-mapped when loaded.
+    """
+
+    def __init__(self):
+        self.sampled_times = []
+        self.analysed_times = []
+        self.face_frames = []
+        self.boxes = []
+        self.face_embeddings = []
+        self.embeddings = []
+        self.num_embeddings = 0
+
+    def add_embeddings(self, features):
+        """
+        A function which stores the embeddings
+        :param features: numpy.ndarray, an array of features, dimensions: (num_faces, dim)
+        :return: numpy.ndarray of indices of the stored embeddings, dimensions: (num_faces,)
+        """
+        indices = np.arange(self.num_embeddings, self.num_embeddings + len(features), dtype=np.int32)
+        if len(features) != 0:
+            self.embeddings.append(normalize_features(features).astype(np.float16))
+            self.num_embeddings += len(features)
+        return indices
+
+    def add_frame(self, t, bboxes, embedding_indices):
+        """
+        A function which stores the faces of the analysed frame
+        :param t: float, time of the frame
+        :param bboxes: numpy.ndarray of bounding boxes, dimensions: (num_faces, 4+) - x1, y1, x2, y2, ...
+        :param embedding_indices: a list of indices of the embeddings of the faces, -1 if the face wasn't embedded
+        :return: None
+        """
+        frame_i = len(self.analysed_times)
+        self.analysed_times.append(t)
+        for box, embedding_i in zip(bboxes, embedding_indices):
+            self.face_frames.append(frame_i)
+            self.boxes.append(np.asarray(box[:4], dtype=np.float32))
+            self.face_embeddings.append(embedding_i)
+
+    def add_sampled_times(self, times):
+        """
+        A function which stores the times of the sampled frames, both analysed and skipped
+        :param times: a list of times of the frames
+        :return: None
+        """
+        self.sampled_times.extend(times)
+
+    def save(self, ledger_dir, source, meta=None, source_id=None):
+        """
+        A function which saves the ledger of the video, the previous ledger of the same video is replaced
+        :param ledger_dir: str, the directory of all the ledgers
+        :param source: str, a path or URL of the video
+        :param meta: dict, additional information stored with the ledger
+        :param source_id: str, a stable ID of the video (e.g. the YouTube video ID) the ledger is named by,
+               the source if not set
+        :return: str, path of the saved ledger
+        """
+        source_id = source_id if source_id is not None else source
+        dim = self.embeddings[0].shape[1] if len(self.embeddings) != 0 else 0
+        columns = {
+            'sampled_times': np.asarray(self.sampled_times, dtype=np.float64),
+            'analysed_times': np.asarray(self.analysed_times, dtype=np.float64),
+            'face_frames': np.asarray(self.face_frames, dtype=np.int32),
+            'boxes': np.asarray(self.boxes, dtype=np.float32).reshape(-1, 4),
+            'face_embeddings': np.asarray(self.face_embeddings, dtype=np.int32),
+            'embeddings': np.vstack(self.embeddings) if dim != 0 else np.empty((0, 0), dtype=np.float16)
+        }
+
+        # The ledger is written to a temporary directory first, so a ledger is never read half written
+        ledger_path = join(ledger_dir, get_ledger_name(source_id))
+        tmp_path = f'{ledger_path}.tmp'
+        if exists(tmp_path):
+            rmtree(tmp_path)
+        makedirs(tmp_path)
+        for name, column in columns.items():
+            np.save(join(tmp_path, f'{name}.npy'), column)
+        with open(join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(dict(meta or {}, source=source, source_id=source_id, dim=dim, created=time()), f)
+        if exists(ledger_path):
+            rmtree(ledger_path)
+        rename(tmp_path, ledger_path)
+        return ledger_path
+
+
+def load_ledger(ledger_path):
+    """
+    A function which opens the saved ledger, the columns are memory-mapped
+    :param ledger_path: str, path of the ledger
+    :return: dict {column name: numpy.ndarray} and dict of the metadata (source, source_id, title, dim, ...)
+    """
+    columns = {name: np.load(join(ledger_path, f'{name}.npy'), mmap_mode='r') for name in LEDGER_COLUMNS}
+    with open(join(ledger_path, 'meta.json')) as f:
+        meta = json.load(f)
+    return columns, meta
+
+
+def list_ledgers(ledger_dir):
+    """
+    :param ledger_dir: str, the directory of all the ledgers
+    :return: a sorted list of paths of the saved ledgers
+    """
+    if not exists(ledger_dir):
+        return []
+    return sorted(join(ledger_dir, name) for name in listdir(ledger_dir)
+                  if isdir(join(ledger_dir, name)) and not name.endswith('.tmp'))
+
+
+def match_ledger(columns, matcher, ref_labels):
+    """
+    A function which matches all the embeddings of the ledger with the reference features at once
+    and returns the labels every sampled frame would get during the analysis
+    :param columns: dict {column name: numpy.ndarray} of the ledger (see load_ledger)
+    :param matcher: an object comparing the features with the reference features (see matchers.py)
+    :param ref_labels: a list containing the labels, the index corresponds to the row of the reference features
+    :return: numpy.ndarray of times of the sampled frames and a list of sets of labels, one set for each frame
+    """
+    sampled_times, analysed_times = columns['sampled_times'], columns['analysed_times']
+    face_frames, face_embeddings = columns['face_frames'], columns['face_embeddings']
+
+    # 1) Match every embedding only once, the tracked faces share the embedding
+    embedding_i, label_i = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if len(columns['embeddings']) != 0:
+        embedding_i, label_i, _ = matcher.match(np.asarray(columns['embeddings'], dtype=np.float32))
+    unique_labels, ref_label_codes = np.unique(np.asarray(ref_labels), return_inverse=True)
+    label_i = ref_label_codes[label_i]
+
+    # 2) Join the faces with the matches of their embeddings
+    order = np.argsort(embedding_i, kind='stable')
+    embedding_i, label_i = embedding_i[order], label_i[order]
+    num_matches = np.bincount(embedding_i, minlength=len(columns['embeddings']))
+    match_starts = np.concatenate(([0], np.cumsum(num_matches)[:-1])).astype(np.int64)
+    embedded = face_embeddings >= 0
+    face_frames, face_embeddings = face_frames[embedded], face_embeddings[embedded]
+    face_num_matches = num_matches[face_embeddings] if len(num_matches) != 0 else np.zeros(0, dtype=np.int64)
+    # The index of every match of every face within the sorted matches
+    face_offsets = np.repeat(match_starts[face_embeddings] - np.cumsum(face_num_matches) + face_num_matches,
+                             face_num_matches) + np.arange(face_num_matches.sum())
+    pairs = np.unique(np.repeat(face_frames.astype(np.int64), face_num_matches) * len(unique_labels)
+                      + label_i[face_offsets])
+
+    # 3) The labels of the analysed frames
+    frame_labels = [set() for _ in range(len(analysed_times))]
+    for frame_i, label in zip(pairs // max(len(unique_labels), 1), pairs % max(len(unique_labels), 1)):
+        frame_labels[frame_i].add(unique_labels[label])
+
+    # 4) The skipped frames reuse the labels of the last analysed frame
+    sources = np.searchsorted(analysed_times, sampled_times, side='right') - 1
+    return np.asarray(sampled_times), [set(frame_labels[i]) if i >= 0 else set() for i in sources]
@@ -0,0 +1,244 @@
+import threading
+
+import cv2
+import numpy as np
+from mtcnn import detect_faces
+
+from .facetracker import box_iou
+
+DETECTORS = ('mtcnn', 'yunet')
+
+
+def _empty_detection():
+    """
+    :return: numpy.ndarray of bounding boxes, dimensions: (0, 5) and numpy.ndarray of landmarks, dimensions: (0, 10)
+    """
+    return np.empty((0, 5), dtype=np.float32), np.empty((0, 10), dtype=np.float32)
+
+
+def non_max_suppression(bboxes, iou_threshold=0.5):
+    """
+    A function which removes the boxes overlapping a box with a higher score
+    :param bboxes: numpy.ndarray, dimensions: (num_faces, 5) - x1, y1, x2, y2, score
+    :param iou_threshold: float, the boxes overlapping more than this value are removed
+    :return: numpy.ndarray of indices of the kept boxes in the order of decreasing score
+    """
+    order = np.argsort(-bboxes[:, 4])
+    ious = box_iou(bboxes[order], bboxes[order])
+    kept = []
+    for i in range(len(order)):
+        if all(ious[i, j] <= iou_threshold for j in kept):
+            kept.append(i)
+    return order[kept]
+
+
+class MTCNNBackend:
+    """
+    Face detection with MTCNN (mtcnn-pytorch)
+    """
+
+    def detect(self, frames, min_face_size=20.0):
+        """
+        A function which detects faces in multiple frames
+        :param frames: a list of numpy.ndarray RGB images, dimensions: (height, weight, 3)
+        :param min_face_size: float, the minimal size of the detected faces in pixels
+        :return: a list of pairs (numpy.ndarray of bounding boxes, dimensions: (num_faces, 5) - x1, y1, x2, y2, score,
+                 numpy.ndarray of landmarks, dimensions: (num_faces, 10) - x coordinates followed by y coordinates),
+                 one pair for each frame
+        """
+        detections = []
+        for frame in frames:
+            try:
+                bboxes, landmarks = detect_faces(frame, min_face_size=min_face_size)
+            except ValueError:
+                # MTCNN fails to stack the candidate boxes when none of the scales of the pyramid proposes any
+                bboxes, landmarks = [], []
+            if len(bboxes) == 0:
+                detections.append(_empty_detection())
+            else:
+                detections.append((np.array(bboxes, dtype=np.float32), np.array(landmarks, dtype=np.float32)))
+        return detections
+
+
+class YuNetBackend:
+    """
+    Face detection with YuNet, a lightweight CNN detector run by OpenCV DNN (requires opencv-python >= 4.5.4)
+    from the local ONNX model file (face_detection_yunet_2023mar.onnx from the OpenCV model zoo).
+    The OpenCV detector keeps the input size and isn't thread-safe, so each thread gets its own instance.
+    """
+
+    def __init__(self, model_path, score_threshold=0.8, nms_threshold=0.3, top_k=5000):
+        """
+        :param model_path: str, path to the ONNX model
+        :param score_threshold: float, the minimal confidence of the detected face
+        :param nms_threshold: float, the boxes overlapping more than this value are suppressed
+        :param top_k: int, the maximum number of candidates kept before the non-maximum suppression
+        """
+        if not hasattr(cv2, 'FaceDetectorYN'):
+            raise ImportError(f'YuNet detector requires opencv-python >= 4.5.4, found {cv2.__version__}')
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+        self.nms_threshold = nms_threshold
+        self.top_k = top_k
+        self._local = threading.local()
+        # The detector of the creating thread is created right away, so a missing model fails early
+        self._get_detector((320, 320))
+
+    def _get_detector(self, input_size):
+        """
+        :param input_size: a pair of ints (width, height) of the frames
+        :return: cv2.FaceDetectorYN of the current thread set to the input size
+        """
+        if getattr(self._local, 'detector', None) is None:
+            self._local.detector = cv2.FaceDetectorYN.create(self.model_path, '', input_size, self.score_threshold,
+                                                             self.nms_threshold, self.top_k)
+            self._local.input_size = input_size
+        elif input_size != self._local.input_size:
+            # The input size is set only when it changes, the frames of one video share it
+            self._local.detector.setInputSize(input_size)
+            self._local.input_size = input_size
+        return self._local.detector
+
+    def detect(self, frames, min_face_size=20.0):
+        """
+        A function which detects faces in multiple frames
+        :param frames: a list of numpy.ndarray RGB images, dimensions: (height, weight, 3)
+        :param min_face_size: float, the minimal size of the detected faces in pixels
+        :return: a list of pairs (numpy.ndarray of bounding boxes, dimensions: (num_faces, 5) - x1, y1, x2, y2, score,
+                 numpy.ndarray of landmarks, dimensions: (num_faces, 10) - x coordinates followed by y coordinates),
+                 one pair for each frame
+        """
+        detections = []
+        for frame in frames:
+            detector = self._get_detector((frame.shape[1], frame.shape[0]))
+            # YuNet expects BGR images
+            _, faces = detector.detect(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+            if faces is None:
+                detections.append(_empty_detection())
+                continue
+
+            # Each row: x, y, width, height, 5 (x, y) landmarks (eyes, nose tip, mouth corners), score
+            faces = faces[np.minimum(faces[:, 2], faces[:, 3]) >= min_face_size]
+            bboxes = np.empty((len(faces), 5), dtype=np.float32)
+            bboxes[:, :2] = faces[:, :2]
+            bboxes[:, 2:4] = faces[:, :2] + faces[:, 2:4]
+            bboxes[:, 4] = faces[:, 14]
+            landmarks = np.hstack((faces[:, 4:14:2], faces[:, 5:14:2])).astype(np.float32)
+            detections.append((bboxes, landmarks))
+        return detections
+
+
+class FaceDetector:
+    """
+    A class which detects faces on a downscaled copy of the frame, optionally limited to regions of interest.
+    The bounding boxes and landmarks are mapped back to the full resolution, so the faces are frontalized
+    from the original frame. The regions of all the frames are passed to the backend at once.
+    """
+
+    def __init__(self, scale=1.0, min_face_size=20.0, rois=None, backend=None):
+        """
+        :param scale: float, the frame (or the region of interest) is resized by this factor before the detection
+        :param min_face_size: float, the minimal size of the detected faces in the full resolution pixels,
+               the faces smaller than 12 / scale pixels can't be detected on the downscaled copy
+        :param rois: a list of regions of interest (x1, y1, x2, y2) relative to the frame size (in the range <0, 1>),
+               the whole frame is searched if not set
+        :param backend: an object detecting the faces in a list of frames (MTCNNBackend or YuNetBackend),
+               MTCNNBackend is used if not set
+        """
+        self.scale = scale
+        self.min_face_size = min_face_size
+        self.rois = rois
+        self.backend = backend if backend is not None else MTCNNBackend()
+
+    def _get_rois(self, img):
+        """
+        :param img: numpy.ndarray, dimensions: (height, weight, 3)
+        :return: a list of regions of interest (x1, y1, x2, y2) in pixels
+        """
+        height, width = img.shape[:2]
+        if self.rois is None:
+            return [(0, 0, width, height)]
+        return [(int(x1 * width), int(y1 * height), int(np.ceil(x2 * width)), int(np.ceil(y2 * height)))
+                for x1, y1, x2, y2 in self.rois]
+
+    def _downscale(self, img):
+        """
+        :param img: numpy.ndarray, the region of interest, dimensions: (height, weight, 3)
+        :return: numpy.ndarray, the region resized by the scale
+        """
+        if self.scale == 1.0:
+            return img
+        size = (max(int(round(img.shape[1] * self.scale)), 1), max(int(round(img.shape[0] * self.scale)), 1))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    def detect_batch(self, imgs):
+        """
+        A function which detects faces in multiple images
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :return: a list of pairs (numpy.ndarray of bounding boxes, dimensions: (num_faces, 5) - x1, y1, x2, y2, score,
+                 numpy.ndarray of landmarks, dimensions: (num_faces, 10) - x coordinates followed by y coordinates),
+                 one pair for each image
+        """
+        # 1) Cut out and downscale the regions of interest of all the images
+        regions, offsets = [], []
+        for img in imgs:
+            img_offsets = []
+            for x1, y1, x2, y2 in self._get_rois(img):
+                regions.append(self._downscale(img[y1:y2, x1:x2]))
+                img_offsets.append((x1, y1))
+            offsets.append(img_offsets)
+
+        # 2) Detect the faces in all the regions at once
+        region_detections = iter(self.backend.detect(regions, max(self.min_face_size * self.scale, 12.0)))
+
+        # 3) Map the detections back to the full resolution of the image
+        detections = []
+        for img_offsets in offsets:
+            all_bboxes, all_landmarks = [], []
+            for x1, y1 in img_offsets:
+                bboxes, landmarks = next(region_detections)
+                bboxes, landmarks = bboxes.copy(), landmarks.copy()
+                bboxes[:, :4] /= self.scale
+                landmarks /= self.scale
+                bboxes[:, [0, 2]] += x1
+                bboxes[:, [1, 3]] += y1
+                landmarks[:, :5] += x1
+                landmarks[:, 5:] += y1
+                all_bboxes.append(bboxes)
+                all_landmarks.append(landmarks)
+
+            bboxes, landmarks = np.vstack(all_bboxes), np.vstack(all_landmarks)
+            if len(all_bboxes) > 1 and len(bboxes) > 1:
+                # The face within the overlap of the regions of interest is detected more than once
+                kept = non_max_suppression(bboxes)
+                bboxes, landmarks = bboxes[kept], landmarks[kept]
+            detections.append((bboxes, landmarks))
+        return detections
+
+    def detect(self, img):
+        """
+        A function which detects faces in the image
+        :param img: numpy.ndarray, dimensions: (height, weight, 3)
+        :return: numpy.ndarray of bounding boxes, dimensions: (num_faces, 5) - x1, y1, x2, y2, score
+                 and numpy.ndarray of landmarks, dimensions: (num_faces, 10) - x coordinates followed by y coordinates
+        """
+        return self.detect_batch([img])[0]
+
+
+def get_face_detector(kind, scale=1.0, min_face_size=20.0, rois=None, model_path=None):
+    """
+    A function which returns the face detector with the backend of the given kind
+    :param kind: str, one of DETECTORS
+    :param scale: float, the frame is resized by this factor before the detection
+    :param min_face_size: float, the minimal size of the detected faces in the full resolution pixels
+    :param rois: a list of regions of interest (x1, y1, x2, y2) relative to the frame size
+    :param model_path: str, path to the model file of the backend (YuNet)
+    :return: FaceDetector
+    """
+    if kind == 'mtcnn':
+        backend = MTCNNBackend()
+    elif kind == 'yunet':
+        backend = YuNetBackend(model_path)
+    else:
+        raise ValueError(f'Unknown detector {kind}, expected one of {DETECTORS}')
+    return FaceDetector(scale, min_face_size, rois, backend)
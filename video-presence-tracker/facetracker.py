@@ -0,0 +1,200 @@
+import cv2
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    A function which computes the intersection over union of every pair of boxes
+    :param boxes_a: numpy.ndarray, dimensions: (n, 4+) - x1, y1, x2, y2, ...
+    :param boxes_b: numpy.ndarray, dimensions: (m, 4+) - x1, y1, x2, y2, ...
+    :return: numpy.ndarray, dimensions: (n, m)
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32)[:, :4]
+    boxes_b = np.asarray(boxes_b, dtype=np.float32)[:, :4]
+    top_left = np.maximum(boxes_a[:, np.newaxis, :2], boxes_b[np.newaxis, :, :2])
+    bottom_right = np.minimum(boxes_a[:, np.newaxis, 2:], boxes_b[np.newaxis, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, np.newaxis] + area_b[np.newaxis, :] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+
+class _Track:
+    """
+    A face followed across the sampled frames along with its cached identity
+    """
+
+    def __init__(self, box):
+        self.box = box
+        # The box and the time of the last embedding, labels are None until the face is embedded
+        self.anchor_box = box
+        self.identity_t = None
+        self.labels = None
+        self.missed = 0
+        # Whether the embedding was requested and the result is not known yet
+        self.pending = False
+        # Index of the last embedding within the EmbeddingLedger, -1 if it is not recorded
+        self.embedding_i = -1
+        # The downscaled face in the current frame and at the time of the last embedding
+        self.appearance = None
+        self.anchor_appearance = None
+
+
+class FaceTracker:
+    """
+    A class which associates the detected faces across the sampled frames by the overlap of their bounding boxes
+    and caches the identity of each track. The face is embedded only when the track is new, when it moved
+    too far from the position where it was last embedded, when it looks different than at that time
+    (e.g. a cut to another person in the same framing) or when its identity is older than the refresh interval.
+    """
+
+    def __init__(self, classifier_wrapper, iou_threshold=0.3, drift_iou=0.5, refresh_interval=10.0, max_missed=1,
+                 ledger=None, appearance_threshold=0.1, appearance_size=16):
+        """
+        :param classifier_wrapper: ClassifierWrapper used for the detection and embedding
+        :param iou_threshold: float, a minimal IoU of the detection and the track to be associated
+        :param drift_iou: float, the face is embedded again when the IoU of its box
+               and the box at the time of the last embedding drops below this value
+        :param refresh_interval: float, the maximum age of the cached identity in seconds
+        :param max_missed: int, a number of consecutive sampled frames the track survives without a detection
+        :param ledger: EmbeddingLedger, the embeddings and the faces of the analysed frames are recorded in it,
+               the faces which weren't embedded refer to the last embedding of their track
+        :param appearance_threshold: float, the face is embedded again when the mean absolute difference
+               of the intensities (in the range <0, 1>) of its downscaled grayscale copy and the copy
+               at the time of the last embedding reaches this value
+        :param appearance_size: int, the faces are downscaled to appearance_size x appearance_size pixels
+               before the comparison
+        """
+        self.classifier_wrapper = classifier_wrapper
+        self.iou_threshold = iou_threshold
+        self.drift_iou = drift_iou
+        self.refresh_interval = refresh_interval
+        self.max_missed = max_missed
+        self.ledger = ledger
+        self.appearance_threshold = appearance_threshold
+        self.appearance_size = appearance_size
+        self.tracks = []
+        # Statistics - number of detected faces and number of faces which were embedded
+        self.num_detections = 0
+        self.num_embeddings = 0
+
+    def _associate(self, bboxes):
+        """
+        A function which greedily associates the detections with the tracks in the order of decreasing IoU
+        :param bboxes: numpy.ndarray, dimensions: (num_faces, 5)
+        :return: a list of tracks, one for each detection
+        """
+        det_tracks, matched = [None] * len(bboxes), set()
+        if len(bboxes) != 0 and len(self.tracks) != 0:
+            ious = box_iou(bboxes, np.array([track.box for track in self.tracks]))
+            for det_i, track_i in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                if ious[det_i, track_i] < self.iou_threshold:
+                    break
+                if det_tracks[det_i] is None and track_i not in matched:
+                    det_tracks[det_i] = self.tracks[track_i]
+                    matched.add(track_i)
+
+        # Age the unmatched tracks and drop the ones which were missing for too long
+        for track_i, track in enumerate(self.tracks):
+            track.missed = 0 if track_i in matched else track.missed + 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        # Start new tracks for the unmatched detections
+        for det_i, box in enumerate(bboxes):
+            box = np.asarray(box[:4], dtype=np.float32)
+            if det_tracks[det_i] is None:
+                det_tracks[det_i] = _Track(box)
+                self.tracks.append(det_tracks[det_i])
+            det_tracks[det_i].box = box
+        return det_tracks
+
+    def _get_appearance(self, img, box):
+        """
+        :param img: numpy.ndarray, dimensions: (height, weight, 3)
+        :param box: numpy.ndarray, the bounding box of the face - x1, y1, x2, y2
+        :return: numpy.ndarray, the downscaled grayscale face with intensities in the range <0, 1>
+                 or None if the box is outside of the image
+        """
+        height, width = img.shape[:2]
+        x1, y1 = max(int(box[0]), 0), max(int(box[1]), 0)
+        x2, y2 = min(int(np.ceil(box[2])), width), min(int(np.ceil(box[3])), height)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        face = img[y1:y2, x1:x2]
+        if face.ndim == 3:
+            face = cv2.cvtColor(face, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(face, (self.appearance_size, self.appearance_size), interpolation=cv2.INTER_AREA)
+        return small.astype(np.float32) / 255
+
+    def _needs_embedding(self, track, t):
+        """
+        :param track: _Track
+        :param t: float, time of the frame
+        :return: bool, whether the face has to be embedded
+        """
+        if track.pending:
+            return False
+        if track.labels is None:
+            return True
+        if t - track.identity_t >= self.refresh_interval:
+            return True
+        if track.appearance is not None and track.anchor_appearance is not None and \
+                float(np.mean(np.abs(track.appearance - track.anchor_appearance))) >= self.appearance_threshold:
+            return True
+        return box_iou(track.box[np.newaxis], track.anchor_box[np.newaxis])[0, 0] < self.drift_iou
+
+    def get_labels_batch(self, imgs, times):
+        """
+        A function which returns labels for multiple consecutive sampled frames,
+        the faces which have to be embedded are fed to the model as one batch.
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :param times: a list of times of the frames
+        :return: a list of sets of labels, one set for each image
+        """
+        frame_tracks, frame_bboxes = [], []
+        embed_imgs, embed_landmarks, embed_tracks = [], [], []
+        detections = self.classifier_wrapper.detect_batch(imgs)
+        for img, t, (bboxes, landmarks) in zip(imgs, times, detections):
+            # 1) Associate the detected faces with the tracks
+            tracks = self._associate(bboxes)
+            frame_tracks.append(tracks)
+            frame_bboxes.append(bboxes)
+            self.num_detections += len(tracks)
+
+            # 2) Collect the faces whose identity is unknown or outdated
+            for track in tracks:
+                track.appearance = self._get_appearance(img, track.box)
+            to_embed = [i for i, track in enumerate(tracks) if self._needs_embedding(track, t)]
+            if len(to_embed) != 0:
+                embed_imgs.append(img)
+                embed_landmarks.append(np.asarray(landmarks)[to_embed])
+                for i in to_embed:
+                    track = tracks[i]
+                    track.pending, track.identity_t, track.anchor_box = True, t, track.box
+                    track.anchor_appearance = track.appearance
+                    embed_tracks.append(track)
+
+        # 3) Embed all the collected faces in a single forward pass and cache their identities
+        if len(embed_tracks) != 0:
+            self.num_embeddings += len(embed_tracks)
+            try:
+                features = self.classifier_wrapper.get_features_for_landmarks(embed_imgs, embed_landmarks)
+                face_scores = self.classifier_wrapper.match_features(features)
+                embedding_indices = self.ledger.add_embeddings(features) if self.ledger is not None \
+                    else [-1] * len(embed_tracks)
+            except Exception as err:
+                print(f'\033[93mException: {err} --> skipping the batch classification\033[0m')
+                face_scores, embedding_indices = [None for _ in embed_tracks], [-1] * len(embed_tracks)
+            for track, scores, embedding_i in zip(embed_tracks, face_scores, embedding_indices):
+                # The identity of the failed embedding stays unknown, so the face is embedded again next time
+                track.labels, track.pending = set(scores) if scores is not None else None, False
+                track.embedding_i = embedding_i
+
+        # 4) Record the faces, the frames of the batch get the latest identities of the tracks
+        if self.ledger is not None:
+            for t, tracks, bboxes in zip(times, frame_tracks, frame_bboxes):
+                self.ledger.add_frame(t, bboxes, [track.embedding_i for track in tracks])
+
+        # 5) The labels of the frame are the identities of the present tracks
+        return [set().union(*[track.labels or set() for track in tracks]) for tracks in frame_tracks]
@@ -0,0 +1,239 @@
+import re
+import subprocess
+from bisect import bisect_left, bisect_right
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from imageio_ffmpeg import get_ffmpeg_exe
+
+# Encoders used for re-encoding the boundary GOPs, the re-encoded parts have to use the same codec as the source
+ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+    'mpeg4': 'mpeg4',
+    'vp9': 'libvpx-vp9',
+}
+
+# Shift of the seek position which makes sure ffmpeg doesn't jump to the previous keyframe due to rounding
+_SEEK_EPS = 0.001
+# The time of the frame in the output of the showinfo filter
+_PTS_TIME = re.compile(r'pts_time:\s*(-?\d+(?:\.\d+)?)')
+
+
+def _run(cmd):
+    """
+    A function which runs the command and returns its standard output
+    :param cmd: a list of command arguments
+    :return: str, the standard output
+    """
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return result.stdout.decode()
+
+
+def _get_stream_info(video_path):
+    """
+    A function which returns the description of the streams ffmpeg prints when it opens the video
+    (only the header of the video is read)
+    :param video_path: str, a path of the video
+    :return: str, the description of the streams
+    """
+    # ffmpeg fails without an output file, the description of the input is printed anyway
+    result = subprocess.run([get_ffmpeg_exe(), '-hide_banner', '-i', video_path], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    return result.stderr.decode(errors='replace')
+
+
+def get_keyframe_times(video_path, t_start=0.0, t_end=None):
+    """
+    A function which returns the times of the keyframes of the first video stream from the last keyframe
+    before t_start to the first keyframe after t_end, only the keyframes within this window are decoded
+    :param video_path: str, a path (or URL) of the video
+    :param t_start: float, the beginning of the window
+    :param t_end: float, the end of the window (None means the end of the video)
+    :return: a sorted list of floats
+    """
+    # Without the accurate seek, the keyframe before t_start is kept and its time is relative to t_start
+    cmd = [get_ffmpeg_exe(), '-hide_banner', '-nostats', '-noaccurate_seek', '-skip_frame', 'nokey']
+    if t_start > 0:
+        cmd += ['-ss', f'{t_start:.6f}']
+    cmd += ['-i', video_path, '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-']
+
+    times, output, finished = [], [], False
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        for line in process.stderr:
+            line = line.decode(errors='replace')
+            match = _PTS_TIME.search(line)
+            if match is None:
+                output.append(line)
+                continue
+            times.append(max(t_start, 0) + float(match.group(1)))
+            if t_end is not None and times[-1] >= t_end:
+                # The rest of the video is not needed
+                finished = True
+                break
+    finally:
+        if finished:
+            process.kill()
+        process.stderr.close()
+        process.wait()
+    if not finished and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=''.join(output[-20:]))
+    return sorted(times)
+
+
+def get_video_codec(video_path):
+    """
+    :param video_path: str, a path of the video
+    :return: str, name of the codec of the first video stream
+    """
+    match = re.search(r'Stream #\d+:\d+.*?: Video: (\w+)', _get_stream_info(video_path))
+    if match is None:
+        raise IOError(f'There is no video stream in {video_path}')
+    return match.group(1)
+
+
+def get_duration(video_path):
+    """
+    :param video_path: str, a path of the video
+    :return: float, duration of the video in seconds
+    """
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', _get_stream_info(video_path))
+    if match is None:
+        raise IOError(f'The duration of {video_path} is not known')
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def widen_to_keyframes(keyframe_times, t_start, t_end=None):
+    """
+    A function which widens the interval so that it starts and ends on a keyframe
+    :param keyframe_times: a sorted list of keyframe times
+    :param t_start: float, the beginning of the interval
+    :param t_end: float, the end of the interval (None means the end of the video)
+    :return: a pair of floats, t_end is None if there is no keyframe after the end of the interval
+    """
+    start_i = bisect_right(keyframe_times, t_start) - 1
+    k_start = keyframe_times[start_i] if start_i >= 0 else 0.0
+    k_end = None
+    if t_end is not None:
+        end_i = bisect_left(keyframe_times, t_end)
+        if end_i < len(keyframe_times):
+            k_end = keyframe_times[end_i]
+    return k_start, k_end
+
+
+def _cut(source_path, output_path, t_start, t_end, codec_args, extra_args=()):
+    """
+    A function which cuts out the interval of the source video
+    :param source_path: str, a path of the source video
+    :param output_path: str, a path of the output file
+    :param t_start: float, the beginning of the interval
+    :param t_end: float or None, the end of the interval
+    :param codec_args: a list of ffmpeg arguments defining the codecs
+    :param extra_args: a list of additional output arguments
+    :return: None
+    """
+    cmd = [get_ffmpeg_exe(), '-y', '-v', 'error', '-ss', f'{t_start:.6f}', '-i', source_path]
+    if t_end is not None:
+        cmd += ['-t', f'{t_end - t_start:.6f}']
+    cmd += list(codec_args) + list(extra_args) + ['-avoid_negative_ts', 'make_zero', output_path]
+    _run(cmd)
+
+
+def cut_stream_copy(source_path, output_path, t_start, t_end=None, keyframe_times=None):
+    """
+    A function which cuts out the interval widened to the nearest keyframes without re-encoding
+    :param source_path: str, a path of the source video
+    :param output_path: str, a path of the output file
+    :param t_start: float, the beginning of the interval
+    :param t_end: float, the end of the interval (None means the end of the video)
+    :param keyframe_times: a sorted list of keyframe times, only the keyframes around the interval are found if not set
+    :return: a pair of floats - the actual beginning and end of the cut (end is None for the end of the video)
+    """
+    if keyframe_times is None:
+        keyframe_times = get_keyframe_times(source_path, t_start, t_end)
+    k_start, k_end = widen_to_keyframes(keyframe_times, t_start, t_end)
+    _cut(source_path, output_path, k_start + _SEEK_EPS, k_end, ['-map', '0', '-c', 'copy'])
+    return k_start, k_end
+
+
+def cut_frame_exact(source_path, output_path, t_start, t_end=None, keyframe_times=None):
+    """
+    A function which cuts out exactly the interval. Only the partial GOPs at the boundaries
+    are re-encoded, the GOPs in between are stream copied and the audio is stream copied as a whole.
+    If the codec of the source can't be re-encoded, the interval is widened to the keyframes instead.
+    :param source_path: str, a path of the source video
+    :param output_path: str, a path of the output file
+    :param t_start: float, the beginning of the interval
+    :param t_end: float, the end of the interval (None means the end of the video)
+    :param keyframe_times: a sorted list of keyframe times, only the keyframes around the interval are found if not set
+    :return: None
+    """
+    if keyframe_times is None:
+        keyframe_times = get_keyframe_times(source_path, t_start, t_end)
+    encoder = ENCODERS.get(get_video_codec(source_path))
+    if encoder is None:
+        cut_stream_copy(source_path, output_path, t_start, t_end, keyframe_times)
+        return
+    if t_end is None:
+        t_end = get_duration(source_path)
+
+    # 1) The first keyframe within the interval and the last keyframe before its end
+    first_i, last_i = bisect_left(keyframe_times, t_start), bisect_right(keyframe_times, t_end) - 1
+    parts = []
+    if first_i > last_i or keyframe_times[first_i] >= keyframe_times[last_i]:
+        # There isn't any whole GOP within the interval --> re-encode everything
+        parts.append((t_start, t_end, False))
+    else:
+        k_first, k_last = keyframe_times[first_i], keyframe_times[last_i]
+        if k_first > t_start:
+            parts.append((t_start, k_first, False))
+        parts.append((k_first, k_last, True))
+        if t_end > k_last:
+            parts.append((k_last, t_end, False))
+
+    with TemporaryDirectory() as tmp_dir:
+        # 2) Cut the video parts into MPEG-TS files, which can be concatenated without re-encoding
+        list_path = join(tmp_dir, 'parts.txt')
+        with open(list_path, 'w') as f:
+            for i, (p_start, p_end, copy) in enumerate(parts):
+                part_path = join(tmp_dir, f'part{i}.ts')
+                if copy:
+                    _cut(source_path, part_path, p_start + _SEEK_EPS, p_end, ['-an', '-c:v', 'copy'])
+                else:
+                    _cut(source_path, part_path, p_start, p_end, ['-an', '-c:v', encoder])
+                f.write(f"file '{part_path}'\n")
+
+        # 3) Concatenate the video parts and add the stream copied audio
+        video_path = join(tmp_dir, 'video.ts')
+        _run([get_ffmpeg_exe(), '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+              '-c', 'copy', video_path])
+        _run([get_ffmpeg_exe(), '-y', '-v', 'error', '-i', video_path, '-ss', f'{t_start:.6f}',
+              '-t', f'{t_end - t_start:.6f}', '-i', source_path, '-map', '0:v:0', '-map', '1:a?',
+              '-c', 'copy', '-shortest', output_path])
+
+
+def split_stream_copy(source_path, output_pattern, split_times):
+    """
+    A function which splits the video into segments without re-encoding,
+    every segment starts at the first keyframe after the split time
+    :param source_path: str, a path of the source video
+    :param output_pattern: str, a path of the output files containing %d which is replaced by the segment index
+    :param split_times: a list of floats, the times at which the video is split
+    :return: None
+    """
+    _run([get_ffmpeg_exe(), '-y', '-v', 'error', '-i', source_path, '-map', '0', '-c', 'copy', '-f', 'segment',
+          '-segment_times', ','.join(f'{t:.6f}' for t in split_times), '-reset_timestamps', '1',
+          output_pattern])
+
+
+def concat_stream_copy(segment_paths, output_path):
+    """
+    A function which concatenates MPEG-TS segments into one video without re-encoding
+    :param segment_paths: a list of paths of the consecutive MPEG-TS segments
+    :param output_path: str, a path of the output file
+    :return: None
+    """
+    _run([get_ffmpeg_exe(), '-y', '-v', 'error', '-i', f'concat:{"|".join(segment_paths)}', '-map', '0',
+          '-c', 'copy', output_path])
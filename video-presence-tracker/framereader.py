@@ -0,0 +1,149 @@
+import cv2
+
+
+class SamplingReader:
+    """
+    A class which iterates through every nth frame of a video using OpenCV.
+    The frames in between are only grabbed - they are never converted to RGB nor copied,
+    and if the gap between the sampled frames is long enough, they are skipped
+    by seeking (OpenCV seeks to the preceding keyframe and decodes from there).
+    The frames can be limited to a range, the sampled frames are always the same as when reading the whole video.
+    """
+
+    def __init__(self, video_path, nth_frame, seek_gap=250, start_frame=0, end_frame=None):
+        """
+        :param video_path: str, a path (or URL) of the video
+        :param nth_frame: int, every nth frame will be returned
+        :param seek_gap: int, a minimal number of skipped frames for which seeking is used
+               instead of grabbing, None disables seeking
+        :param start_frame: int, index of the first frame of the range
+        :param end_frame: int, index of the frame right after the range, the range ends with the video if not set
+        """
+        self.video_path = video_path
+        self.nth_frame = nth_frame
+        self.seek_gap = seek_gap
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.capture = self._open()
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        if not self.fps > 0:
+            self.capture.release()
+            raise IOError(f'Cannot determine the frame rate of the video {video_path}')
+
+    def _open(self):
+        """
+        :return: cv2.VideoCapture of the video
+        """
+        capture = cv2.VideoCapture(self.video_path)
+        if not capture.isOpened():
+            raise IOError(f'Cannot open the video {self.video_path}')
+        return capture
+
+    def _seek(self, frame_i):
+        """
+        A function which moves the capture right before the frame with the given index
+        :param frame_i: int, index of the frame which will be grabbed next
+        :return: bool, True if the seek was successful
+        """
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_i)
+        return int(self.capture.get(cv2.CAP_PROP_POS_FRAMES)) == frame_i
+
+    def _reopen(self, frame_i):
+        """
+        A function which reopens the video after an unsuccessful seek and decodes it sequentially
+        up to the frame with the given index
+        :param frame_i: int, index of the frame which will be grabbed next
+        :return: bool, False if the video ended before reaching the frame
+        """
+        self.capture.release()
+        self.capture = self._open()
+        for _ in range(frame_i):
+            if not self.capture.grab():
+                return False
+        return True
+
+    def __iter__(self):
+        """
+        :return: the generator returns pairs of time of the frame and the frame in RGB format
+        """
+        try:
+            # Index of the last grabbed frame and of the next frame to return
+            # (the first frame with index nth_frame * k - 1 within the range)
+            frame_i = -1
+            target_i = first_sampled_frame(self.start_frame, self.nth_frame)
+            can_seek = self.seek_gap is not None
+            while self.end_frame is None or target_i < self.end_frame:
+                # 1) Skip the frames by seeking if the gap is long enough
+                if can_seek and target_i - frame_i - 1 >= self.seek_gap:
+                    if self._seek(target_i):
+                        frame_i = target_i - 1
+                    else:
+                        # The stream can't seek --> fall back to the sequential decoding
+                        can_seek = False
+                        if not self._reopen(frame_i + 1):
+                            return
+
+                # 2) Skip the remaining frames without retrieving them
+                while frame_i < target_i:
+                    if not self.capture.grab():
+                        return
+                    frame_i += 1
+
+                # 3) Retrieve and convert only the sampled frame
+                ok, frame = self.capture.retrieve()
+                if not ok:
+                    return
+                yield frame_i / self.fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                target_i += self.nth_frame
+        finally:
+            self.capture.release()
+
+
+def first_sampled_frame(start_frame, nth_frame):
+    """
+    :param start_frame: int, index of the frame
+    :param nth_frame: int, every nth frame is sampled
+    :return: int, index of the first sampled frame (nth_frame * k - 1) which is not before start_frame
+    """
+    return (start_frame + nth_frame) // nth_frame * nth_frame - 1
+
+
+def get_frame_count(video_path):
+    """
+    :param video_path: str, a path of the video
+    :return: int, the number of frames of the video according to its header (can be inaccurate)
+    """
+    capture = cv2.VideoCapture(video_path)
+    try:
+        if not capture.isOpened():
+            raise IOError(f'Cannot open the video {video_path}')
+        return int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        capture.release()
+
+
+def iter_sampled_frames(video_clip, nth_frame):
+    """
+    A generator function which returns every nth frame of the video. The frames are read by
+    SamplingReader and if the video can't be opened by OpenCV, all the frames are decoded by moviepy.
+    :param video_clip: moviepy.editor.VideoFileClip - the video to read
+    :param nth_frame: int, every nth frame will be returned
+    :return: the generator returns pairs of time of the frame and the frame in RGB format
+    """
+    try:
+        reader = SamplingReader(video_clip.filename, nth_frame)
+    except IOError as err:
+        print(f'\033[93mException: {err} --> decoding all the frames\033[0m')
+        reader = None
+
+    if reader is not None:
+        yield from reader
+        return
+
+    n_counter = 1
+    for t, video_frame in video_clip.iter_frames(with_times=True):
+        if n_counter == nth_frame:
+            yield t, video_frame
+            n_counter = 1
+        else:
+            n_counter += 1
@@ -0,0 +1,311 @@
+from collections import deque, namedtuple
+from os import makedirs, remove, replace
+from os.path import exists, join
+from queue import Empty, Queue
+from threading import Event, Thread
+from urllib.parse import urljoin
+
+import cv2
+import requests
+
+# A media segment of the stream downloaded to the local file,
+# t_start is the time of the segment since the start of the ingest in seconds
+Segment = namedtuple('Segment', ['sequence', 't_start', 'duration', 'path'])
+
+
+def _parse_attributes(attributes):
+    """
+    :param attributes: str, an attribute list of a playlist tag, e.g. 'BANDWIDTH=1280000,RESOLUTION=1280x720'
+    :return: dict {attribute name: value}
+    """
+    result = {}
+    for attribute in attributes.split(','):
+        name, _, value = attribute.partition('=')
+        result[name.strip()] = value.strip().strip('"')
+    return result
+
+
+def parse_master_playlist(text, playlist_url):
+    """
+    A function which returns the variant streams of the master playlist
+    :param text: str, content of the playlist
+    :param playlist_url: str, URL of the playlist, the relative URLs are resolved against it
+    :return: a list of (bandwidth, URL of the media playlist) tuples, empty if it is a media playlist
+    """
+    variants, bandwidth = [], None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            bandwidth = int(_parse_attributes(line[len('#EXT-X-STREAM-INF:'):]).get('BANDWIDTH', 0))
+        elif line and not line.startswith('#') and bandwidth is not None:
+            variants.append((bandwidth, urljoin(playlist_url, line)))
+            bandwidth = None
+    return variants
+
+
+def parse_media_playlist(text, playlist_url):
+    """
+    A function which returns the segments of the media playlist
+    :param text: str, content of the playlist
+    :param playlist_url: str, URL of the playlist, the relative URLs are resolved against it
+    :return: a tuple (target duration in seconds, a list of (sequence number, duration, URL) tuples of the segments,
+             bool - whether the playlist is finished)
+    """
+    target_duration, sequence, segments, ended = None, 0, [], False
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif line and not line.startswith('#'):
+            duration = duration if duration is not None else target_duration
+            segments.append((sequence, duration, urljoin(playlist_url, line)))
+            sequence, duration = sequence + 1, None
+    return target_duration, segments, ended
+
+
+class HLSReader:
+    """
+    A class which ingests a live HLS stream. The media playlist is polled in a background thread
+    and every new MPEG-TS segment is downloaded exactly once to the segment directory, so no segment
+    is lost while the analysis is busy. The segments are decoded once, by the analysis, and kept on the disk
+    until they are released - the video clips are written by concatenating them without decoding.
+    The ingest starts live_edge segments before the end of the live playlist (from the beginning
+    of a finished one) and when the analysis falls more than max_latency seconds behind the newest
+    downloaded segment, the sampled frames of the late segments are not analysed (the segments are kept).
+    """
+
+    def __init__(self, playlist_url, segment_dir, live_edge=3, max_latency=None, poll_interval=None, max_retries=5,
+                 session=None):
+        """
+        :param playlist_url: str, URL of the master or the media playlist (.m3u8), the variant with
+               the highest bandwidth is used
+        :param segment_dir: str, the directory the segments are downloaded to
+        :param live_edge: int, the number of the segments of the live playlist which are ingested at the start
+        :param max_latency: float, the segments which end more than this number of seconds before the newest
+               downloaded segment are not analysed, None analyses every segment
+        :param poll_interval: float, the time between the reloads of the playlist in seconds,
+               the target duration of the segments if not set
+        :param max_retries: int, the maximum number of consecutive failed reloads of the playlist
+        :param session: requests.Session used for all the requests, a new one if not set
+        """
+        self.playlist_url = playlist_url
+        self.segment_dir = segment_dir
+        self.live_edge = live_edge
+        self.max_latency = max_latency
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.session = session if session is not None else requests.Session()
+
+        # The downloaded segments waiting for the consumer, the end of the newest of them in seconds
+        self._queue = Queue()
+        self._downloaded_t = 0.0
+        # The segments returned to the consumer and not released yet
+        self._buffer = deque()
+        self._stop_event = Event()
+        self._thread = None
+        self._errors = []
+
+    def _get(self, url):
+        """
+        :param url: str, URL of the resource
+        :return: requests.Response
+        """
+        response = self.session.get(url, timeout=30)
+        response.raise_for_status()
+        return response
+
+    def _get_media_playlist_url(self):
+        """
+        :return: str, URL of the media playlist of the variant with the highest bandwidth
+        """
+        variants = parse_master_playlist(self._get(self.playlist_url).text, self.playlist_url)
+        if len(variants) == 0:
+            return self.playlist_url
+        return max(variants)[1]
+
+    def _download(self, sequence, url):
+        """
+        A function which downloads the segment under a temporary name, so an interrupted download is never used
+        :param sequence: int, the sequence number of the segment
+        :param url: str, URL of the segment
+        :return: str, path of the downloaded segment
+        """
+        segment_path = join(self.segment_dir, f'{sequence}.ts')
+        with open(f'{segment_path}.part', 'wb') as f:
+            f.write(self._get(url).content)
+        replace(f'{segment_path}.part', segment_path)
+        return segment_path
+
+    def _get_poll_interval(self, target_duration):
+        """
+        :param target_duration: float, the target duration of the segments or None if it is not known
+        :return: float, the time until the next reload of the playlist in seconds
+        """
+        if self.poll_interval is not None:
+            return self.poll_interval
+        return target_duration if target_duration is not None else 1.0
+
+    def _run(self):
+        """
+        The download loop of the background thread
+        """
+        try:
+            if not exists(self.segment_dir):
+                makedirs(self.segment_dir)
+            media_playlist_url = self._get_media_playlist_url()
+
+            next_sequence, t, num_failures = None, 0.0, 0
+            while not self._stop_event.is_set():
+                # 1) Reload the playlist, the transient failures are retried
+                try:
+                    target_duration, segments, ended = parse_media_playlist(self._get(media_playlist_url).text,
+                                                                            media_playlist_url)
+                    num_failures = 0
+                except (requests.RequestException, ValueError) as err:
+                    num_failures += 1
+                    if num_failures > self.max_retries:
+                        raise
+                    print(f'\033[93mException: {err} --> reloading the playlist again\033[0m')
+                    self._stop_event.wait(self._get_poll_interval(None))
+                    continue
+
+                # 2) Start at the live edge, or at the beginning of the finished stream
+                if next_sequence is None and len(segments) != 0:
+                    next_sequence = segments[0][0] if ended else segments[max(len(segments) - self.live_edge, 0)][0]
+                elif len(segments) != 0 and segments[0][0] > next_sequence:
+                    print(f'\033[93mException: segments {next_sequence}-{segments[0][0] - 1} left the playlist '
+                          f'before they were downloaded --> skipping them\033[0m')
+
+                # 3) Download every new segment exactly once
+                for sequence, duration, url in segments:
+                    if sequence < next_sequence or self._stop_event.is_set():
+                        continue
+                    try:
+                        self._queue.put(Segment(sequence, t, duration, self._download(sequence, url)))
+                    except requests.RequestException as err:
+                        print(f'\033[93mException: {err} --> skipping the segment {sequence}\033[0m')
+                    # The time keeps running over the failed segments, so the clips stay aligned with the stream
+                    t += duration
+                    self._downloaded_t = t
+                    next_sequence = sequence + 1
+
+                if ended:
+                    return
+                # 4) Wait for the next segment
+                self._stop_event.wait(self._get_poll_interval(target_duration))
+        except Exception as err:
+            self._errors.append(err)
+        finally:
+            self._queue.put(None)
+
+    def start(self):
+        """
+        A function which starts downloading the segments in the background thread
+        :return: self
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __iter__(self):
+        """
+        :return: the generator returns the downloaded segments (Segment) in the order of the stream
+                 until the stream ends or the reader is stopped, the download is started on the first use
+        """
+        self.start()
+        while not self._stop_event.is_set():
+            try:
+                segment = self._queue.get(timeout=0.5)
+            except Empty:
+                continue
+            if segment is None:
+                break
+            self._buffer.append(segment)
+            yield segment
+        if len(self._errors) != 0:
+            raise IOError(f'Cannot ingest the stream {self.playlist_url}') from self._errors[0]
+
+    def iter_sampled_frames(self, nth_frame):
+        """
+        A generator function which decodes every segment once and returns its sampled frames. The frames
+        are sampled on one grid across the segments (every frame with index nth_frame * k - 1 since the start).
+        :param nth_frame: int, every nth frame will be returned
+        :return: the generator returns pairs (Segment, a list of (t, frame in RGB format) tuples),
+                 the list is empty if the segment was not analysed
+        """
+        frame_i, fps = 0, None
+        for segment in self:
+            # 1) Don't analyse the late segments to catch up with the stream
+            if self.max_latency is not None and self._downloaded_t - segment.t_start - segment.duration \
+                    > self.max_latency:
+                print(f'\033[93mException: the analysis is late --> skipping the segment {segment.sequence}\033[0m')
+                if fps is not None:
+                    frame_i += int(round(segment.duration * fps))
+                yield segment, []
+                continue
+
+            # 2) Decode the segment and convert only the sampled frames
+            capture = cv2.VideoCapture(segment.path)
+            if capture.get(cv2.CAP_PROP_FPS) > 0:
+                fps = capture.get(cv2.CAP_PROP_FPS)
+            elif fps is None:
+                capture.release()
+                raise IOError(f'Cannot determine the frame rate of the segment {segment.path}')
+            frames, segment_frame_i = [], 0
+            try:
+                while capture.grab():
+                    if (frame_i + 1) % nth_frame == 0:
+                        ok, frame = capture.retrieve()
+                        if ok:
+                            frames.append((segment.t_start + segment_frame_i / fps,
+                                           cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+                    frame_i, segment_frame_i = frame_i + 1, segment_frame_i + 1
+            finally:
+                capture.release()
+            yield segment, frames
+
+    def get_segments(self, t_start, t_end=None):
+        """
+        :param t_start: float, the beginning of the interval
+        :param t_end: float, the end of the interval (None means the end of the last returned segment)
+        :return: a list of the buffered segments overlapping the interval
+        """
+        return [segment for segment in self._buffer
+                if segment.t_start + segment.duration > t_start and (t_end is None or segment.t_start <= t_end)]
+
+    def release(self, t):
+        """
+        A function which deletes the buffered segments which end before the given time
+        :param t: float, the time since which the segments are still needed
+        :return: None
+        """
+        while len(self._buffer) != 0 and self._buffer[0].t_start + self._buffer[0].duration <= t:
+            remove(self._buffer.popleft().path)
+
+    def stop(self):
+        """
+        A function which stops the download and deletes the buffered segments
+        :return: None
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.release(float('inf'))
+        # The segments downloaded but never returned
+        while True:
+            try:
+                segment = self._queue.get_nowait()
+            except Empty:
+                break
+            if segment is not None:
+                remove(segment.path)
+        self.session.close()
@@ -0,0 +1,253 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from os import getpid, rename
+from os.path import exists
+from socket import gethostname
+from time import time
+
+from .pickle_utils import load_pickle
+
+JOB_STATES = ('queued', 'processing', 'done', 'failed')
+
+
+def get_owner():
+    """
+    :return: str, the identifier of the current process (the host name and the PID) stored with its claims
+    """
+    return f'{gethostname()}:{getpid()}'
+
+
+class JobStore:
+    """
+    A class which keeps the state of every video (queued, processing, done or failed) in a SQLite database.
+    Every update is a single atomic statement and the database is in the WAL mode, so multiple threads
+    and processes (pollers and workers) can share it. Each thread and each forked process uses its own connection.
+    The claimed video stores its owner and a heartbeat refreshed while it is being processed, only the videos
+    whose heartbeat stopped are returned to the queue.
+    """
+
+    def __init__(self, db_path, timeout=30.0):
+        """
+        :param db_path: str, path to the SQLite database, created if it doesn't exist
+        :param timeout: float, how long to wait for a lock held by another process in seconds
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection().execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                video_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                title TEXT,
+                channel_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL NOT NULL,
+                owner TEXT,
+                heartbeat REAL
+            )''')
+        # The databases created by the older versions don't have the owner and the heartbeat
+        columns = {row[1] for row in self._connection().execute('PRAGMA table_info(jobs)').fetchall()}
+        for column, column_type in (('owner', 'TEXT'), ('heartbeat', 'REAL')):
+            if column not in columns:
+                self._connection().execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+
+    def __getstate__(self):
+        # The connections are not passed to other processes, they open their own
+        return {'db_path': self.db_path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        :return: sqlite3.Connection of the current thread in the autocommit mode
+        """
+        # The connection inherited by a forked worker process must not be used by it
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != getpid():
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, getpid()
+        return connection
+
+    def get_state(self, video_id):
+        """
+        :param video_id: str, ID of the video
+        :return: str, the state of the video (one of JOB_STATES) or None if the video is not known
+        """
+        row = self._connection().execute('SELECT state FROM jobs WHERE video_id = ?', (video_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __contains__(self, video_id):
+        return self.get_state(video_id) is not None
+
+    def enqueue(self, video_id, title=None, channel_id=None):
+        """
+        A function which adds the video to the queue unless it is already known
+        :param video_id: str, ID of the video
+        :param title: str, the title of the video
+        :param channel_id: str, ID of the channel of the video
+        :return: bool, whether the video was added
+        """
+        cursor = self._connection().execute(
+            'INSERT OR IGNORE INTO jobs (video_id, state, title, channel_id, updated) VALUES (?, ?, ?, ?, ?)',
+            (video_id, 'queued', title, channel_id, time()))
+        return cursor.rowcount == 1
+
+    def _transition(self, video_id, from_states, to_state, error=None, attempt=False, owner=None):
+        """
+        A function which atomically changes the state of the video if it is in one of the given states
+        :param video_id: str, ID of the video
+        :param from_states: a tuple of the states the video can be changed from
+        :param to_state: str, the new state
+        :param error: str, the error message stored with the video
+        :param attempt: bool, whether to increase the number of attempts
+        :param owner: str, if set, the state is changed only if the video is claimed by this owner
+        :return: bool, whether the state was changed
+        """
+        placeholders = ', '.join('?' * len(from_states))
+        owner_condition = ' AND owner = ?' if owner is not None else ''
+        cursor = self._connection().execute(
+            f'UPDATE jobs SET state = ?, error = ?, attempts = attempts + ?, updated = ? '
+            f'WHERE video_id = ? AND state IN ({placeholders}){owner_condition}',
+            (to_state, error, int(attempt), time(), video_id) + tuple(from_states)
+            + ((owner,) if owner is not None else ()))
+        return cursor.rowcount == 1
+
+    def claim(self, video_id, owner=None):
+        """
+        A function which marks the queued video as being processed, only one process can claim the video
+        :param video_id: str, ID of the video
+        :param owner: str, the identifier of the claiming process (see get_owner), the current process if not set
+        :return: bool, whether the video was claimed by the caller
+        """
+        now = time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET state = 'processing', error = NULL, attempts = attempts + 1, updated = ?, owner = ?, "
+            "heartbeat = ? WHERE video_id = ? AND state = 'queued'",
+            (now, owner if owner is not None else get_owner(), now, video_id))
+        return cursor.rowcount == 1
+
+    def beat(self, video_id, owner=None):
+        """
+        A function which refreshes the heartbeat of the video being processed by the owner
+        :param video_id: str, ID of the video
+        :param owner: str, the identifier of the process which claimed the video, the current process if not set
+        :return: bool, whether the video is still claimed by the owner
+        """
+        cursor = self._connection().execute(
+            "UPDATE jobs SET heartbeat = ? WHERE video_id = ? AND state = 'processing' AND owner = ?",
+            (time(), video_id, owner if owner is not None else get_owner()))
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def heartbeat(self, video_id, interval, owner=None):
+        """
+        A context manager which refreshes the heartbeat of the claimed video every interval seconds
+        in a background thread while the video is being processed
+        :param video_id: str, ID of the video
+        :param interval: float, the time between the heartbeats in seconds
+        :param owner: str, the identifier of the process which claimed the video, the current process if not set
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.beat(video_id, owner)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, video_id, owner=None):
+        """
+        A function which returns the claimed video back to the queue (e.g. when the processing was interrupted)
+        :param video_id: str, ID of the video
+        :param owner: str, the video is returned only if it is claimed by this owner, the current process if not set
+        :return: bool, whether the video was returned to the queue
+        """
+        return self._transition(video_id, ('processing',), 'queued',
+                                owner=owner if owner is not None else get_owner())
+
+    def release_owned(self, owner=None):
+        """
+        A function which returns all the videos claimed by the owner back to the queue
+        (e.g. when the workers processing them were stopped)
+        :param owner: str, the identifier of the process which claimed the videos, the current process if not set
+        :return: int, the number of returned videos
+        """
+        cursor = self._connection().execute(
+            "UPDATE jobs SET state = 'queued', updated = ? WHERE state = 'processing' AND owner = ?",
+            (time(), owner if owner is not None else get_owner()))
+        return cursor.rowcount
+
+    def mark_done(self, video_id, owner=None):
+        """
+        :param video_id: str, ID of the processed video
+        :param owner: str, if set, the state is changed only if the video is claimed by this owner
+        :return: bool, whether the state was changed
+        """
+        return self._transition(video_id, ('processing',), 'done', owner=owner)
+
+    def mark_failed(self, video_id, error=None, owner=None):
+        """
+        :param video_id: str, ID of the video which couldn't be processed
+        :param error: str, the error message
+        :param owner: str, if set, the state is changed only if the video is claimed by this owner
+        :return: bool, whether the state was changed
+        """
+        states = ('processing',) if owner is not None else ('queued', 'processing')
+        return self._transition(video_id, states, 'failed', error, owner=owner)
+
+    def get_queued(self):
+        """
+        :return: a list of (video_id, title, channel_id) tuples of the queued videos in the order they were queued
+        """
+        return self._connection().execute(
+            "SELECT video_id, title, channel_id FROM jobs WHERE state = 'queued' ORDER BY updated").fetchall()
+
+    def requeue_stale(self, max_age):
+        """
+        A function which returns the videos whose heartbeat is older than max_age seconds back to the queue,
+        they were left in the processing state by a process which crashed (a live owner keeps refreshing it)
+        :param max_age: float, the maximum age of the heartbeat in seconds
+        :return: int, the number of returned videos
+        """
+        cursor = self._connection().execute(
+            "UPDATE jobs SET state = 'queued', updated = ? "
+            "WHERE state = 'processing' AND COALESCE(heartbeat, updated) < ?",
+            (time(), time() - max_age))
+        return cursor.rowcount
+
+    def get_counts(self):
+        """
+        :return: dict {state: the number of videos in the state}
+        """
+        counts = dict(self._connection().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in JOB_STATES}
+
+    def migrate_pickle(self, processed_ids_path):
+        """
+        A function which imports the IDs from the pickle file used by the older versions as processed videos,
+        the pickle file is renamed afterwards so it is imported only once
+        :param processed_ids_path: path to the pickle file, where the processed video ids are stored in a set
+        :return: int, the number of imported IDs
+        """
+        if not exists(processed_ids_path):
+            return 0
+        processed_ids = load_pickle(processed_ids_path)
+        connection = self._connection()
+        connection.execute('BEGIN')
+        connection.executemany('INSERT OR IGNORE INTO jobs (video_id, state, updated) VALUES (?, ?, ?)',
+                               [(video_id, 'done', time()) for video_id in processed_ids])
+        connection.execute('COMMIT')
+        rename(processed_ids_path, f'{processed_ids_path}.migrated')
+        return len(processed_ids)
@@ -0,0 +1,317 @@
+from hashlib import sha1
+from os.path import exists
+
+import numpy as np
+
+from .pickle_utils import load_pickle, save_pickle
+
+MATCHERS = ('exact', 'ivf', 'faiss')
+
+
+def normalize_features(features):
+    """
+    A function which converts the features to the form used for matching - cosine similarity
+    of two normalized features is just their dot product
+    :param features: numpy.ndarray where each row is 1 feature vector
+    :return: C-contiguous numpy.ndarray of L2-normalized float32 rows, the features which already have this form
+             are returned without a copy (e.g. the memory-mapped reference features stay shared)
+    """
+    features = np.asarray(features, dtype=np.float32)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    if features.flags.c_contiguous and np.allclose(norms, 1, rtol=0, atol=1e-5):
+        return features
+    return np.ascontiguousarray(features / np.maximum(norms, np.finfo(np.float32).tiny))
+
+
+def _empty_match():
+    """
+    :return: an empty result of the match() functions
+    """
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+
+def _top_k(face_indices, ref_indices, similarities, top_k):
+    """
+    A function which keeps only top_k most similar matches of each face
+    :param face_indices: numpy.ndarray, indices of the faces
+    :param ref_indices: numpy.ndarray, indices of the matched reference features
+    :param similarities: numpy.ndarray, cosine similarities of the matches
+    :param top_k: int or None, None keeps all the matches
+    :return: the filtered face_indices, ref_indices and similarities
+    """
+    if top_k is None or len(face_indices) == 0:
+        return face_indices, ref_indices, similarities
+    # Sort by face and descending similarity, the rank is the position within the group of the face
+    order = np.lexsort((-similarities, face_indices))
+    face_indices, ref_indices, similarities = face_indices[order], ref_indices[order], similarities[order]
+    group_starts = np.flatnonzero(np.diff(face_indices, prepend=-1))
+    ranks = np.arange(len(face_indices)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(order))))
+    keep = ranks < top_k
+    return face_indices[keep], ref_indices[keep], similarities[keep]
+
+
+def _fingerprint(ref_features):
+    """
+    :param ref_features: numpy.ndarray where each row is 1 feature vector
+    :return: str, a hash identifying the reference features
+    """
+    ref_features = np.ascontiguousarray(ref_features)
+    return sha1(str(ref_features.shape).encode() + ref_features.tobytes()).hexdigest()
+
+
+class BruteForceMatcher:
+    """
+    A class which compares the features with all the reference features
+    by a single multiplication of the normalized feature matrices
+    """
+
+    def __init__(self, ref_features, threshold=0.5, top_k=None):
+        """
+        :param ref_features: numpy.ndarray where each row is 1 feature vector
+        :param threshold: a float representing the maximum cosine distance
+               between reference feature vector and a feature vector
+               belonging to the same class
+        :param top_k: int, a maximum number of matches of one face, None means unlimited
+        """
+        self.ref_features = normalize_features(ref_features)
+        self.threshold = threshold
+        self.top_k = top_k
+
+    def match(self, features):
+        """
+        A function which finds the reference features closer than the threshold
+        :param features: numpy.ndarray where each row is 1 feature vector, dimensions: (num_faces, dim)
+        :return: a triple of numpy.ndarrays - indices of the faces, indices of the matched reference features
+                 and the cosine similarities of the matches
+        """
+        if len(features) == 0:
+            return _empty_match()
+        similarities = normalize_features(features) @ self.ref_features.T
+        face_indices, ref_indices = np.nonzero(similarities > 1 - self.threshold)
+        return _top_k(face_indices, ref_indices, similarities[face_indices, ref_indices], self.top_k)
+
+
+class _ProbedMatcher:
+    """
+    A base class of the approximate matchers which search only nprobe clusters of the reference features.
+    The number of clusters is calibrated so that the matcher finds the required fraction
+    of the matches found by BruteForceMatcher.
+    """
+
+    def __init__(self, ref_features, threshold, nlist):
+        self.fingerprint = _fingerprint(ref_features)
+        self.threshold = threshold
+        self.num_refs = ref_features.shape[0]
+        self.nlist = nlist if nlist is not None else max(1, int(np.sqrt(self.num_refs)))
+        self.nlist = min(self.nlist, self.num_refs)
+        self.nprobe = self.nlist
+        self.recall = 1.0
+        self.top_k = None
+
+    def _sample_queries(self, ref_features, num_queries=500, seed=0):
+        """
+        A function which generates queries similar to real detections - reference features
+        perturbed by noise, so that their cosine distance from the reference is about half of the threshold
+        :param ref_features: numpy.ndarray where each row is 1 feature vector
+        :param num_queries: int, maximum number of queries
+        :param seed: int, seed of the random generator
+        :return: numpy.ndarray of normalized queries
+        """
+        rng = np.random.RandomState(seed)
+        refs = normalize_features(ref_features)
+        refs = refs[rng.choice(len(refs), min(num_queries, len(refs)), replace=False)]
+        sigma = np.sqrt(1 / (1 - self.threshold / 2) ** 2 - 1)
+        noise = rng.randn(*refs.shape).astype(np.float32) * sigma / np.sqrt(refs.shape[1])
+        return normalize_features(refs + noise)
+
+    def calibrate(self, ref_features, recall):
+        """
+        A function which sets the smallest nprobe reaching the required recall
+        :param ref_features: numpy.ndarray where each row is 1 feature vector
+        :param recall: float, the required fraction of the exact matches
+        :return: None
+        """
+        queries = self._sample_queries(ref_features)
+        exact = BruteForceMatcher(ref_features, self.threshold).match(queries)[:2]
+        num_exact = len(exact[0])
+        top_k, self.top_k = self.top_k, None
+        for nprobe in range(1, self.nlist + 1):
+            self.nprobe = nprobe
+            found = set(zip(*self.match(queries)[:2]))
+            num_found = len(found.intersection(zip(*exact)))
+            if num_exact == 0 or num_found / num_exact >= recall:
+                break
+        self.top_k = top_k
+        self.recall = recall
+
+    def is_valid_for(self, ref_features):
+        """
+        :param ref_features: numpy.ndarray where each row is 1 feature vector
+        :return: bool, whether the index was built from the same reference features
+        """
+        return self.fingerprint == _fingerprint(ref_features)
+
+    def save(self, index_path):
+        """
+        A function which saves the index next to the reference features
+        :param index_path: a path of the file
+        :return: None
+        """
+        save_pickle(index_path, self)
+
+
+class IVFMatcher(_ProbedMatcher):
+    """
+    A class implementing an inverted file index in NumPy - the normalized reference features are clustered
+    by spherical k-means and only the features from the clusters closest to the query are compared.
+    """
+
+    def __init__(self, ref_features, threshold=0.5, nlist=None, num_iter=20, seed=0):
+        """
+        :param ref_features: numpy.ndarray where each row is 1 feature vector
+        :param threshold: a float representing the maximum cosine distance
+               between reference feature vector and a feature vector
+               belonging to the same class
+        :param nlist: int, number of clusters, defaults to the square root of the number of reference features
+        :param num_iter: int, number of k-means iterations
+        :param seed: int, seed of the random generator
+        """
+        super(IVFMatcher, self).__init__(ref_features, threshold, nlist)
+        refs = normalize_features(ref_features)
+
+        # 1) Spherical k-means
+        rng = np.random.RandomState(seed)
+        centroids = refs[rng.choice(len(refs), self.nlist, replace=False)]
+        for _ in range(num_iter):
+            assignment = np.argmax(refs @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, refs)
+            empty = np.bincount(assignment, minlength=self.nlist) == 0
+            sums[empty] = refs[rng.choice(len(refs), int(np.sum(empty)))]
+            centroids = normalize_features(sums)
+        assignment = np.argmax(refs @ centroids.T, axis=1)
+
+        # 2) Store the features sorted by clusters, the features of the cluster c
+        # are within list_offsets[c]:list_offsets[c + 1]
+        order = np.argsort(assignment, kind='stable')
+        self.centroids = centroids
+        self.ref_ids = order
+        self.sorted_refs = np.ascontiguousarray(refs[order])
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=self.nlist))))
+
+    def match(self, features):
+        """
+        A function which finds the reference features closer than the threshold
+        :param features: numpy.ndarray where each row is 1 feature vector, dimensions: (num_faces, dim)
+        :return: a triple of numpy.ndarrays - indices of the faces, indices of the matched reference features
+                 and the cosine similarities of the matches
+        """
+        if len(features) == 0:
+            return _empty_match()
+        queries = normalize_features(features)
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :self.nprobe]
+        face_indices, ref_indices, ref_similarities = [], [], []
+        for face_i, (query, face_probes) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([np.arange(self.list_offsets[c], self.list_offsets[c + 1])
+                                         for c in face_probes])
+            similarities = self.sorted_refs[candidates] @ query
+            matched = similarities > 1 - self.threshold
+            face_indices.append(np.full(np.sum(matched), face_i, dtype=np.int64))
+            ref_indices.append(self.ref_ids[candidates[matched]].astype(np.int64))
+            ref_similarities.append(similarities[matched])
+        return _top_k(np.concatenate(face_indices), np.concatenate(ref_indices), np.concatenate(ref_similarities),
+                      self.top_k)
+
+
+class FaissMatcher(_ProbedMatcher):
+    """
+    A class which uses faiss IVF index with inner product of the normalized features.
+    Requires faiss-cpu package.
+    """
+
+    def __init__(self, ref_features, threshold=0.5, nlist=None):
+        """
+        :param ref_features: numpy.ndarray where each row is 1 feature vector
+        :param threshold: a float representing the maximum cosine distance
+               between reference feature vector and a feature vector
+               belonging to the same class
+        :param nlist: int, number of clusters, defaults to the square root of the number of reference features
+        """
+        import faiss
+
+        super(FaissMatcher, self).__init__(ref_features, threshold, nlist)
+        refs = normalize_features(ref_features)
+        quantizer = faiss.IndexFlatIP(refs.shape[1])
+        self.index = faiss.IndexIVFFlat(quantizer, refs.shape[1], self.nlist, faiss.METRIC_INNER_PRODUCT)
+        self.index.train(refs)
+        self.index.add(refs)
+
+    def match(self, features):
+        """
+        A function which finds the reference features closer than the threshold
+        :param features: numpy.ndarray where each row is 1 feature vector, dimensions: (num_faces, dim)
+        :return: a triple of numpy.ndarrays - indices of the faces, indices of the matched reference features
+                 and the cosine similarities of the matches
+        """
+        if len(features) == 0:
+            return _empty_match()
+        self.index.nprobe = self.nprobe
+        lims, similarities, ref_indices = self.index.range_search(normalize_features(features), 1 - self.threshold)
+        face_indices = np.repeat(np.arange(len(lims) - 1), np.diff(lims))
+        return _top_k(face_indices.astype(np.int64), ref_indices.astype(np.int64), similarities, self.top_k)
+
+    def __getstate__(self):
+        import faiss
+
+        state = self.__dict__.copy()
+        state['index'] = faiss.serialize_index(self.index)
+        return state
+
+    def __setstate__(self, state):
+        import faiss
+
+        state['index'] = faiss.deserialize_index(state['index'])
+        self.__dict__.update(state)
+
+
+def get_matcher(kind, ref_features, threshold=0.5, index_path=None, recall=0.95, top_k=None):
+    """
+    A function which returns the matcher of the given kind. The approximate indices are loaded
+    from index_path if they were built from the same reference features, otherwise they are built
+    and saved there.
+    :param kind: str, one of MATCHERS
+    :param ref_features: numpy.ndarray where each row is 1 feature vector
+    :param threshold: a float representing the maximum cosine distance
+           between reference feature vector and a feature vector
+           belonging to the same class
+    :param index_path: a path of the file the index is persisted in
+    :param recall: float, the required fraction of the exact matches found by an approximate matcher
+    :param top_k: int, a maximum number of matches of one face, None means unlimited
+    :return: the matcher
+    """
+    if kind == 'exact':
+        return BruteForceMatcher(ref_features, threshold, top_k)
+    if kind not in MATCHERS:
+        raise ValueError(f'Unknown matcher {kind}, expected one of {MATCHERS}')
+
+    matcher_class = IVFMatcher if kind == 'ivf' else FaissMatcher
+    matcher = None
+    if index_path is not None and exists(index_path):
+        matcher = load_pickle(index_path)
+        if not isinstance(matcher, matcher_class) or not matcher.is_valid_for(ref_features):
+            matcher = None
+
+    if matcher is None:
+        print(f'Building the {kind} index of the reference features.')
+        matcher = matcher_class(ref_features, threshold)
+    elif matcher.threshold == threshold and matcher.recall == recall:
+        matcher.top_k = top_k
+        return matcher
+
+    matcher.threshold = threshold
+    matcher.top_k = top_k
+    matcher.calibrate(ref_features, recall)
+    print(f'The {kind} index searches {matcher.nprobe} of {matcher.nlist} clusters.')
+    if index_path is not None:
+        matcher.save(index_path)
+    return matcher
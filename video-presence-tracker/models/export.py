@@ -0,0 +1,198 @@
+import json
+import zipfile
+from copy import deepcopy
+from os.path import exists, getmtime, getsize
+
+import torch
+import torch.nn as nn
+
+from .resnet import IRBlock, ResNetFace, resnet_face18
+
+# The file stored in the TorchScript archive of the exported model identifying the weights it was exported from
+SOURCE_FILE = 'source.json'
+
+
+def strip_data_parallel(state_dict):
+    """
+    A function which removes the 'module.' prefix added by DataParallel from the keys of the state dict
+    :param state_dict: dict, the state dict
+    :return: dict, the state dict loadable by the bare model
+    """
+    prefix = 'module.'
+    return {(key[len(prefix):] if key.startswith(prefix) else key): value for key, value in state_dict.items()}
+
+
+def _bn_scale_shift(bn):
+    """
+    :param bn: nn.BatchNorm1d or nn.BatchNorm2d in eval mode
+    :return: a pair of tensors (scale, shift) such that bn(x) = scale * x + shift
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale, shift
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    A function which folds the batch normalization following the convolution into the convolution
+    :param conv: nn.Conv2d
+    :param bn: nn.BatchNorm2d
+    :return: nn.Conv2d with bias
+    """
+    scale, shift = _bn_scale_shift(bn)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                      conv.dilation, conv.groups, bias=True)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.data.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+    fused.bias.data.copy_(bias * scale + shift)
+    return fused
+
+
+def fuse_linear_bn(linear, bn):
+    """
+    A function which folds the batch normalization following the linear layer into the linear layer
+    :param linear: nn.Linear
+    :param bn: nn.BatchNorm1d
+    :return: nn.Linear
+    """
+    scale, shift = _bn_scale_shift(bn)
+    fused = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    fused.weight.data.copy_(linear.weight * scale.reshape(-1, 1))
+    fused.bias.data.copy_(linear.bias * scale + shift)
+    return fused
+
+
+def fuse_bn_linear(bn, linear):
+    """
+    A function which folds the 2D batch normalization followed by flattening into the following linear layer
+    :param bn: nn.BatchNorm2d
+    :param linear: nn.Linear whose input is the flattened output of bn
+    :return: nn.Linear
+    """
+    scale, shift = _bn_scale_shift(bn)
+    # Every channel occupies (linear.in_features / num_channels) consecutive inputs of the linear layer
+    spatial = linear.in_features // scale.numel()
+    scale, shift = scale.repeat_interleave(spatial), shift.repeat_interleave(spatial)
+    fused = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    fused.weight.data.copy_(linear.weight * scale.reshape(1, -1))
+    fused.bias.data.copy_(linear.bias + linear.weight @ shift)
+    return fused
+
+
+def fuse_resnet_face(model):
+    """
+    A function which returns a copy of ResNetFace with every foldable batch normalization folded into
+    the neighbouring convolution or linear layer. The bn0 layers of IRBlock stay untouched as they precede
+    a zero-padded convolution - folding them would change the values at the borders.
+    :param model: ResNetFace in eval mode
+    :return: ResNetFace in eval mode
+    """
+    model = deepcopy(model).eval()
+    with torch.no_grad():
+        for block in model.modules():
+            if isinstance(block, IRBlock):
+                block.conv1, block.bn1 = fuse_conv_bn(block.conv1, block.bn1), nn.Identity()
+                block.conv2, block.bn2 = fuse_conv_bn(block.conv2, block.bn2), nn.Identity()
+                if block.downsample is not None:
+                    block.downsample = nn.Sequential(fuse_conv_bn(block.downsample[0], block.downsample[1]))
+
+        if isinstance(model, ResNetFace):
+            model.conv1, model.bn1 = fuse_conv_bn(model.conv1, model.bn1), nn.Identity()
+            model.fc5 = fuse_linear_bn(fuse_bn_linear(model.bn4, model.fc5), model.bn5)
+            model.bn4, model.bn5, model.dropout = nn.Identity(), nn.Identity(), nn.Identity()
+    return model.eval()
+
+
+def load_eager_model(model_weights_path):
+    """
+    A function which loads the weights saved from the DataParallel model into the bare model
+    :param model_weights_path: str, path to the model weights
+    :return: ResNetFace in eval mode on CPU
+    """
+    model = resnet_face18(False)
+    model.load_state_dict(strip_data_parallel(torch.load(model_weights_path, map_location='cpu')))
+    return model.eval()
+
+
+def get_weights_fingerprint(model_weights_path):
+    """
+    :param model_weights_path: str, path to the model weights
+    :return: str, identifies the weights - the size and the modification time of the file
+    """
+    return f'{getsize(model_weights_path)}:{getmtime(model_weights_path)}'
+
+
+def save_exported_model(exported_model, output_path, model_weights_path):
+    """
+    A function which saves the TorchScript model along with the fingerprint of the weights it was exported from
+    :param exported_model: the TorchScript model
+    :param output_path: str, path of the exported model (.pt)
+    :param model_weights_path: str, path to the model weights the model was exported from
+    :return: None
+    """
+    source = json.dumps({'weights': get_weights_fingerprint(model_weights_path)})
+    torch.jit.save(exported_model, output_path, _extra_files={SOURCE_FILE: source})
+
+
+def is_export_current(exported_path, model_weights_path):
+    """
+    A function which checks that the exported model exists and was exported from the current weights
+    (the TorchScript archive is only read as a zip file, the model is not loaded)
+    :param exported_path: str, path of the exported model (.pt)
+    :param model_weights_path: str, path to the model weights
+    :return: bool, whether the exported model can be used instead of the weights
+    """
+    if not exists(exported_path):
+        return False
+    with zipfile.ZipFile(exported_path) as archive:
+        names = [name for name in archive.namelist() if name.endswith(f'/extra/{SOURCE_FILE}')]
+        if len(names) == 0:
+            return False
+        source = json.loads(archive.read(names[0]))
+    return source.get('weights') == get_weights_fingerprint(model_weights_path)
+
+
+def check_embeddings(reference_model, model, inputs, min_cosine=0.9999):
+    """
+    A function which checks that the model returns the same embeddings as the reference model
+    :param reference_model: the eager model
+    :param model: the optimized model
+    :param inputs: torch.Tensor, dimensions: (num_img, 1, 128, 128)
+    :param min_cosine: float, the minimal cosine similarity of the corresponding embeddings
+    :return: float, the lowest cosine similarity
+    """
+    with torch.no_grad():
+        expected, actual = reference_model(inputs), model(inputs)
+    cosine = nn.functional.cosine_similarity(expected, actual, dim=1).min().item()
+    if cosine < min_cosine:
+        raise ValueError(f'The exported model differs from the eager model: cosine similarity {cosine:.6f}')
+    return cosine
+
+
+def export_model(model_weights_path, output_path, inputs=None, min_cosine=0.9999):
+    """
+    A function which folds the batch normalizations, freezes the model with TorchScript and saves it
+    :param model_weights_path: str, path to the model weights (saved from the DataParallel model)
+    :param output_path: str, path of the exported TorchScript model (.pt)
+    :param inputs: torch.Tensor of processed faces used for the check, dimensions: (num_img, 1, 128, 128),
+           random images are used if not set
+    :param min_cosine: float, the minimal cosine similarity of the exported and the eager embeddings
+    :return: float, the lowest cosine similarity of the exported and the eager embeddings
+    """
+    eager_model = load_eager_model(model_weights_path)
+    fused_model = fuse_resnet_face(eager_model)
+
+    # 1) Trace the model and freeze it (the weights become constants of the graph)
+    example = torch.rand(2, 1, 128, 128) * 2 - 1
+    with torch.no_grad():
+        exported_model = torch.jit.trace(fused_model, example)
+    if hasattr(torch.jit, 'freeze'):
+        exported_model = torch.jit.freeze(exported_model.eval())
+
+    # 2) Make sure the embeddings didn't change
+    if inputs is None:
+        inputs = torch.rand(16, 1, 128, 128) * 2 - 1
+    cosine = check_embeddings(eager_model, exported_model, inputs, min_cosine)
+
+    save_exported_model(exported_model, output_path, model_weights_path)
+    return cosine
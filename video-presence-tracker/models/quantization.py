@@ -0,0 +1,196 @@
+import torch
+import torch.nn as nn
+from torch.quantization import DeQuantStub, QuantStub
+
+from .export import fuse_bn_linear, fuse_conv_bn, fuse_linear_bn, load_eager_model, save_exported_model
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+
+class _FloatIsland(nn.Module):
+    """
+    A wrapper which runs the module without a quantized implementation (PReLU, Sigmoid, standalone BatchNorm)
+    in float between two quantized parts of the model
+    """
+
+    def __init__(self, module):
+        super(_FloatIsland, self).__init__()
+        self.dequant = DeQuantStub()
+        self.module = module
+        self.module.qconfig = None
+        self.quant = QuantStub()
+
+    def forward(self, x):
+        return self.quant(self.module(self.dequant(x)))
+
+
+class QuantizableSEBlock(nn.Module):
+    """
+    SEBlock with the multiplication done by FloatFunctional
+    """
+
+    def __init__(self, se):
+        """
+        :param se: SEBlock
+        """
+        super(QuantizableSEBlock, self).__init__()
+        self.avg_pool = se.avg_pool
+        self.fc1 = se.fc[0]
+        self.prelu = _FloatIsland(se.fc[1])
+        self.fc2 = se.fc[2]
+        self.sigmoid = _FloatIsland(se.fc[3])
+        self.mul = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        b, c, _, _ = x.size()
+        y = self.avg_pool(x).reshape(b, c)
+        y = self.sigmoid(self.fc2(self.prelu(self.fc1(y)))).reshape(b, c, 1, 1)
+        return self.mul.mul(x, y.expand_as(x))
+
+
+class QuantizableIRBlock(nn.Module):
+    """
+    IRBlock with the batch normalizations folded and the residual addition done by FloatFunctional
+    """
+
+    def __init__(self, block):
+        """
+        :param block: IRBlock in eval mode
+        """
+        super(QuantizableIRBlock, self).__init__()
+        self.bn0 = _FloatIsland(block.bn0)
+        self.conv1 = fuse_conv_bn(block.conv1, block.bn1)
+        self.prelu1 = _FloatIsland(block.prelu)
+        self.conv2 = fuse_conv_bn(block.conv2, block.bn2)
+        self.se = QuantizableSEBlock(block.se) if block.use_se else None
+        self.downsample = None
+        if block.downsample is not None:
+            self.downsample = fuse_conv_bn(block.downsample[0], block.downsample[1])
+        self.prelu2 = _FloatIsland(block.prelu)
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        residual = x
+        out = self.bn0(x)
+        out = self.conv1(out)
+        out = self.prelu1(out)
+
+        out = self.conv2(out)
+        if self.se is not None:
+            out = self.se(out)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        out = self.skip_add.add(out, residual)
+        out = self.prelu2(out)
+
+        return out
+
+
+class QuantizableResNetFace(nn.Module):
+    """
+    ResNetFace prepared for the post-training static quantization - the batch normalizations are folded,
+    the quantized part of the model starts with QuantStub and ends with DeQuantStub
+    """
+
+    def __init__(self, model):
+        """
+        :param model: ResNetFace in eval mode
+        """
+        super(QuantizableResNetFace, self).__init__()
+        with torch.no_grad():
+            self.quant = QuantStub()
+            self.conv1 = fuse_conv_bn(model.conv1, model.bn1)
+            self.prelu = _FloatIsland(model.prelu)
+            self.maxpool = model.maxpool
+            self.layer1 = nn.Sequential(*[QuantizableIRBlock(block) for block in model.layer1])
+            self.layer2 = nn.Sequential(*[QuantizableIRBlock(block) for block in model.layer2])
+            self.layer3 = nn.Sequential(*[QuantizableIRBlock(block) for block in model.layer3])
+            self.layer4 = nn.Sequential(*[QuantizableIRBlock(block) for block in model.layer4])
+            self.fc5 = fuse_linear_bn(fuse_bn_linear(model.bn4, model.fc5), model.bn5)
+            self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.conv1(x)
+        x = self.prelu(x)
+        x = self.maxpool(x)
+
+        x = self.layer1(x)
+        x = self.layer2(x)
+        x = self.layer3(x)
+        x = self.layer4(x)
+        x = x.reshape(x.size(0), -1)
+        x = self.fc5(x)
+
+        return self.dequant(x)
+
+
+def quantize_dynamic(model):
+    """
+    A function which quantizes the weights of the linear layers (mainly fc5) to int8,
+    the activations are quantized on the fly
+    :param model: ResNetFace in eval mode
+    :return: the quantized model
+    """
+    return torch.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_inputs, backend='fbgemm', batch_size=32):
+    """
+    A function which quantizes the weights and activations of the convolutions and linear layers to int8,
+    the ranges of the activations are calibrated on the given inputs
+    :param model: ResNetFace in eval mode
+    :param calibration_inputs: torch.Tensor of processed faces, dimensions: (num_img, 1, 128, 128)
+    :param backend: str, the quantized engine - fbgemm for x86 CPUs
+    :param batch_size: int, the number of images fed to the model at once during the calibration
+    :return: the quantized model
+    """
+    torch.backends.quantized.engine = backend
+    quantized_model = QuantizableResNetFace(model.eval()).eval()
+    quantized_model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantized_model, inplace=True)
+    with torch.no_grad():
+        for batch in torch.split(calibration_inputs, batch_size):
+            quantized_model(batch)
+    torch.quantization.convert(quantized_model, inplace=True)
+    return quantized_model
+
+
+def quantize(model, mode, calibration_inputs=None):
+    """
+    :param model: ResNetFace in eval mode
+    :param mode: str, one of QUANTIZATION_MODES
+    :param calibration_inputs: torch.Tensor of processed faces, required by the static quantization
+    :return: the quantized model
+    """
+    if mode == 'dynamic':
+        return quantize_dynamic(model)
+    if mode == 'static':
+        if calibration_inputs is None:
+            raise ValueError('The static quantization requires calibration inputs')
+        return quantize_static(model, calibration_inputs)
+    raise ValueError(f'Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}')
+
+
+def export_quantized_model(model_weights_path, output_path, mode, calibration_inputs=None):
+    """
+    A function which quantizes the model, freezes it with TorchScript and saves it
+    :param model_weights_path: str, path to the model weights (saved from the DataParallel model)
+    :param output_path: str, path of the quantized TorchScript model (.pt)
+    :param mode: str, one of QUANTIZATION_MODES
+    :param calibration_inputs: torch.Tensor of processed faces, dimensions: (num_img, 1, 128, 128)
+    :return: a pair (the eager model, the quantized TorchScript model)
+    """
+    eager_model = load_eager_model(model_weights_path)
+    quantized_model = quantize(eager_model, mode, calibration_inputs)
+
+    example = torch.rand(2, 1, 128, 128) * 2 - 1
+    with torch.no_grad():
+        exported_model = torch.jit.trace(quantized_model, example)
+    if hasattr(torch.jit, 'freeze'):
+        exported_model = torch.jit.freeze(exported_model.eval())
+
+    save_exported_model(exported_model, output_path, model_weights_path)
+    return eager_model, exported_model
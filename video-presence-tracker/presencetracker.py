@@ -0,0 +1,168 @@
+import numpy as np
+
+
+class PresenceTracker:
+    """
+    A class which keeps track of the results of the last m analyses
+    and decides when the recording of a video segment starts and stops.
+    The recording starts when there are at least start_count positive analyses among the last m
+    and stops when there are at most stop_count of them and the recording lasts at least min_length seconds.
+    The returned intervals begin pre_roll seconds before the analysis which started the recording,
+    but never before the end of the previous interval.
+    """
+
+    def __init__(self, m_analyses, start_count=1, stop_count=0, min_length=0, pre_roll=0):
+        """
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param start_count: int, a minimal number of positive analyses among the last m which starts the recording
+        :param stop_count: int, a maximal number of positive analyses among the last m which stops the recording
+        :param min_length: float, a minimal length of the recording in seconds
+        :param pre_roll: float, how many seconds before the first positive analysis the interval begins
+        """
+        self._check_params(m_analyses, start_count, stop_count)
+        self.m_analyses = m_analyses
+        self.start_count = start_count
+        self.stop_count = stop_count
+        self.min_length = min_length
+        self.pre_roll = pre_roll
+
+        # A ring buffer of boolean values which represent whether there was somebody from reference dataset detected
+        self.presence_of_reference = [False] * m_analyses
+        # Index of the oldest analysis within the ring buffer and the number of positive analyses in it
+        self._oldest_i = 0
+        self.positive_count = 0
+
+        self.currently_detected = set()
+        self.recording_t = 0
+        self.recording = False
+        # The end of the last returned interval, the next interval never begins before it
+        self._last_t_end = 0
+
+    @staticmethod
+    def _check_params(m_analyses, start_count, stop_count):
+        """
+        A function which raises ValueError if the parameters don't define a valid hysteresis
+        """
+        if m_analyses < 1:
+            raise ValueError(f'The window has to contain at least 1 analysis, got {m_analyses}')
+        if not 0 <= stop_count < start_count <= m_analyses:
+            raise ValueError(f'Expected 0 <= stop_count < start_count <= m_analyses, '
+                             f'got stop_count={stop_count}, start_count={start_count}, m_analyses={m_analyses}')
+
+    def update(self, t, detected_labels):
+        """
+        A function which processes the result of one analysis
+        :param t: numpy.float64, time of the analysed frame
+        :param detected_labels: a set of labels detected in the analysed frame
+        :return: a tuple (t_start, t_end, identities) if the recording was stopped, None otherwise
+        """
+        # 1) Store the information whether there was someone detected
+        # and update the currently_detected set if necessary
+        positive = len(detected_labels) != 0
+        if positive and len(detected_labels - self.currently_detected) != 0:
+            self.currently_detected.update(detected_labels)
+            print(f'Identities of interest currently present in the recorded clip: {self.currently_detected}')
+
+        # 2) Replace the oldest detection
+        self.positive_count += positive - self.presence_of_reference[self._oldest_i]
+        self.presence_of_reference[self._oldest_i] = positive
+        self._oldest_i = (self._oldest_i + 1) % self.m_analyses
+
+        # 3) Check whether there were enough detections in the last m analyses
+        # and start recording if it is not already the case
+        if self.positive_count >= self.start_count:
+            if not self.recording:
+                print('Recording started')
+                self.recording_t, self.recording = t, True
+
+        elif self.recording and self.positive_count <= self.stop_count and t >= self.recording_t + self.min_length:
+            # 4) Stop recording if there were not enough detections in the last m analyses
+            self.recording = False
+            return self._pop_interval(t)
+
+        return None
+
+    def finish(self):
+        """
+        A function which is called after the last analysis
+        :return: a tuple (t_start, None, identities) if the recording was in progress, None otherwise
+        """
+        if self.recording:
+            self.recording = False
+            return self._pop_interval(None)
+        return None
+
+    def _pop_interval(self, t_end):
+        """
+        :param t_end: numpy.float64 or None, the end of the recorded interval
+        :return: a tuple (t_start, t_end, identities) and clears the detected identities
+        """
+        identities = set(self.currently_detected)
+        self.currently_detected.clear()
+        t_start = self.get_interval_start(self.recording_t)
+        self._last_t_end = t_end
+        return t_start, t_end, identities
+
+    def get_interval_start(self, t):
+        """
+        :param t: numpy.float64, time of the analysis which starts (or started) the recording
+        :return: the beginning of the interval started at the time t (including the pre-roll)
+        """
+        return max(t - self.pre_roll, self._last_t_end, 0)
+
+    @classmethod
+    def replay(cls, times, detections, m_analyses, start_count=1, stop_count=0, min_length=0, labels=None,
+               pre_roll=0):
+        """
+        A function which computes the recorded intervals from precomputed results of all the analyses at once.
+        Returns the same intervals as calling update() for every analysis followed by finish().
+        :param times: numpy.ndarray of increasing times of the analyses, dimensions: (num_analyses,)
+        :param detections: numpy.ndarray of booleans, whether there was someone detected, dimensions: (num_analyses,)
+        :param m_analyses: int, see __init__
+        :param start_count: int, see __init__
+        :param stop_count: int, see __init__
+        :param min_length: float, see __init__
+        :param labels: a list of sets of labels detected in the analyses, used to fill in the identities
+        :param pre_roll: float, see __init__
+        :return: a list of (t_start, t_end, identities) tuples,
+                 t_end of the last interval is None if the recording lasted until the last analysis
+        """
+        cls._check_params(m_analyses, start_count, stop_count)
+        times = np.asarray(times, dtype=np.float64)
+        detections = np.asarray(detections, dtype=bool)
+
+        # 1) Number of positive analyses in the window ending at each analysis
+        cumsum = np.concatenate(([0], np.cumsum(detections)))
+        window_ends = np.arange(1, len(detections) + 1)
+        counts = cumsum[window_ends] - cumsum[np.maximum(window_ends - m_analyses, 0)]
+
+        # 2) Analyses at which the recording would start or stop
+        start_candidates = np.flatnonzero(counts >= start_count)
+        stop_candidates = np.flatnonzero(counts <= stop_count)
+
+        # 3) Walk through the intervals - every start is followed by the first stop allowed by min_length
+        intervals, next_i, labels_i, last_t_end = [], 0, 0, 0
+        while True:
+            start_i = np.searchsorted(start_candidates, next_i)
+            if start_i == len(start_candidates):
+                break
+            start = start_candidates[start_i]
+
+            first_stop = max(start + 1, np.searchsorted(times, times[start] + min_length))
+            stop_i = np.searchsorted(stop_candidates, first_stop)
+            stop = stop_candidates[stop_i] if stop_i < len(stop_candidates) else None
+
+            identities = set()
+            if labels is not None:
+                identities = set().union(*labels[labels_i:len(times) if stop is None else stop + 1])
+
+            t_start = max(times[start] - pre_roll, last_t_end, 0)
+            if stop is None:
+                intervals.append((t_start, None, identities))
+                break
+            intervals.append((t_start, times[stop], identities))
+            next_i = labels_i = stop + 1
+            last_t_end = times[stop]
+
+        return intervals
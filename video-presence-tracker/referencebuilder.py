@@ -0,0 +1,188 @@
+import multiprocessing
+from hashlib import sha1
+from os import cpu_count, listdir
+from os.path import exists, getmtime, getsize, isdir, join
+
+import cv2
+import numpy as np
+import torch
+
+from .matchers import normalize_features
+from .pickle_utils import load_pickle, save_pickle
+
+# The classifier wrapper of the parent process - the forked workers use its face detector and preprocessing
+_classifier_wrapper = None
+
+
+def _init_worker():
+    """
+    A function which limits the worker to one thread, the images are processed in parallel by the workers
+    :return: None
+    """
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+
+
+def _prepare_image(job):
+    """
+    A function which decodes the image, detects the face and frontalizes it in the worker process
+    :param job: a tuple (image path, content hash)
+    :return: a tuple (image path, content hash, numpy.ndarray of the processed face or None, the number of faces)
+    """
+    image_path, content_hash = job
+    image = cv2.imread(image_path)
+    if image is None:
+        return image_path, content_hash, None, 0
+    _, landmarks = _classifier_wrapper.detect(image)
+    if len(landmarks) != 1:
+        return image_path, content_hash, None, len(landmarks)
+    return image_path, content_hash, _classifier_wrapper._get_faces(image, landmarks), 1
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    :param file_path: str, path of the file
+    :param chunk_size: int, the number of bytes read at once
+    :return: str, SHA-1 hash of the content of the file
+    """
+    file_hash = sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class ReferenceBuilder:
+    """
+    A class which computes the representative feature of every identity of the dataset (the mean of the features
+    of its images). The feature of every image is cached under the hash of its content, so only the new or changed
+    images are processed when the dataset changes. The images are decoded, the faces detected and frontalized
+    in parallel worker processes and the faces are embedded in batches by the model of the parent process.
+    The cache is discarded when the model, the detector or the embedding mode changes.
+    """
+
+    def __init__(self, classifier_wrapper, cache_path, model_path, detector='mtcnn', num_workers=None,
+                 batch_size=32):
+        """
+        :param classifier_wrapper: ClassifierWrapper used for the detection and embedding,
+               the model must not be run before build() (the workers are forked)
+        :param cache_path: str, path to the pickle file with the features of the images
+        :param model_path: str, path to the model the features are computed by (identifies the cache)
+        :param detector: str, the kind of the face detector (identifies the cache)
+        :param num_workers: int, the number of worker processes, the number of CPUs if not set
+        :param batch_size: int, the number of faces embedded in a single forward pass
+        """
+        self.classifier_wrapper = classifier_wrapper
+        self.cache_path = cache_path
+        self.num_workers = num_workers if num_workers is not None else cpu_count()
+        self.batch_size = batch_size
+        self.fingerprint = f'{model_path}:{getsize(model_path)}:{getmtime(model_path)}:{detector}:' \
+                           f'{classifier_wrapper.embedding_mode}'
+
+    def _load_cache(self):
+        """
+        :return: dict {content hash: numpy.ndarray feature or None if the image has no usable face}
+        """
+        if not exists(self.cache_path):
+            return {}
+        cache = load_pickle(self.cache_path)
+        if cache.get('fingerprint') != self.fingerprint:
+            print('The model or the detector changed, all the images will be processed again')
+            return {}
+        return cache['features']
+
+    def _embed(self, faces, hashes, cache):
+        """
+        A function which embeds the faces in a single forward pass and stores their features in the cache
+        :param faces: a list of numpy.ndarrays of the processed faces
+        :param hashes: a list of content hashes of the images of the faces
+        :param cache: dict {content hash: feature}
+        :return: None
+        """
+        features = self.classifier_wrapper._get_features_for_batch(np.vstack(faces))
+        for content_hash, feature in zip(hashes, features):
+            cache[content_hash] = np.asarray(feature, dtype=np.float32)
+
+    def _process_images(self, jobs, cache):
+        """
+        A function which computes the features of the images which are not in the cache
+        :param jobs: a list of (image path, content hash) tuples
+        :param cache: dict {content hash: feature}, updated in place
+        :return: None
+        """
+        global _classifier_wrapper
+
+        _classifier_wrapper = self.classifier_wrapper
+        faces, hashes = [], []
+        with multiprocessing.get_context('fork').Pool(self.num_workers, _init_worker) as pool:
+            for image_path, content_hash, face, num_faces in pool.imap_unordered(_prepare_image, jobs, chunksize=4):
+                if face is None:
+                    if num_faces == 0:
+                        print(f'No faces detected in the image on path {image_path}')
+                    else:
+                        print(f'Multiple faces detected in the image on path {image_path}. '
+                              f'Cannot distinguish which face belongs to the identity')
+                    cache[content_hash] = None
+                    continue
+
+                faces.append(face)
+                hashes.append(content_hash)
+                if len(faces) == self.batch_size:
+                    self._embed(faces, hashes, cache)
+                    faces, hashes = [], []
+
+        if len(faces) != 0:
+            self._embed(faces, hashes, cache)
+
+    def build(self, dataset_dir):
+        """
+        A function which computes the representative features of the identities in the dataset,
+        the identities without any usable face are skipped
+        :param dataset_dir: a path to the dataset root folder (the names of the folders are labels)
+        :return: a list of labels and numpy.ndarray of L2-normalized float32 features, one row for each label
+        """
+        # 1) Hash the images and find the ones which are not in the cache
+        cache = self._load_cache()
+        identity_hashes, jobs, queued = {}, [], set()
+        for name in sorted(listdir(dataset_dir)):
+            if not isdir(join(dataset_dir, name)):
+                continue
+            identity_hashes[name] = []
+            for image_name in sorted(listdir(join(dataset_dir, name))):
+                image_path = join(dataset_dir, name, image_name)
+                content_hash = hash_file(image_path)
+                identity_hashes[name].append(content_hash)
+                if content_hash not in cache and content_hash not in queued:
+                    jobs.append((image_path, content_hash))
+                    queued.add(content_hash)
+
+        num_changed = sum(any(content_hash in queued for content_hash in hashes)
+                          for hashes in identity_hashes.values())
+        print(f'Processing {len(jobs)} new images of {num_changed} identities, '
+              f'{sum(map(len, identity_hashes.values())) - len(jobs)} images are cached')
+
+        # 2) Compute the features of the new images
+        if len(jobs) != 0:
+            self._process_images(jobs, cache)
+
+        # 3) Save the features of the images which are still in the dataset
+        used_hashes = set().union(*identity_hashes.values())
+        save_pickle(self.cache_path, {
+            'fingerprint': self.fingerprint,
+            'features': {content_hash: feature for content_hash, feature in cache.items()
+                         if content_hash in used_hashes}
+        })
+
+        # 4) Compute the representative feature of every identity by averaging the features of its images
+        labels, features = [], []
+        for name, hashes in identity_hashes.items():
+            name_features = [cache[content_hash] for content_hash in hashes if cache.get(content_hash) is not None]
+            if len(name_features) == 0:
+                print(f'\033[93mException: no usable face of {name} --> skipping the identity\033[0m')
+                continue
+            labels.append(name)
+            features.append(np.mean(name_features, axis=0))
+
+        if len(features) == 0:
+            raise ValueError(f'There is no usable face in the dataset {dataset_dir}')
+        return labels, normalize_features(np.vstack(features))
@@ -0,0 +1,128 @@
+import json
+from os import listdir, makedirs, rename, replace
+from os.path import exists, isdir, join
+from shutil import rmtree
+from time import time, time_ns
+
+import numpy as np
+
+from .matchers import normalize_features
+from .pickle_utils import load_pickle
+
+# The version of the layout of the reference store, the stores of unknown versions are not loaded
+REFERENCE_STORE_VERSION = 1
+# The file naming the current generation of the reference store
+CURRENT_FILE = 'CURRENT'
+
+
+def _get_current_generation(store_dir):
+    """
+    :param store_dir: str, the directory of the reference store
+    :return: str, the name of the current generation or None if the store doesn't exist
+    """
+    current_path = join(store_dir, CURRENT_FILE)
+    if not exists(current_path):
+        return None
+    with open(current_path) as f:
+        return f.read().strip()
+
+
+def save_references(store_dir, labels, features, model=None, embedding_mode=None, keep_generations=2):
+    """
+    A function which saves the reference features as a new generation of the store. The features are saved
+    as a float32 .npy matrix and the labels with the metadata to index.json. The generation is written completely
+    before the CURRENT file is atomically replaced, so the readers always see either the old or the new set.
+    The older generations are kept for a while, the processes which opened them are not affected.
+    :param store_dir: str, the directory of the reference store
+    :param labels: a list containing the labels, the index corresponds to the row of the features
+    :param features: numpy.ndarray where each row is 1 feature vector
+    :param model: str, the version of the model the features were computed by
+    :param embedding_mode: str, the embedding mode the features were computed in (see classifierwrapper.py)
+    :param keep_generations: int, the number of the latest generations which are not removed
+    :return: str, path of the saved generation
+    """
+    features = normalize_features(features)
+    if len(labels) != len(features):
+        raise ValueError(f'There are {len(labels)} labels for {len(features)} reference features')
+
+    # 1) Write the new generation to a temporary directory
+    generation = f'v{time_ns()}'
+    generation_path = join(store_dir, generation)
+    tmp_path = f'{generation_path}.tmp'
+    makedirs(tmp_path)
+    np.save(join(tmp_path, 'features.npy'), features)
+    with open(join(tmp_path, 'index.json'), 'w') as f:
+        json.dump({
+            'version': REFERENCE_STORE_VERSION,
+            'labels': list(labels),
+            'dim': features.shape[1],
+            'normalization': 'l2',
+            'dtype': 'float32',
+            'model': model,
+            'embedding_mode': embedding_mode,
+            'created': time()
+        }, f)
+    rename(tmp_path, generation_path)
+
+    # 2) Switch the readers to the new generation
+    current_path = join(store_dir, CURRENT_FILE)
+    with open(f'{current_path}.tmp', 'w') as f:
+        f.write(generation)
+    replace(f'{current_path}.tmp', current_path)
+
+    # 3) Remove the old generations
+    generations = sorted(name for name in listdir(store_dir)
+                         if isdir(join(store_dir, name)) and not name.endswith('.tmp'))
+    for name in generations[:-keep_generations]:
+        rmtree(join(store_dir, name), ignore_errors=True)
+    return generation_path
+
+
+def migrate_representations(representations_path, store_dir, embedding_mode=None):
+    """
+    A function which imports the [labels, features] pickle file saved by the older versions to the reference store,
+    the pickle file is renamed afterwards so it is imported only once
+    :param representations_path: path to the pickle file with the labels and the features
+    :param store_dir: str, the directory of the reference store
+    :param embedding_mode: str, the embedding mode the features were computed in
+    :return: bool, True if the representations were imported
+    """
+    if _get_current_generation(store_dir) is not None or not exists(representations_path):
+        return False
+    labels, features = load_pickle(representations_path)
+    makedirs(store_dir, exist_ok=True)
+    save_references(store_dir, labels, features, embedding_mode=embedding_mode)
+    rename(representations_path, f'{representations_path}.migrated')
+    return True
+
+
+def load_references(store_dir, dim=None, model=None):
+    """
+    A function which opens the current generation of the reference store. The features are memory-mapped
+    read-only, so all the processes using the store share its pages
+    :param store_dir: str, the directory of the reference store
+    :param dim: int, the embedding dimension of the loaded model, the store is refused if it doesn't match
+    :param model: str, the version of the loaded model, a warning is printed if the features were computed by another
+    :return: a list of labels, memory-mapped numpy.ndarray of L2-normalized float32 features (one row for each label)
+             and dict of the metadata (dim, model, embedding_mode, ...)
+    """
+    generation = _get_current_generation(store_dir)
+    if generation is None:
+        raise FileNotFoundError(f'There is no reference store in {store_dir}, run setup.py first')
+
+    with open(join(store_dir, generation, 'index.json')) as f:
+        meta = json.load(f)
+    if meta.get('version') != REFERENCE_STORE_VERSION:
+        raise ValueError(f'Unsupported version {meta.get("version")} of the reference store {store_dir}, '
+                         f'expected {REFERENCE_STORE_VERSION}')
+    if dim is not None and meta['dim'] != dim:
+        raise ValueError(f'The reference features have {meta["dim"]} dimensions, the model produces {dim}, '
+                         f'run setup.py again to compute them by the model')
+    if model is not None and meta['model'] is not None and meta['model'] != model:
+        print(f'\033[93mException: the reference features were computed by {meta["model"]}, not by {model} '
+              f'--> run setup.py again if the model changed\033[0m')
+
+    features = np.load(join(store_dir, generation, 'features.npy'), mmap_mode='r')
+    if features.dtype != np.float32 or features.shape != (len(meta['labels']), meta['dim']):
+        raise ValueError(f'The reference features {features.shape} do not match the index of {store_dir}')
+    return meta['labels'], features, meta
@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+
+
+class SceneChangeGate:
+    """
+    A class which skips the analysis of the sampled frames which are almost identical
+    to the last analysed frame and reuses its labels instead. The frames are compared
+    by the mean absolute difference of their downscaled grayscale copies.
+    """
+
+    def __init__(self, threshold=0.03, max_staleness=5.0, size=32):
+        """
+        :param threshold: float, the frame is analysed when the mean absolute difference of the pixel
+               intensities (in the range <0, 1>) from the last analysed frame reaches this value
+        :param max_staleness: float, the frame is analysed when the last analysed frame is older
+               than this number of seconds, no matter how similar it is
+        :param size: int, the frames are downscaled to size x size pixels before the comparison
+        """
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.size = size
+        # The downscaled copy, the time and the labels of the last analysed frame
+        self._reference = None
+        self._reference_t = None
+        self._reference_labels = set()
+        # Statistics - number of frames passed through the gate and number of skipped analyses
+        self.num_frames = 0
+        self.num_skipped = 0
+
+    def _downscale(self, img):
+        """
+        :param img: numpy.ndarray, dimensions: (height, weight, 3)
+        :return: numpy.ndarray, the downscaled grayscale image with intensities in the range <0, 1>
+        """
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(img, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        return small.astype(np.float32) / 255
+
+    def _is_unchanged(self, small, t):
+        """
+        :param small: numpy.ndarray, the downscaled frame
+        :param t: float, time of the frame
+        :return: bool, whether the analysis of the frame can be skipped
+        """
+        if self._reference is None or t - self._reference_t >= self.max_staleness:
+            return False
+        return float(np.mean(np.abs(small - self._reference))) < self.threshold
+
+    def get_labels_batch(self, imgs, times, get_labels_batch):
+        """
+        A function which returns labels for multiple consecutive sampled frames,
+        only the changed frames are passed to get_labels_batch
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :param times: a list of times of the frames
+        :param get_labels_batch: a function (imgs, times) -> a list of sets of labels
+        :return: a list of sets of labels, one set for each image
+        """
+        # 1) Decide which frames have to be analysed, the rest reuses the labels
+        # of the last analysed frame (-1 stands for the frame analysed within one of the previous batches)
+        analysed, sources = [], []
+        for i, (img, t) in enumerate(zip(imgs, times)):
+            self.num_frames += 1
+            small = self._downscale(img)
+            if self._is_unchanged(small, t):
+                self.num_skipped += 1
+                sources.append(sources[-1] if len(sources) != 0 else -1)
+            else:
+                self._reference, self._reference_t = small, t
+                analysed.append(i)
+                sources.append(i)
+
+        # 2) Analyse the changed frames
+        analysed_labels = {}
+        if len(analysed) != 0:
+            labels = get_labels_batch([imgs[i] for i in analysed], [times[i] for i in analysed])
+            analysed_labels = dict(zip(analysed, labels))
+
+        batch_labels = [set(analysed_labels[i]) if i != -1 else set(self._reference_labels) for i in sources]
+        if len(analysed) != 0:
+            self._reference_labels = analysed_labels[analysed[-1]]
+        return batch_labels
@@ -1,9 +1,34 @@
 from os.path import join
+from queue import Empty, Full, Queue
+from threading import Event, Thread
 from time import time
 
 import cv2
 
 from .classifierwrapper import ClassifierWrapper
+from .clipwriter import ClipWriter, save_clip
+from .embeddingledger import EmbeddingLedger
+from .facetracker import FaceTracker
+from .framereader import SamplingReader, iter_sampled_frames
+from .presencetracker import PresenceTracker
+from .scenegate import SceneChangeGate
+
+
+def _put(queue, item, stop_event):
+    """
+    A function which puts the item to the bounded queue unless the pipeline was stopped
+    :param queue: queue.Queue
+    :param item: an item to put
+    :param stop_event: threading.Event, set when the pipeline is stopped
+    :return: bool, True if the item was put to the queue
+    """
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
 
 
 class VideoProcessor:
@@ -13,7 +38,10 @@ class VideoProcessor:
     is detected.
     """
 
-    def __init__(self, ref_labels, ref_features, model_weights_path, video_dir, display_vid=False):
+    def __init__(self, ref_labels, ref_features, model_weights_path, video_dir, display_vid=False, clip_writer=None,
+                 clip_backend='reencode', start_count=1, stop_count=0, min_clip_length=0, matcher=None,
+                 track_faces=False, track_refresh_interval=10.0, scene_change_threshold=None, scene_max_staleness=5.0,
+                 embedding_mode='flip', face_detector=None, pre_roll=0, ledger_dir=None):
         """
         :param ref_labels: a list containing the labels,
                the index corresponds to the row withing ref_features
@@ -22,65 +50,80 @@ class VideoProcessor:
         :param video_dir: a path to the directory where the processed videos will be stored
         :param display_vid: a parameter determining whether the video should be displayed
                in a separate window
+        :param clip_writer: ClipWriter, the writer stage used by the pipelined and the timeline processing,
+               a single-threaded writer is created on the first use if not set
+        :param clip_backend: str, the way the video segments are cut out, one of clipwriter.CLIP_BACKENDS
+        :param start_count: int, a minimal number of positive analyses among the last m which starts the recording
+        :param stop_count: int, a maximal number of positive analyses among the last m which stops the recording
+        :param min_clip_length: float, a minimal length of the recording in seconds
+        :param matcher: an object comparing the features with ref_features (see matchers.py),
+               exact matching is used if not set
+        :param track_faces: bool, whether the faces are followed across the sampled frames by FaceTracker,
+               so that only new or moved faces are embedded (not used by the pipelined processing)
+        :param track_refresh_interval: float, the maximum age of the cached identity of a tracked face in seconds
+        :param scene_change_threshold: float, the sampled frames which differ from the last analysed frame
+               by less than this value reuse its labels (see SceneChangeGate), None analyses every sampled frame
+               (not used by the pipelined processing)
+        :param scene_max_staleness: float, the maximum age of the reused labels in seconds
+        :param embedding_mode: str, 'flip' or 'single' (see ClassifierWrapper), has to match ref_features
+        :param face_detector: FaceDetector (see facedetector.py),
+               MTCNN detection on the full resolution frame is used if not set
+        :param pre_roll: float, the video segments begin this number of seconds before the analysis
+               which started the recording (see PresenceTracker)
+        :param ledger_dir: str, the embeddings of the faces of every processed video are saved to this directory
+               (see EmbeddingLedger), so the video can be matched with new reference features without
+               the model, None disables it (not used by the pipelined and the sharded processing)
         """
-        self.classifier_wrapper = ClassifierWrapper(ref_labels, ref_features, model_weights_path)
+        self.classifier_wrapper = ClassifierWrapper(ref_labels, ref_features, model_weights_path, matcher=matcher,
+                                                    embedding_mode=embedding_mode, face_detector=face_detector)
         self.video_dir = video_dir
         self.display_vid = display_vid
+        self.clip_writer = clip_writer
+        self.clip_backend = clip_backend
+        self.start_count = start_count
+        self.stop_count = stop_count
+        self.min_clip_length = min_clip_length
+        self.track_faces = track_faces
+        self.track_refresh_interval = track_refresh_interval
+        self.scene_change_threshold = scene_change_threshold
+        self.scene_max_staleness = scene_max_staleness
+        self.pre_roll = pre_roll
+        self.ledger_dir = ledger_dir
 
-    def process(self, video_clip, nth_frame, m_analyses):
+    def process(self, video_clip, nth_frame, m_analyses, batch_size=1, source_id=None, title=None):
         """
         A function which processes the video as is explained in the class description.
         :param video_clip: moviepy.editor.VideoFileClip - the video to process
         :param nth_frame: int, every nth frame will be analysed
         :param m_analyses: int, a number which defines how long to keep recording
                - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model
+               in a single forward pass
+        :param source_id: str, a stable ID of the video (e.g. the YouTube video ID) the embeddings are saved under,
+               the path or URL of the video if not set
+        :param title: str, the title of the video stored with the embeddings
         :return: None - saves the video segments directly to files
         """
+        presence_tracker, ledger = self._new_presence_tracker(m_analyses), self._new_ledger()
+        face_tracker, scene_gate = self._new_face_tracker(ledger), self._new_scene_gate()
 
-        # A list of boolean values which represent whether there was somebody from reference dataset detected
-        presence_of_reference = [False for i in range(m_analyses)]
-
-        video_name, currently_detected, n_counter, recording_t, recording = None, set(), 1, 0, False
+        # A list of sampled frames (and their times) waiting for the analysis
+        batch = []
         # 1) Iterate through the video frames
-        for t, video_frame in video_clip.iter_frames(with_times=True):
+        for t, video_frame, sampled in self._iter_frames(video_clip, nth_frame):
 
-            # 2)_Check whether it is time to analyze the frame
-            if n_counter == nth_frame:
-                # 3) Get labels from the frame
-                detected_labels = self.classifier_wrapper.get_labels(video_frame)
-
-                # 4) Store the information whether there was someone detected
-                # and update the currently_detected set if necessary
-                if len(detected_labels) != 0:
-                    presence_of_reference.append(True)
-                    if len(detected_labels - currently_detected) != 0:
-                        currently_detected.update(detected_labels)
-                        print(f'Identities of interest currently present in the recorded clip: {currently_detected}')
-                else:
-                    presence_of_reference.append(False)
-
-                # 5) Remove the oldest detection
-                presence_of_reference = presence_of_reference[1:]
-
-                # 6) Check whether there was there was someone detected in the last m analyses
-                # and start recording if it is not already the case
-                if True in presence_of_reference:
-                    if not recording:
-                        print('Recording started')
-                        video_name, recording_t, recording = f'{time()}.mp4', t, True
-
-                elif recording:
-                    # 7) Stop recording if there were not any detections in the last m analyses
-                    self._save_recording(video_clip, video_name, currently_detected, recording_t, t)
-                    video_name, recording = None, False
-
-                # 8) Reset the counter
-                n_counter = 1
-            else:
-                n_counter += 1
+            # 2) Collect the frames sampled for the analysis
+            if sampled:
+                batch.append((t, video_frame))
+
+                # 3) Analyse the sampled frames once the batch is full
+                if len(batch) == batch_size:
+                    intervals = self._process_batch(batch, presence_tracker, face_tracker, scene_gate, ledger)
+                    self._save_recordings(video_clip, intervals)
+                    batch = []
 
             if self.display_vid:
-                # 9) Display the video frame if the corresponding flag was set
+                # 4) Display the video frame if the corresponding flag was set
                 # OpenCV expects the frame in BGR color format
                 video_frame_bgr = cv2.cvtColor(video_frame, cv2.COLOR_RGB2BGR)
                 cv2.imshow('frame', video_frame_bgr)
@@ -91,9 +134,511 @@ class VideoProcessor:
             # When everything done, close the windows
             cv2.destroyAllWindows()
 
-        if recording:
-            # 10) If the last frame was reached during recording then save the segment
-            self._save_recording(video_clip, video_name, currently_detected, recording_t)
+        # 5) Analyse the frames which did not fill the whole batch
+        if len(batch) != 0:
+            self._save_recordings(video_clip, self._process_batch(batch, presence_tracker, face_tracker, scene_gate,
+                                                                  ledger))
+
+        self._report_skipped(face_tracker, scene_gate)
+        interval = presence_tracker.finish()
+        if interval is not None:
+            # 6) If the last frame was reached during recording then save the segment
+            t_start, _, identities = interval
+            self._save_recording(video_clip, f'{time()}.mp4', identities, t_start)
+        self._save_ledger(ledger, video_clip.filename, nth_frame, source_id, title)
+
+    def process_live(self, hls_reader, nth_frame, m_analyses, batch_size=1, source_id=None, title=None):
+        """
+        A function which processes the live stream segment by segment as they arrive. Each segment is decoded
+        once and the sampled frames of the segment are analysed before the next one, so the latency is bounded
+        by the segment duration. The video segments are saved by concatenating the buffered stream segments
+        without decoding them, so they start and end on the boundaries of the stream segments.
+        Between the recordings, only the encoded segments covering the pre-roll are kept, so the buffer
+        is bounded by the pre-roll (plus one segment) times the bitrate of the stream.
+        The video is not displayed in this mode.
+        :param hls_reader: HLSReader - the stream to process
+        :param nth_frame: int, every nth frame will be analysed
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model
+               in a single forward pass
+        :param source_id: str, a stable ID of the stream (e.g. the URL of its page) the embeddings are saved under,
+               the URL of the playlist if not set
+        :param title: str, the title of the stream stored with the embeddings
+        :return: None - saves the video segments directly to files
+        """
+        presence_tracker, ledger = self._new_presence_tracker(m_analyses), self._new_ledger()
+        face_tracker, scene_gate = self._new_face_tracker(ledger), self._new_scene_gate()
+        try:
+            # 1) Iterate through the stream segments as they are downloaded
+            for segment, sampled_frames in hls_reader.iter_sampled_frames(nth_frame):
+
+                # 2) Analyse the sampled frames of the segment in batches
+                for batch_i in range(0, len(sampled_frames), batch_size):
+                    batch = sampled_frames[batch_i:batch_i + batch_size]
+                    for interval in self._process_batch(batch, presence_tracker, face_tracker, scene_gate, ledger):
+                        self._save_live_recording(hls_reader, interval)
+
+                # 3) Keep only the stream segments which can still become a part of a recording - the buffer
+                # holds the pre-roll before the next analysis (or the whole recording if it is in progress)
+                t_next = presence_tracker.recording_t if presence_tracker.recording \
+                    else segment.t_start + segment.duration
+                hls_reader.release(presence_tracker.get_interval_start(t_next))
+        finally:
+            self._report_skipped(face_tracker, scene_gate)
+            interval = presence_tracker.finish()
+            if interval is not None:
+                # 4) If the stream ended (or was interrupted) during recording then save the segment
+                self._save_live_recording(hls_reader, interval)
+            self._save_ledger(ledger, hls_reader.playlist_url, nth_frame, source_id, title)
+
+    def _save_live_recording(self, hls_reader, interval):
+        """
+        A function which passes the finished recording made of the buffered stream segments to the writer stage,
+        so the analysis of the stream doesn't wait for the concatenation
+        :param hls_reader: HLSReader - the stream which is currently being processed
+        :param interval: a tuple (t_start, t_end, identities)
+        :return: None
+        """
+        print('Recording stopped')
+        t_start, t_end, identities = interval
+        segment_paths = [segment.path for segment in hls_reader.get_segments(t_start, t_end)]
+        self._get_clip_writer().submit_segments(segment_paths, identities)
+
+    def _new_presence_tracker(self, m_analyses):
+        """
+        :param m_analyses: int, a number which defines how long to keep recording
+        :return: PresenceTracker with the recording thresholds of this processor
+        """
+        return PresenceTracker(m_analyses, self.start_count, self.stop_count, self.min_clip_length, self.pre_roll)
+
+    def _new_face_tracker(self, ledger=None):
+        """
+        :param ledger: EmbeddingLedger or None, the faces are recorded in it
+        :return: FaceTracker if the faces are tracked, None otherwise
+        """
+        if not self.track_faces:
+            return None
+        return FaceTracker(self.classifier_wrapper, refresh_interval=self.track_refresh_interval, ledger=ledger)
+
+    def _new_ledger(self):
+        """
+        :return: EmbeddingLedger if the embeddings are saved, None otherwise
+        """
+        if self.ledger_dir is None:
+            return None
+        return EmbeddingLedger()
+
+    def _save_ledger(self, ledger, source, nth_frame, source_id=None, title=None):
+        """
+        A function which saves the embeddings recorded during the analysis of the video
+        :param ledger: EmbeddingLedger or None
+        :param source: str, a path or URL of the video
+        :param nth_frame: int, every nth frame was analysed
+        :param source_id: str, a stable ID of the video the ledger is named by, the source if not set
+               (the URLs of the streams expire, so they can't identify the video)
+        :param title: str, the title of the video
+        :return: None
+        """
+        if ledger is None:
+            return
+        ledger_path = ledger.save(self.ledger_dir, source, {'nth_frame': nth_frame, 'title': title,
+                                                             'embedding_mode': self.classifier_wrapper.embedding_mode},
+                                  source_id)
+        print(f'Saved {ledger.num_embeddings} embeddings of {len(ledger.face_frames)} faces to {ledger_path}')
+
+    def _new_scene_gate(self):
+        """
+        :return: SceneChangeGate if the unchanged frames are skipped, None otherwise
+        """
+        if self.scene_change_threshold is None:
+            return None
+        return SceneChangeGate(self.scene_change_threshold, self.scene_max_staleness)
+
+    @staticmethod
+    def _report_skipped(face_tracker, scene_gate):
+        """
+        A function which prints how much of the analysis was skipped
+        :param face_tracker: FaceTracker or None
+        :param scene_gate: SceneChangeGate or None
+        :return: None
+        """
+        if scene_gate is not None:
+            print(f'Skipped the analysis of {scene_gate.num_skipped} of {scene_gate.num_frames} '
+                  f'sampled frames without a scene change')
+        if face_tracker is not None:
+            print(f'Embedded {face_tracker.num_embeddings} of {face_tracker.num_detections} detected faces')
+
+    def _iter_frames(self, video_clip, nth_frame):
+        """
+        A generator function which returns the frames of the video along with the information
+        whether the frame is sampled for the analysis. Unless the video is displayed,
+        only the sampled frames are decoded.
+        :param video_clip: moviepy.editor.VideoFileClip - the video to process
+        :param nth_frame: int, every nth frame will be analysed
+        :return: the generator returns tuples (t, video_frame, sampled)
+        """
+        if not self.display_vid:
+            for t, video_frame in iter_sampled_frames(video_clip, nth_frame):
+                yield t, video_frame, True
+            return
+
+        n_counter = 1
+        for t, video_frame in video_clip.iter_frames(with_times=True):
+            if n_counter == nth_frame:
+                yield t, video_frame, True
+                n_counter = 1
+            else:
+                yield t, video_frame, False
+                n_counter += 1
+
+    def _get_labels_batch(self, imgs, times, ledger=None):
+        """
+        A function which returns labels for multiple images without tracking the faces
+        :param imgs: a list of numpy.ndarray images, dimensions: (height, weight, 3)
+        :param times: a list of times of the frames (used only by the ledger)
+        :param ledger: EmbeddingLedger or None, the faces and their embeddings are recorded in it
+        :return: a list of sets of labels, one set for each image
+        """
+        if ledger is None:
+            return self.classifier_wrapper.get_labels_batch(imgs)
+
+        features, img_indices, bboxes = self.classifier_wrapper.get_detections_and_features_batch(imgs)
+        embedding_indices = ledger.add_embeddings(features)
+        for img_i, (t, img_bboxes) in enumerate(zip(times, bboxes)):
+            # The faces of the failed batch are recorded without the embeddings
+            img_embeddings = embedding_indices[img_indices == img_i] if len(features) != 0 \
+                else [-1] * len(img_bboxes)
+            ledger.add_frame(t, img_bboxes, img_embeddings)
+        return [set(scores) for scores in
+                self.classifier_wrapper.get_label_scores_for_features(features, img_indices, len(imgs))]
+
+    def _get_batch_labels(self, batch, face_tracker=None, scene_gate=None, ledger=None):
+        """
+        A function which returns the labels of a batch of sampled frames
+        :param batch: a list of (t, video_frame) tuples
+        :param face_tracker: FaceTracker or None, the faces tracked across the previous batches
+        :param scene_gate: SceneChangeGate or None, skips the frames without a scene change
+        :param ledger: EmbeddingLedger or None, the analysed faces are recorded in it
+               (the face tracker records the faces in its own ledger)
+        :return: a list of sets of labels, one set for each frame
+        """
+        video_frames, times = [video_frame for _, video_frame in batch], [t for t, _ in batch]
+        if ledger is not None:
+            ledger.add_sampled_times(times)
+        if face_tracker is not None:
+            get_labels_batch = face_tracker.get_labels_batch
+        else:
+            def get_labels_batch(imgs, imgs_times):
+                return self._get_labels_batch(imgs, imgs_times, ledger)
+        if scene_gate is not None:
+            return scene_gate.get_labels_batch(video_frames, times, get_labels_batch)
+        return get_labels_batch(video_frames, times)
+
+    def _process_batch(self, batch, presence_tracker, face_tracker=None, scene_gate=None, ledger=None):
+        """
+        A function which analyses a batch of sampled frames
+        :param batch: a list of (t, video_frame) tuples
+        :param presence_tracker: PresenceTracker, the state of the recording
+        :param face_tracker: FaceTracker or None, the faces tracked across the previous batches
+        :param scene_gate: SceneChangeGate or None, skips the frames without a scene change
+        :param ledger: EmbeddingLedger or None, the analysed faces are recorded in it
+        :return: a list of (t_start, t_end, identities) tuples of the finished recordings
+        """
+        # 1) Get labels for all the frames in the batch
+        batch_labels = self._get_batch_labels(batch, face_tracker, scene_gate, ledger)
+
+        # 2) Update the recording state in the order of the frames
+        intervals = []
+        for (t, _), detected_labels in zip(batch, batch_labels):
+            interval = presence_tracker.update(t, detected_labels)
+            if interval is not None:
+                intervals.append(interval)
+        return intervals
+
+    def _save_recordings(self, video_clip, intervals):
+        """
+        A function which saves the finished recordings
+        :param video_clip: moviepy.editor.VideoFileClip - the video which is currently being processed
+        :param intervals: a list of (t_start, t_end, identities) tuples
+        :return: None
+        """
+        for t_start, t_end, identities in intervals:
+            self._save_recording(video_clip, f'{time()}.mp4', identities, t_start, t_end)
+
+    def get_timeline(self, video_clip, nth_frame, m_analyses, batch_size=1, source_id=None, title=None):
+        """
+        A function which analyses the whole video without saving the video segments
+        and returns the intervals which would be recorded by process()
+        :param video_clip: moviepy.editor.VideoFileClip - the video to process
+        :param nth_frame: int, every nth frame will be analysed
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model
+               in a single forward pass
+        :param source_id: str, a stable ID of the video (e.g. the YouTube video ID) the embeddings are saved under,
+               the path or URL of the video if not set
+        :param title: str, the title of the video stored with the embeddings
+        :return: the detection timeline - a list of (t_start, t_end, identities) tuples,
+                 t_end of the last interval is None if the recording lasted until the end of the video
+        """
+        presence_tracker, ledger = self._new_presence_tracker(m_analyses), self._new_ledger()
+        face_tracker, scene_gate = self._new_face_tracker(ledger), self._new_scene_gate()
+        timeline, batch = [], []
+        for t, video_frame in iter_sampled_frames(video_clip, nth_frame):
+            batch.append((t, video_frame))
+            if len(batch) == batch_size:
+                timeline.extend(self._process_batch(batch, presence_tracker, face_tracker, scene_gate, ledger))
+                batch = []
+
+        if len(batch) != 0:
+            timeline.extend(self._process_batch(batch, presence_tracker, face_tracker, scene_gate, ledger))
+
+        self._report_skipped(face_tracker, scene_gate)
+        interval = presence_tracker.finish()
+        if interval is not None:
+            timeline.append(interval)
+        self._save_ledger(ledger, video_clip.filename, nth_frame, source_id, title)
+        return timeline
+
+    def get_detections(self, video_path, nth_frame, batch_size=1, start_frame=0, end_frame=None):
+        """
+        A function which analyses the sampled frames within a range of the video without recording anything.
+        The frames are sampled on the same grid as when the whole video is analysed and every frame
+        is analysed on its own (without the face tracker and the scene gate), so the labels don't depend
+        on the frames before the range.
+        :param video_path: str, a path of the local video file
+        :param nth_frame: int, every nth frame will be analysed
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model
+               in a single forward pass
+        :param start_frame: int, index of the first frame of the range
+        :param end_frame: int, index of the frame right after the range, the range ends with the video if not set
+        :return: a list of times and a list of sets of labels of the sampled frames within the range
+        """
+        reader = SamplingReader(video_path, nth_frame, start_frame=start_frame, end_frame=end_frame)
+        times, labels, batch = [], [], []
+        for t, video_frame in reader:
+            batch.append((t, video_frame))
+            if len(batch) == batch_size:
+                times.extend(t for t, _ in batch)
+                labels.extend(self._get_batch_labels(batch))
+                batch = []
+
+        if len(batch) != 0:
+            times.extend(t for t, _ in batch)
+            labels.extend(self._get_batch_labels(batch))
+        return times, labels
+
+    def get_timeline_from_detections(self, times, labels, m_analyses):
+        """
+        A function which returns the intervals which would be recorded by process()
+        for the given results of all the analyses of the video
+        :param times: a list of increasing times of the sampled frames
+        :param labels: a list of sets of labels detected in the sampled frames
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :return: the detection timeline - a list of (t_start, t_end, identities) tuples,
+                 t_end of the last interval is None if the recording lasted until the end of the video
+        """
+        detections = [len(frame_labels) != 0 for frame_labels in labels]
+        return PresenceTracker.replay(times, detections, m_analyses, self.start_count, self.stop_count,
+                                      self.min_clip_length, labels, self.pre_roll)
+
+    def process_timeline(self, video_clip, nth_frame, m_analyses, batch_size=1, source_id=None, title=None):
+        """
+        A function which first collects the detection timeline of the whole video
+        and then passes all the intervals to the writer stage, so the analysis never waits for the encoder.
+        :param video_clip: moviepy.editor.VideoFileClip - the video to process
+        :param nth_frame: int, every nth frame will be analysed
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model
+               in a single forward pass
+        :param source_id: str, a stable ID of the video (e.g. the YouTube video ID) the embeddings are saved under,
+               the path or URL of the video if not set
+        :param title: str, the title of the video stored with the embeddings
+        :return: the detection timeline - a list of (t_start, t_end, identities) tuples,
+                 the video segments are saved in the background, see close()
+        """
+        timeline = self.get_timeline(video_clip, nth_frame, m_analyses, batch_size, source_id, title)
+        print(f'Detected {len(timeline)} video segments to save')
+        self._get_clip_writer().save_timeline(video_clip.filename, timeline)
+        return timeline
+
+    def _get_clip_writer(self):
+        """
+        :return: ClipWriter, the writer stage - created on the first use
+        """
+        if self.clip_writer is None:
+            self.clip_writer = ClipWriter(self.video_dir, backend=self.clip_backend)
+        return self.clip_writer
+
+    def process_pipelined(self, video_clip, nth_frame, m_analyses, batch_size=1, num_workers=2, queue_size=4):
+        """
+        A function which processes the video in the same way as process() does, but the decoding,
+        the inference and the saving of the video segments run concurrently. The stages are connected
+        by bounded queues, so the decoder waits when the inference can't keep up.
+        The video is not displayed in this mode.
+        :param video_clip: moviepy.editor.VideoFileClip - the video to process
+        :param nth_frame: int, every nth frame will be analysed
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model
+               in a single forward pass
+        :param num_workers: int, a number of inference workers
+        :param queue_size: int, a maximum number of batches waiting in each of the queues
+        :return: None - the video segments are saved in the background, see close()
+        """
+        clip_writer = self._get_clip_writer()
+
+        stop_event, errors = Event(), []
+        frame_queue, result_queue = Queue(maxsize=queue_size), Queue(maxsize=queue_size)
+
+        # 1) Start the decoder and the inference workers
+        threads = [Thread(target=self._decode_stage,
+                          args=(video_clip, nth_frame, batch_size, num_workers, frame_queue, stop_event, errors))]
+        threads += [Thread(target=self._inference_stage, args=(frame_queue, result_queue, stop_event, errors))
+                    for _ in range(num_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        presence_tracker = self._new_presence_tracker(m_analyses)
+        pending, next_batch_i, finished_workers = {}, 0, 0
+        try:
+            # 2) Collect the results until all the workers are finished
+            while finished_workers < num_workers:
+                try:
+                    result = result_queue.get(timeout=0.1)
+                except Empty:
+                    if len(errors) != 0:
+                        break
+                    continue
+                if result is None:
+                    finished_workers += 1
+                    continue
+
+                # 3) The workers finish the batches in arbitrary order
+                # --> update the recording state in the order of the frames
+                batch_i, batch_times, batch_labels = result
+                pending[batch_i] = (batch_times, batch_labels)
+                while next_batch_i in pending:
+                    batch_times, batch_labels = pending.pop(next_batch_i)
+                    for t, detected_labels in zip(batch_times, batch_labels):
+                        interval = presence_tracker.update(t, detected_labels)
+                        if interval is not None:
+                            # 4) Pass the finished recording to the writer stage
+                            self._submit_recording(clip_writer, video_clip, interval)
+                    next_batch_i += 1
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+
+        if len(errors) != 0:
+            raise errors[0]
+
+        interval = presence_tracker.finish()
+        if interval is not None:
+            # 5) If the last frame was reached during recording then save the segment
+            self._submit_recording(clip_writer, video_clip, interval)
+
+    @staticmethod
+    def _decode_stage(video_clip, nth_frame, batch_size, num_workers, frame_queue, stop_event, errors):
+        """
+        A function which decodes the video and puts batches of the sampled frames to the frame queue
+        :param video_clip: moviepy.editor.VideoFileClip - the video to process
+        :param nth_frame: int, every nth frame will be analysed
+        :param batch_size: int, a number of sampled frames in one batch
+        :param num_workers: int, a number of inference workers - each of them gets an end marker
+        :param frame_queue: queue.Queue of (batch index, list of (t, video_frame)) tuples
+        :param stop_event: threading.Event, set when the pipeline is stopped
+        :param errors: a list the exceptions are stored in
+        :return: None
+        """
+        try:
+            batch, batch_i = [], 0
+            for t, video_frame in iter_sampled_frames(video_clip, nth_frame):
+                if stop_event.is_set():
+                    return
+                batch.append((t, video_frame))
+                if len(batch) == batch_size:
+                    if not _put(frame_queue, (batch_i, batch), stop_event):
+                        return
+                    batch, batch_i = [], batch_i + 1
+
+            if len(batch) != 0:
+                _put(frame_queue, (batch_i, batch), stop_event)
+        except Exception as err:
+            errors.append(err)
+            stop_event.set()
+        finally:
+            for _ in range(num_workers):
+                _put(frame_queue, None, stop_event)
+
+    def _inference_stage(self, frame_queue, result_queue, stop_event, errors):
+        """
+        A function which gets labels for the batches from the frame queue
+        and puts them to the result queue
+        :param frame_queue: queue.Queue of (batch index, list of (t, video_frame)) tuples
+        :param result_queue: queue.Queue of (batch index, list of times, list of sets of labels) tuples
+        :param stop_event: threading.Event, set when the pipeline is stopped
+        :param errors: a list the exceptions are stored in
+        :return: None
+        """
+        try:
+            while True:
+                try:
+                    item = frame_queue.get(timeout=0.1)
+                except Empty:
+                    if stop_event.is_set():
+                        return
+                    continue
+                if item is None:
+                    return
+
+                batch_i, batch = item
+                batch_labels = self.classifier_wrapper.get_labels_batch([video_frame for _, video_frame in batch])
+                if not _put(result_queue, (batch_i, [t for t, _ in batch], batch_labels), stop_event):
+                    return
+        except Exception as err:
+            errors.append(err)
+            stop_event.set()
+        finally:
+            _put(result_queue, None, stop_event)
+
+    @staticmethod
+    def _submit_recording(clip_writer, video_clip, interval):
+        """
+        A function which passes the finished recording to the writer stage
+        :param clip_writer: ClipWriter, the writer stage
+        :param video_clip: moviepy.editor.VideoFileClip - the video which is currently being processed
+        :param interval: a tuple (t_start, t_end, identities)
+        :return: None
+        """
+        print('Recording stopped')
+        t_start, t_end, identities = interval
+        clip_writer.submit(video_clip.filename, identities, t_start, t_end)
+
+    def join(self):
+        """
+        A function which waits until the video segments submitted to the writer stage so far are saved
+        :return: None, raises IOError if any of them was not saved
+        """
+        if self.clip_writer is None:
+            return
+        errors = self.clip_writer.join()
+        if len(errors) != 0:
+            raise IOError(f'{len(errors)} video segments were not saved, the first error: {errors[0]}')
+
+    def close(self):
+        """
+        A function which waits until all the video segments are saved
+        :return: None
+        """
+        if self.clip_writer is not None:
+            self.clip_writer.close()
+            self.clip_writer = None
 
     def _save_recording(self, video, video_name, currently_detected, t_start, t_end=None):
         """
@@ -106,8 +651,4 @@ class VideoProcessor:
         :return: None - saves the video segments directly to files
         """
         print('Recording stopped')
-        video_clip = video.subclip(t_start, t_end)
-        video_clip.write_videofile(join(self.video_dir, video_name), codec='libx265')
-        with open(join(self.video_dir, f'{video_name}_identities'), 'a') as f:
-            f.write(",".join(currently_detected))
-        currently_detected.clear()
\ No newline at end of file
+        save_clip(video, join(self.video_dir, video_name), currently_detected, t_start, t_end, self.clip_backend)
@@ -0,0 +1,210 @@
+import multiprocessing
+from os import cpu_count
+from queue import Queue
+
+import torch
+from moviepy.editor import VideoFileClip
+
+from .framereader import get_frame_count
+from .jobstore import get_owner
+
+# The video processor of the parent process - the forked workers inherit it along with the loaded model,
+# so the weights are read only once and their memory pages are shared copy-on-write (they are never written)
+_video_processor = None
+
+
+def _init_worker(num_threads):
+    """
+    A function which limits the number of torch intra-op threads of the worker
+    :param num_threads: int, the number of threads
+    :return: None
+    """
+    torch.set_num_threads(num_threads)
+
+
+def _run_video(source, open_video, process_args, source_id=None, title=None):
+    """
+    :param source: the video source
+    :param open_video: a module level function source -> moviepy.editor.VideoFileClip
+    :param process_args: a tuple of the arguments of VideoProcessor.process after the video
+    :param source_id: str, a stable ID of the video (e.g. the YouTube video ID)
+    :param title: str, the title of the video
+    :return: str, the error message or None if the video was processed
+    """
+    try:
+        video = open_video(source)
+        try:
+            _video_processor.process(video, *process_args, source_id=source_id, title=title)
+        finally:
+            video.close()
+    except Exception as err:
+        return str(err)
+    return None
+
+
+def _process_video(job):
+    """
+    A function which processes one video in the worker process. If the video is a job of the job store,
+    the worker claims it on behalf of the parent process, keeps its heartbeat while processing it
+    and marks it as done or failed afterwards
+    :param job: a tuple (source, open_video, process_args, claim), where claim is None
+           or a tuple (job_store, video_id, title, owner, heartbeat_interval)
+    :return: a tuple (source, the error message or None) or None if another process claimed the video
+    """
+    source, open_video, process_args, claim = job
+    if claim is None:
+        return source, _run_video(source, open_video, process_args)
+
+    job_store, video_id, title, owner, heartbeat_interval = claim
+    if not job_store.claim(video_id, owner):
+        return None
+    with job_store.heartbeat(video_id, heartbeat_interval, owner):
+        error = _run_video(source, open_video, process_args, video_id, title)
+    # The video is marked as processed only after it was processed
+    if error is None:
+        job_store.mark_done(video_id, owner)
+    else:
+        job_store.mark_failed(video_id, error, owner)
+    return source, error
+
+
+def _detect_shard(job):
+    """
+    A function which analyses one time shard of the video in the worker process
+    :param job: a tuple of the arguments of VideoProcessor.get_detections
+    :return: a list of times and a list of sets of labels of the sampled frames within the shard
+    """
+    return _video_processor.get_detections(*job)
+
+
+def split_into_shards(frame_count, nth_frame, num_shards):
+    """
+    A function which splits the video into ranges of frames with the same number of sampled frames,
+    the boundaries are aligned to the sampling grid
+    :param frame_count: int, the number of frames of the video
+    :param nth_frame: int, every nth frame is analysed
+    :param num_shards: int, the maximum number of ranges
+    :return: a list of (start_frame, end_frame) tuples, end_frame of the last range is None
+    """
+    num_samples = frame_count // nth_frame
+    bounds = sorted({nth_frame * (num_samples * i // num_shards) for i in range(num_shards)})
+    # The number of frames in the header can be inaccurate --> the last range ends with the video
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+class VideoWorkerPool:
+    """
+    A class which processes multiple videos in parallel worker processes. The workers are forked after
+    the model was loaded by the VideoProcessor of the parent process, so they share its weights.
+    All the workers save the video segments to the video_dir of the VideoProcessor.
+    The parent process must not run the model before the pool is created (the thread pools of torch
+    don't survive the fork) and only one pool can exist at a time.
+    """
+
+    def __init__(self, video_processor, num_workers=None, threads_per_worker=None):
+        """
+        :param video_processor: VideoProcessor used by all the workers
+        :param num_workers: int, the number of worker processes, the number of CPUs if not set
+        :param threads_per_worker: int, the number of torch intra-op threads of each worker,
+               the CPUs are split evenly among the workers if not set
+        """
+        global _video_processor
+
+        self.num_workers = num_workers if num_workers is not None else cpu_count()
+        if threads_per_worker is None:
+            threads_per_worker = max(cpu_count() // self.num_workers, 1)
+        self.threads_per_worker = threads_per_worker
+
+        _video_processor = video_processor
+        self._pool = multiprocessing.get_context('fork').Pool(self.num_workers, _init_worker, (threads_per_worker,))
+
+    def process(self, sources, nth_frame, m_analyses, batch_size=1, open_video=VideoFileClip, job_store=None,
+                heartbeat_interval=60):
+        """
+        A generator function which processes the videos in the worker processes
+        :param sources: an iterable of video sources (paths of the video files by default),
+               or of (video_id, title, source) tuples if the job store is set
+        :param nth_frame: int, every nth frame will be analysed
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model in a single forward pass
+        :param open_video: a module level function source -> moviepy.editor.VideoFileClip
+        :param job_store: JobStore, if set, each video is claimed by the worker right before it is processed
+               (on behalf of this process, see JobStore.release_owned) and marked as done or failed by it,
+               the videos claimed by another process are skipped
+        :param heartbeat_interval: float, the time between the heartbeats of the claimed videos in seconds
+        :return: a tuple (source, the error message or None) for every finished video in the order of completion
+        """
+        process_args = (nth_frame, m_analyses, batch_size)
+        if job_store is None:
+            jobs = ((source, open_video, process_args, None) for source in sources)
+        else:
+            owner = get_owner()
+            jobs = ((source, open_video, process_args, (job_store, video_id, title, owner, heartbeat_interval))
+                    for video_id, title, source in sources)
+
+        # The next video is taken from the sources only when a worker is free, so the sources (e.g. the poller
+        # with its bounded queue of the prepared streams) are not drained ahead of the workers
+        results = Queue()
+        num_running = 0
+        while True:
+            if num_running == self.num_workers:
+                result = results.get()
+                num_running -= 1
+                if result is not None:
+                    yield result
+            job = next(jobs, None)
+            if job is None:
+                break
+            self._pool.apply_async(_process_video, (job,), callback=results.put,
+                                   error_callback=lambda err, source=job[0]: results.put((source, str(err))))
+            num_running += 1
+        for _ in range(num_running):
+            result = results.get()
+            if result is not None:
+                yield result
+
+    def get_timeline(self, video_path, nth_frame, m_analyses, batch_size=1, num_shards=None):
+        """
+        A function which splits the local video file into time shards analysed in parallel by the workers
+        and stitches their detections into the intervals which would be recorded by VideoProcessor.process().
+        The face tracker and the scene gate carry state from frame to frame, so the shards would differ
+        from the sequential pass at their boundaries --> the video processor must not use them.
+        :param video_path: str, a path of the local video file
+        :param nth_frame: int, every nth frame will be analysed
+        :param m_analyses: int, a number which defines how long to keep recording
+               - defined as a number of analyses since the last positive detection
+        :param batch_size: int, a number of sampled frames whose faces are fed to the model in a single forward pass
+        :param num_shards: int, the number of shards, the number of workers if not set
+        :return: the detection timeline - a list of (t_start, t_end, identities) tuples,
+                 t_end of the last interval is None if the recording lasted until the end of the video
+        """
+        if _video_processor.track_faces or _video_processor.scene_change_threshold is not None:
+            raise ValueError('The sharded analysis requires the face tracker and the scene gate to be disabled')
+        num_shards = num_shards if num_shards is not None else self.num_workers
+        shards = split_into_shards(get_frame_count(video_path), nth_frame, num_shards)
+        jobs = [(video_path, nth_frame, batch_size, start_frame, end_frame) for start_frame, end_frame in shards]
+
+        # The detections of the shards (in the order of the shards) form the detections of the whole video,
+        # the recording state is computed from all of them at once
+        times, labels = [], []
+        for shard_times, shard_labels in self._pool.imap(_detect_shard, jobs):
+            times.extend(shard_times)
+            labels.extend(shard_labels)
+        return _video_processor.get_timeline_from_detections(times, labels, m_analyses)
+
+    def close(self):
+        """
+        A function which waits until the workers finish the submitted videos and stops them
+        :return: None
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """
+        A function which stops the workers immediately
+        :return: None
+        """
+        self._pool.terminate()
+        self._pool.join()